@@ -0,0 +1,51 @@
+#coding=utf8
+"""
+BatchCapture depositing held orders against the local simulator with the bank latency emulated.
+Reports capture rate, p50/p99 latency and the projected time of a day's holds for every concurrency.
+
+    python benchmarks/bench_capture.py [--orders 2000] [--latency 0.05] [--concurrency 1 8 32] [--daily 100000]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pysberbps import SberWrapper, PooledTransport, BatchCapture
+from pysberbps.simulator import SberSimulator
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated bank latency, seconds')
+    parser.add_argument('--concurrency', type=int, nargs='*', default=(1, 8, 32))
+    parser.add_argument('--daily', type=int, default=100000, help='held orders per day for projection')
+    args = parser.parse_args()
+
+    with SberSimulator(latency=args.latency) as simulator:
+        print('{0:>11} {1:>7} {2:>8} {3:>8} {4:>8} {5:>10}'.format('concurrency', 'orders', 'req/s', 'p50, ms',
+                                                                   'p99, ms', 'daily, min'))
+        for concurrency in args.concurrency:
+            # serial run is slow, it gets fewer orders
+            orders = args.orders if concurrency > 1 else min(args.orders, 100)
+            order_ids = []
+            for number in range(orders):
+                order_id = simulator._registerPreAuth(dict(orderNumber='{0}-{1}'.format(concurrency, number),
+                                                           amount=100))['orderId']
+                simulator.pay(order_id)
+                order_ids.append(order_id)
+            transport = PooledTransport(maxsize=concurrency)
+            wrapper = SberWrapper('user', 'password', urls=simulator.urls, transport=transport)
+            capture = BatchCapture(wrapper, concurrency=concurrency)
+            failed = sum(1 for result in capture.run((order_id, 0) for order_id in order_ids)
+                         if result.error is not None)
+            transport.close()
+            stats = capture.stats
+            print('{0:>11} {1:>7} {2:>8.0f} {3:>8.1f} {4:>8.1f} {5:>10.1f}{6}'.format(
+                concurrency, orders, stats.rate, stats.p50 * 1000, stats.p99 * 1000, args.daily / stats.rate / 60,
+                ' ({0} failed)'.format(failed) if failed else ''))
+
+
+if __name__ == '__main__':
+    main()
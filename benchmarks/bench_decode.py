@@ -0,0 +1,69 @@
+#coding=utf8
+"""
+Decode time of a getOrderStatusExtended.do reply with available JSON decoders
+and memory of many status replies kept as dicts and as OrderStatusInfo.
+
+    python benchmarks/bench_decode.py [--number 100000] [--orders 10000]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pysberbps.responses import OrderStatusInfo
+
+BODY = json.dumps(dict(
+    errorCode='0', errorMessage='Success', orderNumber='0784sse49d0s134567890', orderStatus=2, actionCode=0,
+    actionCodeDescription='', amount=33000, currency='643', date=1383819429914, orderDescription=' ',
+    merchantOrderParams=[dict(name='email', value='yap@bk.ru')], attributes=[dict(name='mdOrder',
+                                                                                 value='b9054496-c65a-4975')],
+    cardAuthInfo=dict(expiration='201512', cardholderName='Ivan', secureAuthInfo=dict(eci=6),
+                      pan='411111**1111', approvalCode='123456'),
+    authDateTime=1383819429914, terminalId='111113', authRefNum='111111111111',
+    paymentAmountInfo=dict(paymentState='DEPOSITED', approvedAmount=33000, depositedAmount=33000, refundedAmount=0),
+    bankInfo=dict(bankName='TEST CARD', bankCountryCode='RU', bankCountryName='Россия'),
+)).encode('utf-8')
+
+
+def decoders():
+    yield 'json(str)', lambda body: json.loads(body.decode('utf8'))
+    yield 'json(bytes)', json.loads
+    for name in ('orjson', 'ujson'):
+        try:
+            yield name, __import__(name).loads
+        except ImportError:
+            pass
+
+
+def kept_memory(factory, orders):
+    tracemalloc.start()
+    kept = [factory() for _ in range(orders)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return size / orders
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=100000)
+    parser.add_argument('--orders', type=int, default=10000)
+    args = parser.parse_args()
+
+    print('{0:<12} {1:>8}'.format('decoder', 'us/call'))
+    for name, decode in decoders():
+        seconds = min(timeit.repeat(lambda: decode(BODY), number=args.number, repeat=3))
+        print('{0:<12} {1:>8.2f}'.format(name, seconds / args.number * 1e6))
+
+    print('{0:<16} {1:>12}'.format('kept as', 'bytes/order'))
+    print('{0:<16} {1:>12.0f}'.format('dict', kept_memory(lambda: json.loads(BODY), args.orders)))
+    print('{0:<16} {1:>12.0f}'.format('OrderStatusInfo', kept_memory(
+        lambda: OrderStatusInfo.from_status_ext(json.loads(BODY)), args.orders)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#coding=utf8
+"""
+Micro-benchmark of request encoding time and allocations: the old way (full dict with credentials + urlencode)
+against SberWrapper._prepare with precomputed credentials.
+
+    python benchmarks/bench_encode.py [--number 100000]
+"""
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pysberbps import SberWrapper
+
+ORDER_ID = '976495d3-2fa6-4e99-a026-058f83622767'
+
+
+def before(wrapper):
+    url = wrapper.urls['status']
+    request = dict(userName=wrapper._username, password=wrapper._password, orderId=ORDER_ID, language='RU')
+    return 'POST', url, urllib.parse.urlencode(request).encode('utf-8'), {
+        "Content-Type": "application/x-www-form-urlencoded;charset=utf-8"}
+
+
+def after(wrapper):
+    return wrapper._prepare(*wrapper._status_request(ORDER_ID, 'RU'))
+
+
+def before_register(wrapper):
+    request = dict(userName=wrapper._username, password=wrapper._password, orderNumber='A1', amount=100,
+                   currency=643, returnUrl='https://example.com/success', language='RU', pageView='DESKTOP',
+                   sessionTimeoutSecs=1200, jsonParams={'email': 'user@example.com'})
+    return 'POST', wrapper.urls['register'], urllib.parse.urlencode(request).encode('utf-8'), {
+        "Content-Type": "application/x-www-form-urlencoded;charset=utf-8"}
+
+
+def after_register(wrapper):
+    return wrapper._prepare(*wrapper._register_request('A1', 100, 'https://example.com/success',
+                                                       extra={'email': 'user@example.com'}))
+
+
+def allocated(func, wrapper, number=1000):
+    """Mean peak of memory allocated by one call, bytes"""
+    tracemalloc.start()
+    total = 0
+    for _ in range(number):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        func(wrapper)
+        total += tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return total / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    wrapper = SberWrapper('merchant-api', 'secret password')
+    print('{0:<18} {1:>10} {2:>12}'.format('variant', 'us/call', 'bytes/call'))
+    for name, func in (('status before', before), ('status after', after),
+                       ('register before', before_register), ('register after', after_register)):
+        seconds = min(timeit.repeat(lambda: func(wrapper), number=args.number, repeat=3))
+        print('{0:<18} {1:>10.3f} {2:>12.0f}'.format(name, seconds / args.number * 1e6, allocated(func, wrapper)))
+
+
+if __name__ == '__main__':
+    main()
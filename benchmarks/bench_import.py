@@ -0,0 +1,65 @@
+#coding=utf8
+"""
+Import time of pysberbps measured with `python -X importtime` in fresh interpreters.
+Reports the best cumulative time of `import pysberbps` and the slowest modules it loads.
+Exits with status 1 if time exceeds --max-ms or a module of --forbid is loaded, so CI can assert against it.
+
+    python benchmarks/bench_import.py [--runs 5] [--max-ms 50] [--forbid urllib.request http.client ssl asyncio]
+"""
+import argparse
+import compileall
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FORBIDDEN = ('urllib.request', 'http.client', 'ssl', 'asyncio', 'email.parser', 'datetime', 'json')
+
+
+def import_times(statement='import pysberbps'):
+    """
+    :return: {module: (self us, cumulative us)} of one fresh interpreter
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=ROOT,
+                             stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--statement', default='import pysberbps')
+    parser.add_argument('--max-ms', type=float, help='fail if import is slower')
+    parser.add_argument('--forbid', nargs='*', default=FORBIDDEN, help='fail if one of modules is imported')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    # deployed packages have bytecode compiled, don't measure compilation
+    compileall.compile_dir(os.path.join(ROOT, 'pysberbps'), quiet=1)
+    runs = [import_times(args.statement) for _ in range(args.runs)]
+    best = min(runs, key=lambda times: times['pysberbps'][1])
+    total = best['pysberbps'][1] / 1000
+    print('{0}: {1:.2f} ms (best of {2})'.format(args.statement, total, args.runs))
+    print('{0:<32} {1:>10} {2:>10}'.format('module', 'self, ms', 'cumul, ms'))
+    for name, (own, cumulative) in sorted(best.items(), key=lambda item: -item[1][0])[:args.top]:
+        print('{0:<32} {1:>10.2f} {2:>10.2f}'.format(name, own / 1000, cumulative / 1000))
+
+    failed = False
+    loaded = sorted(name for name in args.forbid if name in best)
+    if loaded:
+        print('FAIL: imported {0}'.format(', '.join(loaded)))
+        failed = True
+    if args.max_ms is not None and total > args.max_ms:
+        print('FAIL: {0:.2f} ms > {1} ms'.format(total, args.max_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#coding=utf8
+"""
+StatusPoller following many pending orders: memory per watched order, scheduler CPU time
+and request rate against the simulator running in a separate process.
+
+    python benchmarks/bench_poller.py [--orders 50000] [--rate 500] [--seconds 10]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pysberbps import SberWrapper, PooledTransport, StatusPoller
+from pysberbps.batch import imap_unordered
+from harness import start_simulator
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=50000)
+    parser.add_argument('--rate', type=float, default=500, help='maximum status requests per second')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    process, urls = start_simulator(0.0)
+    try:
+        transport = PooledTransport(maxsize=args.concurrency)
+        wrapper = SberWrapper('user', 'password', urls=urls, transport=transport, coalesce=False)
+        print('registering {0} orders...'.format(args.orders))
+        register = lambda number: wrapper.register('{0}-{1}'.format(os.getpid(), number), 100,
+                                                   'https://example.com/')[0]
+        order_ids = [result.result for result in imap_unordered(register, range(args.orders), args.concurrency)]
+        poller = StatusPoller(wrapper, interval=1.0, max_interval=30.0, concurrency=args.concurrency,
+                              rate=args.rate)
+
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        for order_id in order_ids[:1000]:
+            poller.watch(order_id, timeout=args.seconds)
+        memory = (tracemalloc.get_traced_memory()[0] - baseline) / 1000
+        tracemalloc.stop()
+
+        cpu, wall = time.process_time(), time.perf_counter()
+        for order_id in order_ids[1000:]:
+            poller.watch(order_id, timeout=args.seconds)
+        poller.wait(args.seconds + 5)
+        cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+        poller.close()
+        transport.close()
+        print('orders {0}, memory per watched order {1:.0f} B'.format(args.orders, memory))
+        print('polls {0} in {1:.1f} s: {2:.0f} req/s (limit {3:.0f}), client CPU {4:.2f} s'.format(
+            poller.polls, wall, poller.polls / wall, args.rate, cpu))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#coding=utf8
+"""
+SberWrapper.register_many against the simulator running in a separate process: registrations per second
+and peak memory of the pipeline for every concurrency. Peak memory doesn't grow with --orders.
+
+    python benchmarks/bench_register.py [--orders 20000] [--latency 0.02] [--concurrency 8 32 64]
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pysberbps import SberWrapper, PooledTransport
+from harness import start_simulator
+
+
+def specs(prefix, orders):
+    for number in range(orders):
+        yield dict(order='{0}-{1}'.format(prefix, number), amount=100 + number, success_url='https://example.com/',
+                   description='Invoice {0}'.format(number), extra={'invoice': str(number)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=20000)
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated bank latency, seconds')
+    parser.add_argument('--concurrency', type=int, nargs='*', default=(8, 32, 64))
+    args = parser.parse_args()
+
+    process, urls = start_simulator(args.latency)
+    try:
+        print('{0:>11} {1:>8} {2:>8} {3:>8} {4:>12}'.format('concurrency', 'orders', 'errors', 'req/s', 'peak, KiB'))
+        for concurrency in args.concurrency:
+            transport = PooledTransport(maxsize=concurrency)
+            wrapper = SberWrapper('user', 'password', urls=urls, transport=transport)
+            tracemalloc.start()
+            batch = wrapper.register_many(specs('{0}-{1}'.format(os.getpid(), concurrency), args.orders),
+                                          concurrency)
+            errors = sum(1 for result in batch if result.error is not None)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            transport.close()
+            print('{0:>11} {1:>8} {2:>8} {3:>8.0f} {4:>12.0f}'.format(concurrency, args.orders, errors,
+                                                                     batch.stats.rate, peak / 1024))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#coding=utf8
+"""
+Benchmark of SOAP against REST calls: WSDL loading (parse, disk cache, memory), client CPU time
+of request encoding and reply decoding, and status_ext calls to the simulator over keep-alive connections.
+
+    python benchmarks/bench_soap.py [--calls 2000] [--number 20000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pysberbps import SberWrapper, PooledTransport, soap
+from pysberbps.simulator import SberSimulator
+
+
+def load_times(simulator, cache_dir, number=20):
+    """Mean seconds of soap.load_service from WSDL, from cache directory and from memory"""
+    wsdl = simulator.wsdl().encode('utf-8')
+    parse = min(timeit.repeat(lambda: soap.parse_wsdl(wsdl), number=number, repeat=3)) / number
+    soap.load_service(simulator.wsdl_url, cache_dir)
+
+    def from_disk():
+        soap._services.clear()
+        soap.load_service(simulator.wsdl_url, cache_dir)
+    disk = min(timeit.repeat(from_disk, number=number, repeat=3)) / number
+    memory = min(timeit.repeat(lambda: soap.load_service(simulator.wsdl_url, cache_dir), number=number,
+                               repeat=3)) / number
+    return parse, disk, memory
+
+
+def codec_time(wrapper, order_id, body, number):
+    """Mean seconds to encode status_ext request and decode its reply"""
+    def call():
+        wrapper._prepare(*wrapper._status_ext_request(order_id))
+        wrapper.decoder(body)
+    return min(timeit.repeat(call, number=number, repeat=3)) / number
+
+
+def call_time(wrapper, order_id, calls):
+    """Wall and CPU seconds per status_ext call"""
+    cpu, wall = time.process_time(), time.perf_counter()
+    for _ in range(calls):
+        wrapper.status_ext(order_id)
+    return (time.perf_counter() - wall) / calls, (time.process_time() - cpu) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    with SberSimulator() as simulator, tempfile.TemporaryDirectory() as cache_dir:
+        parse, disk, memory = load_times(simulator, cache_dir)
+        print('WSDL load: parse {0:.1f} us, disk cache {1:.1f} us, memory {2:.2f} us'.format(
+            parse * 1e6, disk * 1e6, memory * 1e6))
+
+        order_id = simulator._register(dict(orderNumber='B1', amount=100))['orderId']
+        simulator.pay(order_id)
+        rest = SberWrapper('user', 'password', urls=simulator.urls, transport=PooledTransport(), coalesce=False)
+        soap_wrapper = SberWrapper('user', 'password', soap=True, wsdl=simulator.wsdl_url, wsdl_cache=cache_dir,
+                                   transport=PooledTransport(), coalesce=False)
+        rest_body = rest.transport.request(*rest._prepare(*rest._status_ext_request(order_id))).body
+        soap_body = soap_wrapper.transport.request(
+            *soap_wrapper._prepare(*soap_wrapper._status_ext_request(order_id))).body
+
+        print('{0:<6} {1:>12} {2:>14} {3:>14} {4:>12}'.format(
+            'api', 'reply bytes', 'codec us/call', 'wall ms/call', 'cpu ms/call'))
+        for name, wrapper, body in (('rest', rest, rest_body), ('soap', soap_wrapper, soap_body)):
+            wall, cpu = call_time(wrapper, order_id, args.calls)
+            print('{0:<6} {1:>12} {2:>14.2f} {3:>14.3f} {4:>12.3f}'.format(
+                name, len(body), codec_time(wrapper, order_id, body, args.number) * 1e6, wall * 1e3, cpu * 1e3))
+            wrapper.transport.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#coding=utf8
+"""
+Throughput and tail latency of SberWrapper.status_ext_many against the local simulator
+as concurrency grows.
+
+    python benchmarks/bench_status_many.py [--orders 400] [--latency 0.02] [--concurrency 1 4 16 64]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pysberbps import SberWrapper, PooledTransport
+from pysberbps.simulator import SberSimulator
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class TimedWrapper(SberWrapper):
+    """Collects latency of every status_ext call"""
+    def __init__(self, *args, **kwargs):
+        super(TimedWrapper, self).__init__(*args, **kwargs)
+        self.latencies = []
+
+    def status_ext(self, order_id, language='RU'):
+        started = time.perf_counter()
+        try:
+            return super(TimedWrapper, self).status_ext(order_id, language)
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=400)
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated bank latency, seconds')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    args = parser.parse_args()
+
+    with SberSimulator(latency=args.latency) as simulator:
+        order_ids = [simulator.handle('register.do', dict(userName='u', password='p', orderNumber=str(i),
+                                                          amount='100'))['orderId'] for i in range(args.orders)]
+        print('{0:>11} {1:>10} {2:>9} {3:>9}'.format('concurrency', 'orders/s', 'p50, ms', 'p99, ms'))
+        for concurrency in args.concurrency:
+            transport = PooledTransport(maxsize=concurrency)
+            wrapper = TimedWrapper('user', 'password', urls=simulator.urls, transport=transport)
+            started = time.perf_counter()
+            for result in wrapper.status_ext_many(order_ids, concurrency=concurrency):
+                assert result.error is None, result.error
+            elapsed = time.perf_counter() - started
+            print('{0:>11} {1:>10.1f} {2:>9.2f} {3:>9.2f}'.format(
+                concurrency, len(order_ids) / elapsed,
+                percentile(wrapper.latencies, 0.5) * 1000, percentile(wrapper.latencies, 0.99) * 1000))
+            transport.close()
+
+
+if __name__ == '__main__':
+    main()
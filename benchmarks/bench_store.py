@@ -0,0 +1,79 @@
+#coding=utf8
+"""
+OrderStore answering status_ext of finished orders without the bank: lookups per second through
+SberWrapper, order number lookups and range scan rate.
+
+    python benchmarks/bench_store.py [--orders 200000] [--lookups 100000] [--threads 4]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pysberbps import SberWrapper, OrderStore
+
+
+def populate(store, orders):
+    started = 1.7e9
+    for number in range(orders):
+        order_id = '{0:032x}'.format(number)
+        store.record_register(order_id, 'N{0}'.format(number), 100 + number % 1000, created=started + number)
+        store.record_status(order_id, 'status_ext', 'RU', dict(
+            orderNumber='N{0}'.format(number), orderStatus=2, amount=100 + number % 1000, currency='643',
+            date=int((started + number) * 1000), errorCode='0', errorMessage='Success',
+            paymentAmountInfo=dict(approvedAmount=100, depositedAmount=100, refundedAmount=0),
+            cardAuthInfo=dict(pan='411111**1111', expiration='201912', cardholderName='KENNY MCCORMICK')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=200000)
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory, OrderStore(os.path.join(directory, 'orders.sqlite')) as store:
+        started = time.perf_counter()
+        populate(store, args.orders)
+        print('populated {0} orders in {1:.1f} s'.format(args.orders, time.perf_counter() - started))
+
+        # urls point nowhere, every lookup must be answered locally
+        wrapper = SberWrapper('user', 'password', urls=dict.fromkeys(SberWrapper.rest_urls, 'http://127.0.0.1:1/'),
+                              store=store, coalesce=False)
+        order_ids = ['{0:032x}'.format(random.randrange(args.orders)) for _ in range(args.lookups)]
+        per_thread = args.lookups // args.threads
+
+        def worker(part):
+            for order_id in part:
+                wrapper.status_ext(order_id)
+
+        workers = [threading.Thread(target=worker, args=(order_ids[n * per_thread:(n + 1) * per_thread],))
+                   for n in range(args.threads)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        print('status_ext from store: {0:.0f} lookups/s ({1} threads)'.format(per_thread * args.threads / elapsed,
+                                                                              args.threads))
+
+        started = time.perf_counter()
+        for number in random.sample(range(args.orders), min(10000, args.orders)):
+            store.find('N{0}'.format(number))
+        print('find by order number: {0:.0f} lookups/s'.format(min(10000, args.orders) /
+                                                              (time.perf_counter() - started)))
+
+        started = time.perf_counter()
+        scanned = sum(1 for _ in store.scan(1.7e9, 1.7e9 + args.orders / 2))
+        print('range scan: {0} orders at {1:.0f} rows/s'.format(scanned, scanned / (time.perf_counter() - started)))
+        print(store.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#coding=utf8
+"""
+Throughput of one SberWrapper shared by many threads against the local simulator: every thread
+registers orders, requests their status, refunds them and requests status_ext.
+Exits with status 1 if the largest thread count isn't --min-speedup times faster than one thread,
+so CI can assert that calls don't serialize on shared state.
+
+    python benchmarks/bench_threads.py [--orders 40] [--latency 0.002] [--threads 1 2 4 8] [--min-speedup 2]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pysberbps import SberWrapper
+from pysberbps.simulator import SberSimulator
+
+
+def run(wrapper, simulator, threads, orders, prefix):
+    """
+    :return: calls per second
+    """
+    def worker(number):
+        for index in range(orders):
+            order_id, _ = wrapper.register('{0}-{1}-{2}'.format(prefix, number, index), 100, 'https://example.com/')
+            wrapper.status(order_id)
+            simulator.pay(order_id)
+            wrapper.refund(order_id, 100)
+            wrapper.status_ext(order_id)
+
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return threads * orders * 4 / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=40, help='orders of every thread')
+    parser.add_argument('--latency', type=float, default=0.002, help='simulated bank latency, seconds')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--min-speedup', type=float, help='fail if the last thread count is slower')
+    args = parser.parse_args()
+
+    with SberSimulator(latency=args.latency) as simulator:
+        wrapper = SberWrapper('user', 'password', urls=simulator.urls, transport='pooled')
+        try:
+            print('{0:>7} {1:>10} {2:>8}'.format('threads', 'calls/s', 'speedup'))
+            single = None
+            for threads in args.threads:
+                rate = run(wrapper, simulator, threads, args.orders, 'threads-{0}'.format(threads))
+                single = single or rate
+                print('{0:>7} {1:>10.1f} {2:>8.2f}'.format(threads, rate, rate / single))
+        finally:
+            wrapper.transport.close()
+    if args.min_speedup is not None and rate / single < args.min_speedup:
+        print('FAIL: speedup {0:.2f} < {1}'.format(rate / single, args.min_speedup))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
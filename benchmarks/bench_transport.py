@@ -0,0 +1,91 @@
+#coding=utf8
+"""
+Compare requests/sec of SberWrapper.status over the transports (urllib, pooled, http2)
+against the local simulator.
+
+    python benchmarks/bench_transport.py [--requests 500] [--threads 4] [--no-tls] [--transports urllib pooled http2]
+
+TLS certificate for the local server is generated with the openssl binary. http2 is skipped if httpx
+is not installed; the simulator speaks HTTP/1.1 only, so it measures the overhead of httpx there
+and its multiplexing pays off against the bank hosts.
+"""
+import argparse
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pysberbps import SberWrapper
+from pysberbps.transport import create_transport
+from pysberbps.simulator import SberSimulator
+
+
+def make_ssl_contexts(directory):
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                           '-subj', '/CN=127.0.0.1', '-keyout', key, '-out', cert],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server.load_cert_chain(cert, key)
+    client = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    client.check_hostname = False
+    client.verify_mode = ssl.CERT_NONE
+    return server, client
+
+
+def run(wrapper, order_id, requests, threads):
+    per_thread = requests // threads
+
+    def worker():
+        for _ in range(per_thread):
+            wrapper.status(order_id)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return per_thread * threads / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--no-tls', action='store_true')
+    parser.add_argument('--transports', nargs='*', default=('urllib', 'pooled', 'http2'))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        server_context = client_context = None
+        if not args.no_tls:
+            server_context, client_context = make_ssl_contexts(directory)
+
+        with SberSimulator(ssl_context=server_context) as simulator:
+            order_id = simulator.handle('register.do', dict(userName='u', password='p', orderNumber='1',
+                                                            amount='100'))['orderId']
+            options = dict(
+                urllib=dict(ssl_context=client_context),
+                pooled=dict(maxsize=args.threads, ssl_context=client_context),
+                http2=dict(ssl_context=client_context),
+            )
+            print('{0:<10} {1:>10}'.format('transport', 'req/s'))
+            for name in args.transports:
+                try:
+                    transport = create_transport(name, **options.get(name, {}))
+                except ImportError as e:
+                    print('{0:<10} {1:>10}'.format(name, 'skipped: {0}'.format(e)))
+                    continue
+                with transport:
+                    wrapper = SberWrapper('user', 'password', urls=simulator.urls, transport=transport,
+                                          coalesce=False)
+                    print('{0:<10} {1:>10.1f}'.format(name, run(wrapper, order_id, args.requests, args.threads)))
+
+if __name__ == '__main__':
+    main()
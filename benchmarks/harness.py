@@ -0,0 +1,172 @@
+#coding=utf8
+"""
+Benchmark harness of SberWrapper client overhead against the local simulator.
+The simulator runs in a separate process, so CPU time is spent by the client only.
+
+    python benchmarks/harness.py [--calls 2000] [--threads 8] [--latency 0.0] [--method status] [--replay]
+
+For every mode (serial, threaded, async) it reports requests/sec, client CPU time per call
+and p50/p99 latency. With --replay the serial run is recorded and replayed by ReplayTransport,
+which shows the client overhead without any network. Allocated memory per call is measured with tracemalloc in a separate serial run.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pysberbps import SberWrapper, AsyncSberWrapper, PooledTransport
+from pysberbps.recording import RecordingTransport, ReplayTransport
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def start_simulator(latency):
+    process = subprocess.Popen([sys.executable, '-m', 'pysberbps.simulator', '--latency', str(latency)],
+                               stdout=subprocess.PIPE, universal_newlines=True,
+                               cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    base_url = process.stdout.readline().strip()
+    urls = dict(register=base_url + 'register.do', registerPreAuth=base_url + 'registerPreAuth.do',
+                status=base_url + 'getOrderStatus.do', status_ext=base_url + 'getOrderStatusExtended.do',
+                refund=base_url + 'refund.do', deposit=base_url + 'deposit.do', reverse=base_url + 'reverse.do')
+    return process, urls
+
+
+class Workload(object):
+    """Calls one wrapper method with fresh arguments"""
+    def __init__(self, method, order_id):
+        self.method = method
+        self.order_id = order_id
+        self.counter = 0
+
+    def args(self):
+        if self.method == 'register':
+            self.counter += 1
+            return '{0}-{1}'.format(os.getpid(), self.counter), 100, 'https://example.com/'
+        return self.order_id,
+
+
+def run_serial(wrapper, workload, calls):
+    method = getattr(wrapper, workload.method)
+    latencies = []
+    for _ in range(calls):
+        args = workload.args()
+        started = time.perf_counter()
+        method(*args)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def run_threaded(wrapper, workload, calls, threads):
+    method = getattr(wrapper, workload.method)
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(calls // threads):
+            with lock:
+                args = workload.args()
+            started = time.perf_counter()
+            method(*args)
+            latencies.append(time.perf_counter() - started)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return latencies
+
+
+def run_async(urls, workload, calls, concurrency):
+    async def run():
+        latencies = []
+        semaphore = asyncio.Semaphore(concurrency)
+        async with AsyncSberWrapper('user', 'password', urls=urls, coalesce=False) as wrapper:
+            method = getattr(wrapper, workload.method)
+
+            async def one():
+                async with semaphore:
+                    started = time.perf_counter()
+                    await method(*workload.args())
+                    latencies.append(time.perf_counter() - started)
+            await asyncio.gather(*(one() for _ in range(calls)))
+        return latencies
+    return asyncio.run(run())
+
+
+def measure(name, func, *args):
+    cpu, wall = time.process_time(), time.perf_counter()
+    latencies = func(*args)
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    print('{0:<9} {1:>7} {2:>9.1f} {3:>12.3f} {4:>8.2f} {5:>8.2f}'.format(
+        name, len(latencies), len(latencies) / wall, cpu / len(latencies) * 1000,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+
+
+def allocated_per_call(wrapper, workload, calls):
+    method = getattr(wrapper, workload.method)
+    tracemalloc.start()
+    total = 0
+    for _ in range(calls):
+        args = workload.args()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        method(*args)
+        total += tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return total / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8, help='threads and async concurrency')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated bank latency, seconds')
+    parser.add_argument('--method', choices=('register', 'status', 'status_ext'), default='status')
+    parser.add_argument('--replay', action='store_true', help='add record/replay run')
+    args = parser.parse_args()
+
+    process, urls = start_simulator(args.latency)
+    try:
+        transport = PooledTransport(maxsize=args.threads)
+        wrapper = SberWrapper('user', 'password', urls=urls, transport=transport, coalesce=False)
+        order_id, _ = wrapper.register('{0}-0'.format(os.getpid()), 100, 'https://example.com/')
+        workload = Workload(args.method, order_id)
+
+        print('{0:<9} {1:>7} {2:>9} {3:>12} {4:>8} {5:>8}'.format(
+            'mode', 'calls', 'req/s', 'cpu ms/call', 'p50, ms', 'p99, ms'))
+        measure('urlopen', run_serial, SberWrapper('user', 'password', urls=urls, coalesce=False), workload,
+                args.calls // 4)
+        measure('serial', run_serial, wrapper, workload, args.calls)
+        measure('threaded', run_threaded, wrapper, workload, args.calls, args.threads)
+        measure('async', run_async, urls, workload, args.calls, args.threads)
+        if args.replay:
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'traffic.sbr')
+                recording = RecordingTransport(path, transport)
+                run_serial(SberWrapper('user', 'password', urls=urls, transport=recording, coalesce=False), workload,
+                           args.calls // 4)
+                replay = ReplayTransport(path, ignore=('orderNumber',))
+                replay_wrapper = SberWrapper('user', 'password', urls=urls, transport=replay, coalesce=False)
+                measure('replay', run_serial, replay_wrapper, workload, args.calls)
+                measure('replay-t', run_threaded, replay_wrapper, workload, args.calls, args.threads)
+                replay.close()
+        print('allocated per call: {0:.1f} KiB'.format(allocated_per_call(wrapper, workload, 200) / 1024))
+        transport.close()
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
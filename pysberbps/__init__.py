@@ -1,5 +1,51 @@
-import sys
-if sys.version.startswith('2'):
-    from pysberbps import *
-else:
-    from .pysberbps import *
\ No newline at end of file
+#coding=utf8
+# pysberbank package, optional parts are imported on first access #
+from .pysberbps import (SberWrapper, SberError, SberNetworkError, SberCircuitOpenError, SberRequestError,
+                        SberChecksumError, __version__, __author__, __author_email__)
+
+# public name -> module, loaded by __getattr__ when the name is used first time
+_lazy = dict(
+    Transport='transport',
+    UrllibTransport='transport',
+    PooledTransport='transport',
+    Http2Transport='http2',
+    DNSCache='transport',
+    AsyncSberWrapper='aio',
+    AsyncPooledTransport='aio',
+    StatusCache='cache',
+    OrderStore='store',
+    Timeout='resilience',
+    RetryPolicy='resilience',
+    CircuitBreaker='resilience',
+    MetricsHook='metrics',
+    Profiler='profiler',
+    SberClientPool='registry',
+    TokenBucket='ratelimit',
+    RateLimiter='ratelimit',
+    BatchRefund='refunds',
+    RefundJournal='refunds',
+    BatchCapture='capture',
+    CallbackProcessor='callbacks',
+    Notification='callbacks',
+    StatusPoller='poller',
+    RecordingTransport='recording',
+    ReplayTransport='recording',
+)
+
+__all__ = ['SberWrapper', 'SberError', 'SberNetworkError', 'SberCircuitOpenError', 'SberRequestError',
+           'SberChecksumError'] + \
+    sorted(_lazy)
+
+
+def __getattr__(name):
+    module = _lazy.get(name)
+    if module is None:
+        raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
+    import importlib
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
@@ -0,0 +1,546 @@
+#coding=utf8
+# pysberbank asyncio client #
+import asyncio
+import collections
+import functools
+import http.client
+import logging
+import ssl
+import time
+from .batch import BatchResult, Checkpoint, RegisterBatch, RegisterResult
+from .pysberbps import SberWrapper, SberError, SberNetworkError, SberRequestError, _Trace
+from .transport import Response, create_transport, split_timeout, split_url
+logger = logging.getLogger(__name__)
+
+# transport name -> (module, class) for AsyncSberWrapper
+TRANSPORTS = dict(
+    pooled=('aio', 'AsyncPooledTransport'),
+    http2=('http2', 'AsyncHttp2Transport'),
+)
+
+
+class AsyncPooledTransport(object):
+    """
+    Non-blocking HTTP/1.1 keep-alive transport for asyncio. Concurrency per (scheme, host, port)
+    is limited by a semaphore, requests over the limit wait for a free connection.
+    """
+    def __init__(self, limit_per_host: int=100, idle_timeout: float=60.0, timeout: float=None, ssl_context=None):
+        """
+        :param limit_per_host: maximum simultaneous connections (and requests) per host
+        :param idle_timeout: idle connections older than this (seconds) are closed instead of reused
+        :param timeout: resilience.Timeout(connect, read) or seconds for both (None means no timeout)
+        :param ssl_context: ssl.SSLContext for https connections
+        """
+        self.limit_per_host = limit_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self._semaphores = {}
+        # (scheme, host, port) -> deque of (reader, writer, released_at)
+        self._idle = collections.defaultdict(collections.deque)
+
+    async def _connect(self, key):
+        scheme, host, port = key
+        context = None
+        if scheme == 'https':
+            context = self.ssl_context or ssl.create_default_context()
+        return await asyncio.open_connection(host, port, ssl=context)
+
+    async def _checkout(self, key, connect_timeout, trace=None):
+        idle = self._idle[key]
+        now = time.monotonic()
+        while idle:
+            reader, writer, released_at = idle.pop()
+            if now - released_at <= self.idle_timeout and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        started = time.perf_counter()
+        reader, writer = await asyncio.wait_for(self._connect(key), connect_timeout)
+        if trace is not None:
+            # asyncio establishes TLS session together with connection
+            trace('connect', time.perf_counter() - started)
+        return reader, writer, False
+
+    @staticmethod
+    async def _read_response(reader, trace=None):
+        started = time.perf_counter()
+        status_line = await reader.readline()
+        if trace is not None:
+            trace('ttfb', time.perf_counter() - started)
+        if not status_line:
+            raise http.client.RemoteDisconnected('Remote end closed connection without response')
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        headers = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers.append((name.strip(), value.strip()))
+        lowered = {name.lower(): value.lower() for name, value in headers}
+
+        will_close = version == 'HTTP/1.0' or lowered.get('connection') == 'close'
+        if lowered.get('transfer-encoding') == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';', 1)[0], 16)
+                if not size:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        elif 'content-length' in lowered:
+            body = await reader.readexactly(int(lowered['content-length']))
+        else:
+            body = await reader.read()
+            will_close = True
+        return Response(int(status), reason, headers, body), will_close
+
+    @staticmethod
+    async def _write_request(writer, host, method, path, body, headers):
+        lines = ['{0} {1} HTTP/1.1'.format(method, path), 'Host: {0}'.format(host),
+                 'Content-Length: {0}'.format(len(body or b''))]
+        lines.extend('{0}: {1}'.format(name, value) for name, value in (headers or {}).items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b''))
+        await writer.drain()
+
+    async def _send(self, key, method, path, body, headers, connect_timeout, read_timeout, trace):
+        while True:
+            reader, writer, reused = await self._checkout(key, connect_timeout, trace)
+            sent = False
+            try:
+                await asyncio.wait_for(self._write_request(writer, key[1], method, path, body, headers),
+                                       read_timeout)
+                sent = True
+                response, will_close = await asyncio.wait_for(self._read_response(reader, trace), read_timeout)
+            except (ConnectionResetError, BrokenPipeError) as e:
+                writer.close()
+                # resend only if the request wasn't written or no byte of reply came, see PooledTransport.request
+                if reused and (not sent or isinstance(e, http.client.RemoteDisconnected)):
+                    logger.debug('Pooled connection to %s:%s was closed by peer, retrying', key[1], key[2])
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if will_close:
+                writer.close()
+            else:
+                self._idle[key].append((reader, writer, time.monotonic()))
+            return response
+
+    async def request(self, method: str, url: str, body: bytes=None, headers: dict=None, timeout=None,
+                      trace=None):
+        """
+        Send request through a pooled connection
+        :param timeout: resilience.Timeout(connect, read) or seconds, transport timeout if None
+        :param trace: callable(stage, seconds) receiving connect and ttfb timings
+        :return: transport.Response(status, reason, headers, body)
+        """
+        connect_timeout, read_timeout = split_timeout(self.timeout if timeout is None else timeout)
+        key, path = split_url(url)
+
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            semaphore = self._semaphores[key] = asyncio.Semaphore(self.limit_per_host)
+        async with semaphore:
+            return await self._send(key, method, path, body, headers, connect_timeout, read_timeout, trace)
+
+    async def prewarm(self, url: str, connections: int=1, timeout=None):
+        """
+        Open connections (TCP connect and TLS handshake) to the host of url ahead of the first request
+        :param connections: number of connections put to the pool, no more than limit_per_host
+        :param timeout: resilience.Timeout(connect, read) or seconds, transport timeout if None
+        """
+        connect_timeout, _ = split_timeout(self.timeout if timeout is None else timeout)
+        key, _ = split_url(url)
+        opened = await asyncio.gather(*(asyncio.wait_for(self._connect(key), connect_timeout)
+                                        for _ in range(min(connections, self.limit_per_host))),
+                                      return_exceptions=True)
+        now = time.monotonic()
+        errors = [result for result in opened if isinstance(result, BaseException)]
+        self._idle[key].extend((result[0], result[1], now) for result in opened
+                               if not isinstance(result, BaseException))
+        if errors:
+            raise errors[0]
+
+    async def close(self):
+        """Close all idle connections"""
+        idle, self._idle = self._idle, collections.defaultdict(collections.deque)
+        for connections in idle.values():
+            for _, writer, _ in connections:
+                writer.close()
+
+
+class AsyncSingleFlight(object):
+    """
+    Deduplicates concurrent coroutine calls with the same key: while the first call is in flight,
+    other coroutines await it and get the same result or exception
+    """
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func):
+        """
+        Await func() unless a call with the same key is already in flight. func() runs in its own task,
+        so cancellation of one caller doesn't cancel the call for the others
+        :param key: hashable call identifier
+        :param func: coroutine function without arguments
+        :return: func() result
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(func())
+            task.add_done_callback(functools.partial(self._done, key))
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # mark exception as retrieved, all callers may be cancelled
+            task.exception()
+
+
+async def imap_unordered(func, items, concurrency: int=8):
+    """
+    Await func(item) for every item and yield BatchResult(item, result, error) in completion order,
+    asyncio version of batch.imap_unordered. Items are consumed lazily, no more than concurrency calls
+    are in flight at once. SberError raised by func is returned in BatchResult.error and doesn't stop the batch
+    """
+    async def call(item):
+        try:
+            return BatchResult(item, await func(item), None)
+        except SberError as e:
+            return BatchResult(item, None, e)
+
+    pending = set()
+    try:
+        for item in items:
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+            # tasks run with a copy of caller's context, e.g. ratelimit.priority()
+            pending.add(asyncio.ensure_future(call(item)))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        # consumer stopped iteration, don't send queued requests
+        for task in pending:
+            task.cancel()
+
+
+async def map_orders(func, order_ids, concurrency: int=8, checkpoint=None):
+    """
+    Await func(order_id) for many orders, yield BatchResult in completion order, see batch.map_orders
+    """
+    own_checkpoint = isinstance(checkpoint, str)
+    if own_checkpoint:
+        checkpoint = Checkpoint(checkpoint)
+    try:
+        if checkpoint is not None:
+            order_ids = (order_id for order_id in order_ids if order_id not in checkpoint)
+        async for result in imap_unordered(func, order_ids, concurrency):
+            if checkpoint is not None and (result.error is None or isinstance(result.error, SberRequestError)):
+                checkpoint.mark(result.key)
+            yield result
+    finally:
+        if own_checkpoint:
+            checkpoint.close()
+
+
+class AsyncRegisterBatch(RegisterBatch):
+    """
+    Registration pipeline returned by AsyncSberWrapper.register_many, iterated with async for
+    """
+    async def _register(self, item):
+        order, amount, url, request, error = item
+        if error is None:
+            try:
+                order_id, form_url = await self.wrapper._call('register', url, request,
+                                                              self.wrapper._register_response)
+                self.wrapper._registered(order_id, order, amount)
+                return RegisterResult(order, order_id, form_url, None)
+            except SberError as e:
+                error = e
+        return RegisterResult(order, None, None, error)
+
+    def __iter__(self):
+        raise TypeError('AsyncRegisterBatch is iterated with async for')
+
+    async def __aiter__(self):
+        counters = dict(registered=0, failed=0, invalid=0, uncertain=0)
+        started = time.perf_counter()
+        try:
+            async for batch_result in imap_unordered(self._register, self._prepared(), self.concurrency):
+                self._count(counters, batch_result.result)
+                yield batch_result.result
+        finally:
+            self._set_stats(counters, started)
+
+
+class AsyncSberWrapper(SberWrapper):
+    """
+    Sberbank acquiring API wrapper for asyncio. Has the same methods as SberWrapper, but they are coroutines
+
+        async with AsyncSberWrapper(username, password) as wrapper:
+            order_id, form_url = await wrapper.register(order, amount, success_url)
+    """
+    def __init__(self, username: str, password: str, post: bool=True, urls: dict=None, test_env: bool=True,
+                 transport=None, cache=None, coalesce: bool=True, timeout=None, retry=None,
+                 breaker=None, metrics=None, decoder=None, typed: bool=False, limiter=None, store=None):
+        """
+        :param username: Store username
+        :param password: Store password
+        :param post: use POST request not GET
+        :param urls: dict of urls where requests will be sent
+        :param test_env: use test environment urls if urls is None
+        :param transport: asyncio transport (e.g. AsyncPooledTransport) or its name: 'pooled' (default) or 'http2'
+        :param cache: cache.StatusCache for status/status_ext replies, no caching if None
+        :param coalesce: share one in-flight status/status_ext request between concurrent coroutines
+        :param timeout: resilience.Timeout(connect, read) or seconds for both, no timeout if None
+        :param retry: resilience.RetryPolicy for idempotent calls (status, status_ext), no retries if None
+        :param breaker: resilience.CircuitBreaker, may be shared between wrappers
+        :param metrics: metrics.MetricsHook to report timings and errors, disabled if None
+        :param decoder: callable parsing reply body bytes, the fastest of orjson/ujson/json if None
+        :param typed: status/status_ext return responses.OrderStatusInfo instead of dict
+        :param limiter: ratelimit.RateLimiter or other object with coroutine acquire_async(method),
+            waited before every attempt
+        :param store: store.OrderStore saving orders, its calls are local and don't wait for network
+        """
+        super(AsyncSberWrapper, self).__init__(username, password, post=post, urls=urls, test_env=test_env,
+                                               transport=transport, cache=cache,
+                                               coalesce=False, timeout=timeout, retry=retry, breaker=breaker,
+                                               metrics=metrics, decoder=decoder, typed=typed,
+                                               limiter=limiter, store=store)
+        self._flight = AsyncSingleFlight() if coalesce else None
+
+    @staticmethod
+    def _create_transport(transport):
+        if transport is None or isinstance(transport, str):
+            return create_transport(transport or 'pooled', TRANSPORTS)
+        return transport
+
+    async def _request(self, url, params, trace=None):
+        logger.debug('Request  is %r', params)
+        measure = getattr(trace, 'measure', None)
+        try:
+            prepared = self._prepare(url, params) if measure is None else measure('encode', self._prepare, url, params)
+            response = await self.transport.request(*prepared, timeout=self.timeout, trace=trace)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+            logger.warning('Error {0!r} happened during processing request'.format(e), exc_info=True)
+            raise SberNetworkError
+        return self._process(response, trace)
+
+    async def _send(self, method, url, request, idempotent: bool=False, trace=None):
+        delays = self.retry.delays() if idempotent and self.retry is not None else iter(())
+        while True:
+            if self.limiter is not None:
+                # every attempt is counted by the bank, retries included
+                await self.limiter.acquire_async(method)
+            if self.breaker is not None:
+                self.breaker.before_call()
+            try:
+                response = await self._request(url, request, trace)
+            except SberNetworkError:
+                if self.breaker is not None:
+                    self.breaker.record(False)
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                logger.info('Network error, retry in %.3f seconds', delay)
+                await asyncio.sleep(delay)
+                continue
+            except SberError:
+                if self.breaker is not None:
+                    self.breaker.record(True)
+                raise
+            except Exception as e:
+                if self.breaker is not None:
+                    self.breaker.record(False)
+                raise SberError(e)
+            except BaseException:
+                # cancelled or interrupted call, e.g. by asyncio.wait_for timeout
+                if self.breaker is not None:
+                    self.breaker.cancel()
+                raise
+            if self.breaker is not None:
+                self.breaker.record(True)
+            return response
+
+    async def _call(self, method, url, request, handler, idempotent: bool=False):
+        metrics = self.metrics
+        if metrics is None:
+            return handler(await self._send(method, url, request, idempotent))
+
+        context = metrics.start(method)
+        started = time.perf_counter()
+        error = None
+        try:
+            if metrics.detailed:
+                trace = _Trace(metrics, method, context)
+                return trace.measure('handle', handler, await self._send(method, url, request, idempotent, trace))
+            trace = functools.partial(metrics.observe, method, context=context)
+            return handler(await self._send(method, url, request, idempotent, trace))
+        except SberError as e:
+            error = e
+            if isinstance(e, SberRequestError):
+                metrics.error(method, e.code, context)
+            raise
+        finally:
+            metrics.finish(method, time.perf_counter() - started, error, context)
+
+    async def _cached_status(self, method, order_id, language, fetch, fresh=False):
+        if fresh:
+            return await self._fetch_and_store(method, order_id, language, fetch)
+        if self.cache is not None:
+            cached = self.cache.get(order_id, method, language)
+            if cached is not None:
+                return cached
+        if self.store is not None:
+            stored = self.store.get(order_id, method, language)
+            if stored is not None:
+                return stored
+
+        if self._flight is None:
+            return await self._fetch_and_store(method, order_id, language, fetch)
+        return await self._flight.do((method, order_id, language),
+                                     lambda: self._fetch_and_store(method, order_id, language, fetch))
+
+    async def _fetch_and_store(self, method, order_id, language, fetch):
+        # reply requested before refund, deposit or reverse of the order isn't saved after its _invalidate
+        cache_requested = self.cache.clock() if self.cache is not None else None
+        store_requested = time.time()
+        response = await fetch()
+        if self.cache is not None:
+            self.cache.set(order_id, method, language, response, cache_requested)
+        if self.store is not None:
+            self.store.record_status(order_id, method, language, response, store_requested)
+        return response
+
+    async def register(self, *args, **kwargs):
+        """
+        Register request in acquiring system, see SberWrapper.register
+        :return: (order_id, form_url)
+        """
+        url, request = self._build('register', self._register_request, *args, **kwargs)
+        order_id, form_url = await self._call('register', url, request, self._register_response)
+        self._registered(order_id, request['orderNumber'], request['amount'])
+        return order_id, form_url
+
+    async def status(self, order_id: str, language: str='RU', fresh: bool=False):
+        """
+        Get order status
+        :param order_id: order UID
+        :param language: Acquiring page language
+        :param fresh: request the bank even if the reply is cached or stored
+        :return: <dict> order data
+        """
+        url, request = self._build('status', self._status_request, order_id, language)
+
+        async def fetch():
+            return await self._call('status', url, request, self._status_response, idempotent=True)
+        response = await self._cached_status('status', order_id, language, fetch, fresh)
+        return response if self._status_type is None else self._status_type(response)
+
+    async def status_ext(self, order_id: str, language: str='RU', fresh: bool=False):
+        """
+        Get order extended status
+        :param order_id: order UID
+        :param language: Acquiring page language
+        :param fresh: request the bank even if the reply is cached or stored
+        :return: <dict> order data
+        """
+        url, request = self._build('status_ext', self._status_ext_request, order_id, language)
+
+        async def fetch():
+            return await self._call('status_ext', url, request, self._status_ext_response, idempotent=True)
+        response = await self._cached_status('status_ext', order_id, language, fetch, fresh)
+        return response if self._status_ext_type is None else self._status_ext_type(response)
+
+    def status_many(self, order_ids, concurrency: int=8, language: str='RU', checkpoint=None):
+        """
+        Get statuses of many orders concurrently, see SberWrapper.status_many
+        :return: async generator of batch.BatchResult(order_id, <dict> order data, SberError) in completion order
+        """
+        return map_orders(lambda order_id: self.status(order_id, language), order_ids, concurrency, checkpoint)
+
+    def status_ext_many(self, order_ids, concurrency: int=8, language: str='RU', checkpoint=None):
+        """
+        Get extended statuses of many orders concurrently, see SberWrapper.status_many
+        :return: async generator of batch.BatchResult(order_id, <dict> order data, SberError) in completion order
+        """
+        return map_orders(lambda order_id: self.status_ext(order_id, language), order_ids, concurrency, checkpoint)
+
+    def register_many(self, specs, concurrency: int=8):
+        """
+        Register many orders concurrently, see SberWrapper.register_many
+        :return: AsyncRegisterBatch, async iterable of batch.RegisterResult in completion order
+        """
+        return AsyncRegisterBatch(self, specs, concurrency)
+
+    async def refund(self, order_id: str, amount: int, language: str='RU'):
+        """
+        Refund order and send <amount> back to user credit card
+        :param order_id: Sberbank order UID
+        :param amount: Order amount in minimal unit of currency(penny / kopeck)
+        :param language: Acquiring page language
+        :return: Sberbank status text
+        """
+        url, request = self._build('refund', self._refund_request, order_id, amount, language)
+        self._invalidate(order_id)
+        try:
+            message = await self._call('refund', url, request, self._refund_response)
+            if self.store is not None:
+                self.store.record_refund(order_id, amount)
+            return message
+        finally:
+            self._invalidate(order_id)
+
+    async def deposit(self, order_id: str, amount: int=0, language: str='RU'):
+        """
+        Complete payment of order held by 2 steps payment, see SberWrapper.deposit
+        """
+        url, request = self._build('deposit', self._deposit_request, order_id, amount, language)
+        self._invalidate(order_id)
+        try:
+            return await self._call('deposit', url, request, self._deposit_response)
+        finally:
+            self._invalidate(order_id)
+
+    async def reverse(self, order_id: str, language: str='RU'):
+        """
+        Cancel payment of held order, see SberWrapper.reverse
+        """
+        url, request = self._build('reverse', self._reverse_request, order_id, language)
+        self._invalidate(order_id)
+        try:
+            return await self._call('reverse', url, request, self._reverse_response)
+        finally:
+            self._invalidate(order_id)
+
+    async def prewarm(self, connections: int=1):
+        """
+        Open connections of the transport to the bank ahead of the first request, see SberWrapper.prewarm
+        :return: self
+        """
+        try:
+            for url in self._endpoints():
+                await self.transport.prewarm(url, connections, self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.warning('Error {0!r} happened during prewarm'.format(e), exc_info=True)
+            raise SberNetworkError
+        return self
+
+    async def close(self):
+        await self.transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
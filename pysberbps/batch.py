@@ -0,0 +1,187 @@
+#coding=utf8
+# pysberbank batch helpers #
+import collections
+import concurrent.futures
+import contextvars
+import os
+import threading
+import time
+from .pysberbps import SberError, SberRequestError
+
+BatchResult = collections.namedtuple('BatchResult', 'key result error')
+RegisterResult = collections.namedtuple('RegisterResult', 'order order_id form_url error')
+RegisterStats = collections.namedtuple('RegisterStats', 'registered failed invalid uncertain elapsed rate')
+
+
+def imap_unordered(func, items, concurrency: int=8):
+    """
+    Call func(item) for every item in a thread pool and yield BatchResult(item, result, error) in completion order.
+    Items are consumed lazily, no more than 2 * concurrency calls are queued at once.
+    SberError raised by func is returned in BatchResult.error and doesn't stop the batch
+    """
+    def call(item):
+        try:
+            return BatchResult(item, func(item), None)
+        except SberError as e:
+            return BatchResult(item, None, e)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = set()
+        try:
+            for item in items:
+                if len(pending) >= 2 * concurrency:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                # worker threads run with caller's context, e.g. ratelimit.priority()
+                pending.add(executor.submit(contextvars.copy_context().run, call, item))
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            # consumer stopped iteration, don't send queued requests
+            for future in pending:
+                future.cancel()
+
+
+class Checkpoint(object):
+    """
+    Append-only file with keys of finished items. Batch started with the same checkpoint
+    skips items finished by the previous run
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.done.update(line.rstrip('\n') for line in f if line.strip())
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def mark(self, key: str):
+        with self._lock:
+            self.done.add(key)
+            self._file.write(key + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def map_orders(func, order_ids, concurrency: int=8, checkpoint=None):
+    """
+    Run func(order_id) for many orders, yield BatchResult in completion order
+    :param func: one of SberWrapper methods, e.g. status_ext
+    :param order_ids: iterable of order UIDs
+    :param concurrency: number of simultaneous requests
+    :param checkpoint: Checkpoint or path to checkpoint file. Orders with result or SberRequestError
+                       are marked done there, orders failed by network errors are retried on the next run
+    """
+    own_checkpoint = isinstance(checkpoint, str)
+    if own_checkpoint:
+        checkpoint = Checkpoint(checkpoint)
+    try:
+        if checkpoint is not None:
+            order_ids = (order_id for order_id in order_ids if order_id not in checkpoint)
+        for result in imap_unordered(func, order_ids, concurrency):
+            if checkpoint is not None and (result.error is None or isinstance(result.error, SberRequestError)):
+                checkpoint.mark(result.key)
+            yield result
+    finally:
+        if own_checkpoint:
+            checkpoint.close()
+
+
+def validate_register(spec: dict):
+    """
+    Check order spec before sending it
+    :param spec: keyword arguments of SberWrapper.register
+    :raise ValueError: if order, amount or success_url is wrong
+    """
+    if not spec.get('order'):
+        raise ValueError('Order number is empty')
+    amount = spec.get('amount')
+    if not isinstance(amount, int) or isinstance(amount, bool) or amount <= 0:
+        raise ValueError('Amount of order {0} must be positive integer, got {1!r}'.format(spec['order'], amount))
+    if not spec.get('success_url'):
+        raise ValueError('success_url of order {0} is empty'.format(spec['order']))
+
+
+class RegisterBatch(object):
+    """
+    Registration pipeline returned by SberWrapper.register_many. Iteration yields RegisterResult
+    in completion order, stats are set when iteration is finished
+    """
+    fields = ('order', 'amount', 'success_url')
+
+    def __init__(self, wrapper, specs, concurrency: int=8):
+        """
+        :param wrapper: SberWrapper
+        :param specs: iterable of dicts with keyword arguments of register or (order, amount, success_url) tuples
+        :param concurrency: number of simultaneous requests
+        """
+        self.wrapper = wrapper
+        self.specs = specs
+        self.concurrency = concurrency
+        self.stats = RegisterStats(0, 0, 0, 0, 0.0, 0.0)
+
+    def _prepared(self):
+        """
+        Validate specs and build requests in the caller thread while previous requests are in flight
+        :return: generator of (order, amount, url, request, error)
+        """
+        for spec in self.specs:
+            order = amount = None
+            try:
+                if not isinstance(spec, dict):
+                    # TypeError if the row isn't a tuple, e.g. None
+                    spec = dict(zip(self.fields, spec))
+                order, amount = spec.get('order'), spec.get('amount')
+                validate_register(spec)
+                url, request = self.wrapper._build('register', self.wrapper._register_request, **spec)
+            except (TypeError, ValueError) as e:
+                yield order, amount, None, None, e
+                continue
+            yield order, amount, url, request, None
+
+    def _register(self, item):
+        order, amount, url, request, error = item
+        if error is None:
+            try:
+                order_id, form_url = self.wrapper._call('register', url, request, self.wrapper._register_response)
+                self.wrapper._registered(order_id, order, amount)
+                return RegisterResult(order, order_id, form_url, None)
+            except SberError as e:
+                error = e
+        return RegisterResult(order, None, None, error)
+
+    @staticmethod
+    def _count(counters, result):
+        if result.error is None:
+            counters['registered'] += 1
+        elif isinstance(result.error, SberRequestError):
+            counters['failed'] += 1
+        elif isinstance(result.error, SberError):
+            # reply is lost, repeated register of the same order number is rejected by the bank
+            counters['uncertain'] += 1
+        else:
+            counters['invalid'] += 1
+
+    def _set_stats(self, counters, started):
+        elapsed = time.perf_counter() - started
+        sent = counters['registered'] + counters['failed'] + counters['uncertain']
+        self.stats = RegisterStats(elapsed=elapsed, rate=sent / elapsed if elapsed else 0.0, **counters)
+
+    def __iter__(self):
+        counters = dict(registered=0, failed=0, invalid=0, uncertain=0)
+        started = time.perf_counter()
+        try:
+            for batch_result in imap_unordered(self._register, self._prepared(), self.concurrency):
+                self._count(counters, batch_result.result)
+                yield batch_result.result
+        finally:
+            self._set_stats(counters, started)
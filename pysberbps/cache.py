@@ -0,0 +1,124 @@
+#coding=utf8
+# pysberbank order status cache #
+import collections
+import threading
+import time
+from .pysberbps import SberWrapper
+
+
+class StatusCache(object):
+    """
+    LRU cache of status/status_ext replies. Orders in a terminal state are kept until evicted,
+    the others expire after ttl seconds. Instance is thread-safe.
+    Cached replies are shared between callers and must not be modified.
+    """
+    terminal = frozenset((SberWrapper.OrderStatus.DEPOSITED, SberWrapper.OrderStatus.REVERSED,
+                          SberWrapper.OrderStatus.REFUNDED, SberWrapper.OrderStatus.DECLINED))
+
+    def __init__(self, maxsize: int=10000, ttl: float=2.0, clock=time.monotonic):
+        """
+        :param maxsize: maximum number of orders in the cache
+        :param ttl: lifetime in seconds of non-terminal order status
+        :param clock: time source, monotonic by default
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        # order_id -> {(method, language): (expires_at, response)}
+        self._orders = collections.OrderedDict()
+        # order_id -> clock() of the last invalidate or update_status, maxsize most recent
+        self._changed = collections.OrderedDict()
+
+    @staticmethod
+    def order_status(response: dict):
+        """
+        :return: OrderStatus from status or status_ext reply, None if it isn't known
+        """
+        value = response.get('orderStatus', response.get('OrderStatus'))
+        try:
+            return SberWrapper.OrderStatus(int(value))
+        except (TypeError, ValueError):
+            return None
+
+    def get(self, order_id: str, method: str, language: str):
+        """
+        :return: cached reply or None
+        """
+        with self._lock:
+            entry = self._orders.get(order_id, {}).get((method, language))
+            if entry is not None and (entry[0] is None or entry[0] > self.clock()):
+                self._orders.move_to_end(order_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def _mark_changed(self, order_id):
+        # under the lock
+        self._changed[order_id] = self.clock()
+        self._changed.move_to_end(order_id)
+        while len(self._changed) > self.maxsize:
+            self._changed.popitem(last=False)
+
+    def set(self, order_id: str, method: str, language: str, response: dict, requested: float=None):
+        """
+        :param requested: clock() before the request of the reply. Reply isn't cached if the order
+                          was changed after it, e.g. by refund or notification
+        """
+        expires_at = None
+        if self.order_status(response) not in self.terminal:
+            expires_at = self.clock() + self.ttl
+        with self._lock:
+            if requested is not None and self._changed.get(order_id, requested) > requested:
+                return response
+            entries = self._orders.get(order_id)
+            if entries is None:
+                entries = self._orders[order_id] = {}
+                while len(self._orders) > self.maxsize:
+                    self._orders.popitem(last=False)
+            else:
+                self._orders.move_to_end(order_id)
+            entries[(method, language)] = (expires_at, response)
+        return response
+
+    def update_status(self, order_id: str, status: SberWrapper.OrderStatus):
+        """
+        Set status of the order reported by a trusted source, e.g. verified notification. Cached replies
+        of the order, expired ones too, are replaced by copies with the new status, other fields are kept.
+        They expire after ttl in any status, so full reply of finished order is requested from the bank later
+        :return: number of updated replies, 0 if the order isn't cached
+        """
+        expires_at = self.clock() + self.ttl
+        with self._lock:
+            self._mark_changed(order_id)
+            entries = self._orders.get(order_id)
+            if not entries:
+                return 0
+            for key, (_, response) in list(entries.items()):
+                field = 'OrderStatus' if 'OrderStatus' in response else 'orderStatus'
+                entries[key] = (expires_at, dict(response, **{field: status.value}))
+            self._orders.move_to_end(order_id)
+            return len(entries)
+
+    def invalidate(self, order_id: str):
+        with self._lock:
+            self._mark_changed(order_id)
+            self._orders.pop(order_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._orders.clear()
+            self._changed.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._orders)
+
+    def stats(self):
+        """
+        :return: dict(hits, misses, size)
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, size=len(self._orders))
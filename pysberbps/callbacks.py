@@ -0,0 +1,270 @@
+#coding=utf8
+# pysberbank payment notifications #
+"""
+Processing of notifications sent by the bank to the callback URL of the store
+
+    processor = CallbackProcessor(key=b'secret', cache=wrapper.cache, store=wrapper.store)
+
+    @processor.handler('deposited')
+    def paid(notification):
+        mark_paid(notification.order_number, notification.amount)
+
+    application = processor.wsgi        # or processor.asgi, or processor.process(params)
+
+Notifications are checked with HMAC-SHA256 checksum, so they are trusted without getStatus request:
+status of the order is set in the status cache and the order store. Processor without key doesn't verify
+notifications and can't update them.
+Handlers are called by worker threads, notifications of the same order are handled by one worker in order.
+"""
+import collections
+import hashlib
+import hmac
+import logging
+import queue
+import threading
+import urllib.parse
+from .pysberbps import SberWrapper, SberChecksumError
+from .responses import OrderStatusInfo
+
+logger = logging.getLogger(__name__)
+
+# notification operation -> order status after successful operation
+OPERATIONS = dict(
+    approved=SberWrapper.OrderStatus.APPROVED,
+    deposited=SberWrapper.OrderStatus.DEPOSITED,
+    reversed=SberWrapper.OrderStatus.REVERSED,
+    refunded=SberWrapper.OrderStatus.REFUNDED,
+    declinedByTimeout=SberWrapper.OrderStatus.DECLINED,
+)
+
+
+def checksum(params: dict, key: bytes):
+    """
+    HMAC-SHA256 of notification params sorted by name as 'name1;value1;name2;value2;', upper case hex
+    :param params: notification params, checksum param is ignored
+    """
+    message = ''.join('{0};{1};'.format(name, params[name]) for name in sorted(params) if name != 'checksum')
+    return hmac.new(key, message.encode('utf-8'), hashlib.sha256).hexdigest().upper()
+
+
+def verify(params: dict, key: bytes):
+    """
+    :raise SberChecksumError: if checksum is missing or wrong
+    """
+    expected = params.get('checksum')
+    if not expected or not hmac.compare_digest(checksum(params, key), expected.upper()):
+        raise SberChecksumError('Wrong checksum of notification for order {0}'.format(params.get('mdOrder')))
+
+
+class Notification(OrderStatusInfo):
+    """
+    Payment notification, typed status of the order after the operation.
+    status is None if the operation failed
+    """
+    __slots__ = ('order_id', 'operation', 'success', 'params')
+
+    def __init__(self, order_id: str, operation: str, success: bool, order_number: str=None,
+                 status: SberWrapper.OrderStatus=None, amount: int=None, params: dict=None):
+        super(Notification, self).__init__(order_number, status, amount)
+        self.order_id = order_id
+        self.operation = operation
+        self.success = success
+        self.params = params
+
+    @classmethod
+    def from_params(cls, params: dict):
+        """
+        Build from params of notification request
+        """
+        if not params.get('mdOrder') or not params.get('operation'):
+            raise ValueError('Notification has no mdOrder or operation')
+        success = params.get('status') == '1'
+        amount = params.get('amount')
+        return cls(params['mdOrder'], params['operation'], success, params.get('orderNumber'),
+                   OPERATIONS.get(params['operation']) if success else None,
+                   int(amount) if amount and amount.isdigit() else None, params)
+
+    def __repr__(self):
+        return 'Notification(order_id={0.order_id!r}, operation={0.operation!r}, success={0.success})'.format(self)
+
+
+class CallbackProcessor(object):
+    """
+    Verifies notifications, updates status of their orders and passes them to handlers in worker threads.
+    Instance is thread-safe
+    """
+    def __init__(self, key: bytes=None, cache=None, workers: int=4, queue_size: int=10000, timeout: float=1.0,
+                 store=None):
+        """
+        :param key: HMAC key of the store, checksum isn't verified if None. Required with cache or store
+        :param cache: cache.StatusCache of wrappers, cached replies of notified order get its new status
+        :param store: store.OrderStore of wrappers, notified order gets its new status and is refreshed later
+        :param workers: number of threads calling handlers
+        :param queue_size: maximum notifications waiting for handlers, process() blocks when the queue is full
+        :param timeout: seconds process() waits for free place in queue, 503 is replied to the bank after it
+        :raise TypeError: if cache or store is given without key
+        """
+        if key is None and (cache is not None or store is not None):
+            # forged notification would set status of unpaid order
+            raise TypeError('Notifications update cache and store only if they are verified, key is required')
+        self.key = key.encode('utf-8') if isinstance(key, str) else key
+        self.cache = cache
+        self.store = store
+        self.timeout = timeout
+        self._handlers = collections.defaultdict(list)
+        self._queues = [queue.Queue(max(1, queue_size // workers)) for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._counters_lock = threading.Lock()
+        self.received = self.rejected = self.handled = self.failed = 0
+
+    def _count(self, name):
+        with self._counters_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def add_handler(self, func, operation: str=None):
+        """
+        :param func: callable(Notification)
+        :param operation: call func for this operation only (deposited, refunded, ...), for all if None
+        """
+        self._handlers[operation].append(func)
+
+    def handler(self, operation: str=None):
+        """Decorator version of add_handler"""
+        def decorator(func):
+            self.add_handler(func, operation)
+            return func
+        return decorator
+
+    def start(self):
+        with self._lock:
+            if not self._threads:
+                for worker_queue in self._queues:
+                    thread = threading.Thread(target=self._work, args=(worker_queue,), daemon=True,
+                                              name='sberbank-callbacks')
+                    thread.start()
+                    self._threads.append(thread)
+        return self
+
+    def close(self):
+        """Handle queued notifications and stop workers"""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for worker_queue in self._queues:
+            if threads:
+                worker_queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _work(self, worker_queue):
+        while True:
+            notification = worker_queue.get()
+            if notification is None:
+                return
+            for func in self._handlers.get(notification.operation, []) + self._handlers.get(None, []):
+                try:
+                    func(notification)
+                    self._count('handled')
+                except Exception:
+                    self._count('failed')
+                    logger.exception('Handler %r failed on %r', func, notification)
+
+    def _update(self, notification):
+        """
+        Set notified status of the order in the cache and the store
+        """
+        if notification.status is None or notification.operation == 'refunded':
+            # status after failed operation isn't notified, partial refund leaves the order DEPOSITED
+            if self.cache is not None:
+                self.cache.invalidate(notification.order_id)
+            if self.store is not None:
+                self.store.invalidate(notification.order_id)
+            return
+        if self.cache is not None:
+            self.cache.update_status(notification.order_id, notification.status)
+        if self.store is not None:
+            self.store.update_status(notification.order_id, notification.status)
+
+    def process(self, params: dict, block: bool=True):
+        """
+        Verify notification and queue it for handlers
+        :param params: query or form params of notification request
+        :param block: wait for free place in the queue up to timeout
+        :raise SberChecksumError: if checksum is wrong
+        :raise ValueError: if notification has no required params
+        :raise queue.Full: if handlers can't keep up
+        :return: Notification
+        """
+        self._count('received')
+        try:
+            if self.key is not None:
+                verify(params, self.key)
+            notification = Notification.from_params(params)
+        except (SberChecksumError, ValueError):
+            self._count('rejected')
+            raise
+        self._update(notification)
+        if not self._threads:
+            self.start()
+        worker_queue = self._queues[hash(notification.order_id) % len(self._queues)]
+        worker_queue.put(notification, block, self.timeout)
+        return notification
+
+    def queue_depth(self):
+        """
+        :return: number of notifications waiting for handlers
+        """
+        return sum(worker_queue.qsize() for worker_queue in self._queues)
+
+    def stats(self):
+        """
+        :return: dict(received, rejected, handled, failed, queued), handled and failed count handler calls
+        """
+        return dict(received=self.received, rejected=self.rejected, handled=self.handled, failed=self.failed,
+                    queued=self.queue_depth())
+
+    def _respond(self, params, block):
+        """
+        :return: (HTTP status, body)
+        """
+        try:
+            self.process(params, block)
+        except SberChecksumError:
+            logger.warning('Notification with wrong checksum: %r', params)
+            return '403 Forbidden', b'Wrong checksum'
+        except ValueError:
+            return '400 Bad Request', b'Bad notification'
+        except queue.Full:
+            # the bank repeats notification later
+            return '503 Service Unavailable', b'Busy'
+        return '200 OK', b'OK'
+
+    def wsgi(self, environ, start_response):
+        """WSGI application receiving notifications by GET or POST"""
+        query = environ.get('QUERY_STRING', '')
+        if environ.get('REQUEST_METHOD') == 'POST':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            query = environ['wsgi.input'].read(length).decode('utf-8')
+        status, body = self._respond(dict(urllib.parse.parse_qsl(query)), True)
+        start_response(status, [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+        return [body]
+
+    async def asgi(self, scope, receive, send):
+        """ASGI application receiving notifications by GET or POST, doesn't block the event loop"""
+        import asyncio
+        if scope['type'] != 'http':
+            return
+        query = scope.get('query_string', b'')
+        if scope.get('method') == 'POST':
+            query = b''
+            while True:
+                message = await receive()
+                query += message.get('body', b'')
+                if not message.get('more_body'):
+                    break
+        # the order store is updated by SQLite queries, they run in the default executor
+        status, body = await asyncio.get_running_loop().run_in_executor(
+            None, self._respond, dict(urllib.parse.parse_qsl(query.decode('utf-8'))), False)
+        await send(dict(type='http.response.start', status=int(status.split()[0]),
+                        headers=[(b'content-type', b'text/plain'), (b'content-length', str(len(body)).encode())]))
+        await send(dict(type='http.response.body', body=body))
@@ -0,0 +1,97 @@
+#coding=utf8
+# pysberbank batch capture of held orders #
+"""
+Mass completion (deposit) and cancellation (reverse) of orders held by 2 steps payments
+
+    wrapper = SberWrapper(username, password, transport=PooledTransport(maxsize=16))
+    capture = BatchCapture(wrapper, concurrency=16)
+    for result in capture.run(read_csv(f)):            # (order_id, amount) rows, see refunds.read_csv
+        if result.error is not None:
+            print(result.order_id, result.error)
+    print(capture.stats)
+
+Rows are (order_id, amount) to deposit amount (0 for the whole held amount) or (order_id, amount, REVERSE)
+to cancel the hold, rows with other operations are returned with ValueError and aren't sent.
+Requests are sent by `concurrency` threads through the shared transport of the wrapper. PooledTransport
+opens a connection for every thread anyway, its maxsize should be at least `concurrency` to keep them
+idle between requests instead of reconnecting. The bank rate is limited by concurrency, not by maxsize.
+"""
+import collections
+import time
+from .batch import imap_unordered
+from .profiler import _percentile
+from .pysberbps import SberWrapper, SberError, SberRequestError
+
+DEPOSIT, REVERSE = 'deposit', 'reverse'
+
+CaptureResult = collections.namedtuple('CaptureResult', 'order_id operation amount message error seconds')
+CaptureStats = collections.namedtuple('CaptureStats', 'deposited reversed failed uncertain invalid elapsed '
+                                                      'mean p50 p99 rate')
+
+
+class BatchCapture(object):
+    """
+    Capture pipeline: rows are read lazily and processed by `concurrency` threads in completion order.
+    Network errors aren't retried, deposit and reverse aren't idempotent: such orders are counted
+    as uncertain and should be checked with status_ext(order_id, fresh=True) before the next attempt,
+    replies cached or stored by the wrapper may be older than the lost request
+    """
+    def __init__(self, wrapper: SberWrapper, concurrency: int=16, language: str='RU'):
+        """
+        :param wrapper: SberWrapper used for deposit and reverse calls
+        :param concurrency: number of simultaneous requests
+        """
+        self.wrapper = wrapper
+        self.concurrency = concurrency
+        self.language = language
+        self.stats = CaptureStats(0, 0, 0, 0, 0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+    def _capture(self, row):
+        order_id, amount = row[0], row[1]
+        operation = row[2] if len(row) > 2 else DEPOSIT
+        if operation not in (DEPOSIT, REVERSE):
+            return CaptureResult(order_id, operation, amount, None,
+                                 ValueError('Unknown operation {0!r} of order {1}'.format(operation, order_id)), 0.0)
+        started = time.perf_counter()
+        message = error = None
+        try:
+            if operation == DEPOSIT:
+                message = self.wrapper.deposit(order_id, amount, self.language)
+            else:
+                message = self.wrapper.reverse(order_id, self.language)
+        except SberError as e:
+            error = e
+        return CaptureResult(order_id, operation, amount, message, error, time.perf_counter() - started)
+
+    def run(self, rows):
+        """
+        Deposit or reverse orders, yield CaptureResult in completion order. stats are updated when
+        the batch is finished
+        :param rows: iterable of (order_id, amount) or (order_id, amount, operation)
+        """
+        counters = dict(deposited=0, reversed=0, failed=0, uncertain=0, invalid=0)
+        latencies = []
+        started = time.perf_counter()
+        try:
+            for batch_result in imap_unordered(self._capture, rows, self.concurrency):
+                result = batch_result.result
+                if result.error is None:
+                    counters['deposited' if result.operation == DEPOSIT else 'reversed'] += 1
+                elif isinstance(result.error, SberRequestError):
+                    counters['failed'] += 1
+                elif isinstance(result.error, SberError):
+                    counters['uncertain'] += 1
+                else:
+                    # invalid row isn't sent
+                    counters['invalid'] += 1
+                    yield result
+                    continue
+                latencies.append(result.seconds)
+                yield result
+        finally:
+            elapsed = time.perf_counter() - started
+            latencies.sort()
+            self.stats = CaptureStats(elapsed=elapsed,
+                                      mean=sum(latencies) / len(latencies) if latencies else 0.0,
+                                      p50=_percentile(latencies, 0.5), p99=_percentile(latencies, 0.99),
+                                      rate=len(latencies) / elapsed if elapsed else 0.0, **counters)
@@ -0,0 +1,128 @@
+#coding=utf8
+# pysberbank HTTP/2 transports #
+"""
+HTTP/2 transports on httpx, install with `pip install pysberbps[http2]`
+
+    wrapper = SberWrapper(username, password, transport='http2')
+
+Concurrent requests of all threads (or coroutines) are multiplexed as streams over one TLS
+connection per host, instead of a connection per request in flight as with PooledTransport.
+Hosts not offering HTTP/2 in TLS handshake are served over HTTP/1.1.
+"""
+import socket
+import time
+from .transport import Response, Transport, split_timeout
+
+
+def _import_httpx():
+    try:
+        import httpx
+        import h2
+    except ImportError as e:
+        raise ImportError('HTTP/2 transport requires httpx and h2: pip install pysberbps[http2]') from e
+    return httpx
+
+
+def _timeout(httpx, timeout):
+    """
+    :param timeout: resilience.Timeout(connect, read) or seconds for both
+    :return: httpx.Timeout
+    """
+    connect, read = split_timeout(timeout)
+    return httpx.Timeout(read, connect=connect)
+
+
+def _network_error(httpx, error):
+    """
+    :return: OSError for httpx error, SberWrapper handles it as SberNetworkError
+    """
+    if isinstance(error, httpx.TimeoutException):
+        return socket.timeout(str(error))
+    return ConnectionError(str(error))
+
+
+def _response(response):
+    return Response(response.status_code, response.reason_phrase, list(response.headers.items()), response.content)
+
+
+class Http2Transport(Transport):
+    """
+    HTTP/2 transport, instance is thread-safe and should be shared by all worker threads
+    """
+    def __init__(self, timeout=None, ssl_context=None, max_connections: int=10, idle_timeout: float=60.0):
+        """
+        :param timeout: resilience.Timeout(connect, read) or seconds for both, no timeout if None
+        :param ssl_context: ssl.SSLContext for https connections
+        :param max_connections: maximum connections per host, used by hosts without HTTP/2 only
+        :param idle_timeout: idle connections older than this (seconds) are closed
+        :raise ImportError: if httpx or h2 is not installed
+        """
+        self._httpx = httpx = _import_httpx()
+        self.timeout = timeout
+        self.client = httpx.Client(http2=True, verify=ssl_context or True, timeout=_timeout(httpx, timeout),
+                                   limits=httpx.Limits(max_connections=max_connections,
+                                                       keepalive_expiry=idle_timeout))
+
+    def request(self, method: str, url: str, body: bytes=None, headers: dict=None, timeout=None, trace=None):
+        httpx = self._httpx
+        started = time.perf_counter()
+        try:
+            response = self.client.request(method, url, content=body, headers=headers,
+                                           timeout=httpx.USE_CLIENT_DEFAULT if timeout is None
+                                           else _timeout(httpx, timeout))
+        except httpx.TransportError as e:
+            raise _network_error(httpx, e) from e
+        if trace is not None:
+            # httpx reads the reply at once, stream is opened on existing connection if any
+            trace('ttfb', time.perf_counter() - started)
+        return _response(response)
+
+    def prewarm(self, url: str, connections: int=1, timeout=None):
+        """
+        Open connection to the host of url with HEAD request, its reply is ignored.
+        One connection is enough for HTTP/2, so connections is ignored
+        """
+        self.request('HEAD', url, timeout=timeout)
+
+    def close(self):
+        self.client.close()
+
+
+class AsyncHttp2Transport(object):
+    """
+    HTTP/2 transport for AsyncSberWrapper
+    """
+    def __init__(self, timeout=None, ssl_context=None, max_connections: int=10, idle_timeout: float=60.0):
+        """
+        :param timeout: resilience.Timeout(connect, read) or seconds for both, no timeout if None
+        :param ssl_context: ssl.SSLContext for https connections
+        :param max_connections: maximum connections per host, used by hosts without HTTP/2 only
+        :param idle_timeout: idle connections older than this (seconds) are closed
+        :raise ImportError: if httpx or h2 is not installed
+        """
+        self._httpx = httpx = _import_httpx()
+        self.timeout = timeout
+        self.client = httpx.AsyncClient(http2=True, verify=ssl_context or True, timeout=_timeout(httpx, timeout),
+                                        limits=httpx.Limits(max_connections=max_connections,
+                                                            keepalive_expiry=idle_timeout))
+
+    async def request(self, method: str, url: str, body: bytes=None, headers: dict=None, timeout=None,
+                      trace=None):
+        httpx = self._httpx
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, content=body, headers=headers,
+                                                 timeout=httpx.USE_CLIENT_DEFAULT if timeout is None
+                                                 else _timeout(httpx, timeout))
+        except httpx.TransportError as e:
+            raise _network_error(httpx, e) from e
+        if trace is not None:
+            trace('ttfb', time.perf_counter() - started)
+        return _response(response)
+
+    async def prewarm(self, url: str, connections: int=1, timeout=None):
+        """Open connection to the host of url with HEAD request, its reply is ignored"""
+        await self.request('HEAD', url, timeout=timeout)
+
+    async def close(self):
+        await self.client.aclose()
@@ -0,0 +1,124 @@
+#coding=utf8
+# pysberbank metrics and tracing hooks #
+"""
+Hooks receive timings of every API call made by SberWrapper:
+
+    wrapper = SberWrapper(username, password, transport=PooledTransport(), metrics=PrometheusHook())
+
+Stages reported to MetricsHook.observe:
+    connect -- DNS lookup and TCP connect (with TLS handshake for AsyncPooledTransport)
+    tls     -- TLS handshake (PooledTransport only)
+    ttfb    -- from sending request till the first byte of reply
+    decode  -- JSON decoding of reply body
+connect and tls are reported only when a new connection is opened.
+Hooks with detailed=True also run the stages of the wrapper through measure():
+    build   -- building dict of request params
+    encode  -- urlencoding of params or SOAP envelope
+    decode  -- as above
+    handle  -- checking reply and building the result
+"""
+import time
+
+
+class MetricsHook(object):
+    """
+    Base class of metrics hooks. All methods do nothing, override the needed ones.
+    Value returned by start() is passed to other methods as context, e.g. tracing span
+    """
+    # wrapper stages are run by measure(), see profiler.Profiler
+    detailed = False
+
+    def start(self, method: str):
+        """
+        API call is started
+        :param method: API method name (register, status, status_ext, refund, deposit, reverse)
+        :return: context of the call
+        """
+        return None
+
+    def observe(self, method: str, stage: str, seconds: float, context=None):
+        """Stage of the call is finished"""
+
+    def measure(self, method: str, stage: str, func, *args, context=None):
+        """
+        Run stage of the call as func(*args) if detailed, build stage is run before start() without context
+        :return: result of func
+        """
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.observe(method, stage, time.perf_counter() - started, context)
+
+    def error(self, method: str, code: str, context=None):
+        """Bank replied with SberRequestError code"""
+
+    def finish(self, method: str, seconds: float, error: Exception=None, context=None):
+        """
+        API call is finished
+        :param seconds: total call time including retries
+        :param error: SberError raised by the call or None
+        """
+
+
+class PrometheusHook(MetricsHook):
+    """
+    Exports histograms of stage and call timings and counter of errors by code with prometheus_client
+    """
+    def __init__(self, namespace: str='sberbank', registry=None, buckets=None):
+        """
+        :param namespace: prefix of metric names
+        :param registry: prometheus_client registry, default one if None
+        :param buckets: histogram buckets in seconds
+        """
+        from prometheus_client import Counter, Histogram, REGISTRY
+        registry = registry or REGISTRY
+        kwargs = dict(namespace=namespace, registry=registry)
+        if buckets is not None:
+            kwargs['buckets'] = buckets
+        self.stages = Histogram('request_stage_seconds', 'Sberbank API call stage time', ['method', 'stage'],
+                                **kwargs)
+        self.calls = Histogram('request_seconds', 'Sberbank API call time', ['method'], **kwargs)
+        self.errors = Counter('request_errors', 'Sberbank API errors', ['method', 'code'],
+                              namespace=namespace, registry=registry)
+
+    def observe(self, method, stage, seconds, context=None):
+        self.stages.labels(method, stage).observe(seconds)
+
+    def error(self, method, code, context=None):
+        self.errors.labels(method, code).inc()
+
+    def finish(self, method, seconds, error=None, context=None):
+        self.calls.labels(method).observe(seconds)
+        if error is not None and not hasattr(error, 'code'):
+            self.errors.labels(method, type(error).__name__).inc()
+
+
+class OpenTelemetryHook(MetricsHook):
+    """
+    Wraps every API call in OpenTelemetry-style span, stage timings are set as span attributes
+    """
+    def __init__(self, tracer, prefix: str='sberbank'):
+        """
+        :param tracer: opentelemetry.trace.Tracer or any object with start_span(name) method
+        :param prefix: prefix of span names and attributes
+        """
+        self.tracer = tracer
+        self.prefix = prefix
+
+    def start(self, method):
+        return self.tracer.start_span('{0}.{1}'.format(self.prefix, method))
+
+    def observe(self, method, stage, seconds, context=None):
+        if context is None:
+            # build stage of chained Profiler runs before the span is started
+            return
+        context.set_attribute('{0}.{1}_seconds'.format(self.prefix, stage), seconds)
+
+    def error(self, method, code, context=None):
+        context.set_attribute('{0}.error_code'.format(self.prefix), code)
+
+    def finish(self, method, seconds, error=None, context=None):
+        if error is not None:
+            context.record_exception(error)
+        context.end()
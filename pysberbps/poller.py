@@ -0,0 +1,274 @@
+#coding=utf8
+# pysberbank order status polling #
+"""
+Central polling of pending orders instead of a sleeping thread per order
+
+    poller = StatusPoller(SberWrapper(username, password, transport=PooledTransport()), rate=50)
+    order_id, form_url = poller.wrapper.register(order, amount, success_url)
+    poller.watch(order_id, callback=on_finished)
+
+    # or from asyncio code
+    async for result in poller.results():
+        ...
+
+Orders are kept in one heap ordered by the time of the next poll. The interval of an order grows
+by `backoff` after every poll up to `max_interval`. Due polls are sent by a fixed pool of threads
+through the wrapper transport, no faster than `rate` requests per second. Order is finished when
+it reaches a final status, its deadline passes or the bank doesn't know it.
+"""
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import threading
+import time
+from .pysberbps import SberWrapper, SberError, SberRequestError
+
+logger = logging.getLogger(__name__)
+
+PollResult = collections.namedtuple('PollResult', 'order_id response error expired')
+
+# user finished payment page: paid, held (pre-auth) or declined
+FINAL = frozenset((SberWrapper.OrderStatus.APPROVED, SberWrapper.OrderStatus.DEPOSITED,
+                   SberWrapper.OrderStatus.REVERSED, SberWrapper.OrderStatus.REFUNDED,
+                   SberWrapper.OrderStatus.DECLINED))
+
+_IDLE = object()
+
+
+class _Watch(object):
+    __slots__ = ('order_id', 'deadline', 'interval', 'callback', 'seq', 'response')
+
+    def __init__(self, order_id, deadline, interval, callback):
+        self.order_id = order_id
+        self.deadline = deadline
+        self.interval = interval
+        self.callback = callback
+        self.seq = None
+        self.response = None
+
+
+class StatusPoller(object):
+    """
+    Polls status of many pending orders with one scheduler thread and `concurrency` request threads
+    """
+    def __init__(self, wrapper: SberWrapper, interval: float=2.0, max_interval: float=30.0, backoff: float=1.5,
+                 concurrency: int=8, rate: float=None, method: str='status', final=FINAL,
+                 clock=time.monotonic):
+        """
+        :param wrapper: SberWrapper sending status requests, use keep-alive transport for many orders
+        :param interval: delay before the first poll and between the first polls, seconds
+        :param max_interval: longest delay between polls of one order
+        :param backoff: multiplier of the delay after every poll
+        :param concurrency: maximum requests in flight
+        :param rate: maximum requests per second, unlimited if None
+        :param method: wrapper method polled, status or status_ext
+        :param final: OrderStatus values which finish polling
+        :param clock: time source, monotonic by default
+        """
+        self.wrapper = wrapper
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.concurrency = concurrency
+        self.method = method
+        self.final = final
+        self.clock = clock
+        self.limiter = None
+        if rate:
+            from .ratelimit import TokenBucket
+            self.limiter = TokenBucket(rate, clock=clock)
+        self._orders = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._condition = threading.Condition()
+        self._slots = threading.Semaphore(concurrency)
+        self._listeners = []
+        self._thread = None
+        self._executor = None
+        self._running = False
+        self.polls = 0
+
+    def __len__(self):
+        return len(self._orders)
+
+    def __contains__(self, order_id):
+        return order_id in self._orders
+
+    def watch(self, order_id: str, timeout: float=1200.0, expiration=None, callback=None):
+        """
+        Poll status of order until it is finished
+        :param timeout: stop polling after this number of seconds, session_timeout of register
+        :param expiration: datetime.datetime when order expires, expiration of register, overrides timeout
+        :param callback: callable(PollResult) called in a poller thread when order is finished
+        """
+        if expiration is not None:
+            timeout = expiration.timestamp() - time.time()
+        now = self.clock()
+        watch = _Watch(order_id, now + timeout, self.interval, callback)
+        with self._condition:
+            self._orders[order_id] = watch
+            self._schedule(watch, now + self.interval)
+        self.start()
+
+    def unwatch(self, order_id: str):
+        """Stop polling order without result"""
+        with self._condition:
+            self._orders.pop(order_id, None)
+            self._condition.notify_all()
+
+    def _schedule(self, watch, due):
+        watch.seq = next(self._seq)
+        heapq.heappush(self._heap, (due, watch.seq, watch.order_id))
+        if self._heap[0][1] == watch.seq:
+            self._condition.notify_all()
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return self
+            self._running = True
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.concurrency,
+                                                                   thread_name_prefix='sberbank-poll')
+            self._thread = threading.Thread(target=self._run, daemon=True, name='sberbank-poller')
+            self._thread.start()
+        return self
+
+    def close(self):
+        """Stop polling, orders stay watched and are polled again after start()"""
+        with self._condition:
+            if not self._running:
+                return
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def _due(self):
+        """
+        Wait for orders to poll
+        :return: list of due _Watch, empty list when poller is closed
+        """
+        with self._condition:
+            while self._running:
+                now = self.clock()
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    _, seq, order_id = heapq.heappop(self._heap)
+                    watch = self._orders.get(order_id)
+                    # entries of unwatched and rescheduled orders are skipped
+                    if watch is not None and watch.seq == seq:
+                        due.append(watch)
+                if due:
+                    return due
+                self._condition.wait(self._heap[0][0] - now if self._heap else None)
+            return []
+
+    def _run(self):
+        while True:
+            due = self._due()
+            if not due:
+                return
+            for index, watch in enumerate(due):
+                if not self._running:
+                    # closed, orders not polled yet are due after start()
+                    with self._condition:
+                        for rest in due[index:]:
+                            if self._orders.get(rest.order_id) is rest:
+                                self._schedule(rest, self.clock())
+                    return
+                if self.clock() >= watch.deadline:
+                    self._finish(watch, PollResult(watch.order_id, watch.response, None, True))
+                    continue
+                self._slots.acquire()
+                if self.limiter is not None:
+                    self.limiter.acquire(self.method)
+                self.polls += 1
+                self._executor.submit(self._poll, watch)
+
+    def _poll(self, watch):
+        response = error = None
+        try:
+            response = getattr(self.wrapper, self.method)(watch.order_id)
+        except SberError as e:
+            error = e
+        except Exception as e:
+            logger.exception('Polling of order %s failed', watch.order_id)
+            error = SberError(e)
+        finally:
+            self._slots.release()
+
+        if isinstance(error, SberRequestError):
+            # unknown order or access error won't change with time
+            self._finish(watch, PollResult(watch.order_id, None, error, False))
+            return
+        if response is not None:
+            watch.response = response
+            if self._status(response) in self.final:
+                self._finish(watch, PollResult(watch.order_id, response, None, False))
+                return
+        watch.interval = min(self.max_interval, watch.interval * self.backoff)
+        with self._condition:
+            if self._orders.get(watch.order_id) is watch:
+                self._schedule(watch, min(self.clock() + watch.interval, watch.deadline))
+
+    @staticmethod
+    def _status(response):
+        if isinstance(response, dict):
+            from .cache import StatusCache
+            return StatusCache.order_status(response)
+        return response.status
+
+    def _finish(self, watch, result):
+        with self._condition:
+            if self._orders.get(watch.order_id) is not watch:
+                return
+            del self._orders[watch.order_id]
+            idle = not self._orders
+            listeners = list(self._listeners)
+            self._condition.notify_all()
+        if watch.callback is not None:
+            try:
+                watch.callback(result)
+            except Exception:
+                logger.exception('Poll callback of order %s failed', watch.order_id)
+        for listener in listeners:
+            listener(result)
+            if idle:
+                listener(_IDLE)
+
+    def wait(self, timeout: float=None):
+        """
+        Block until all watched orders are finished
+        :return: True if no orders are watched
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._orders, timeout)
+
+    async def results(self, until_idle: bool=True):
+        """
+        Async iterator of PollResult of finished orders
+        :param until_idle: stop iteration when no orders are watched
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        results = asyncio.Queue()
+
+        def listener(result):
+            loop.call_soon_threadsafe(results.put_nowait, result)
+
+        with self._condition:
+            self._listeners.append(listener)
+            if until_idle and not self._orders:
+                results.put_nowait(_IDLE)
+        try:
+            while True:
+                result = await results.get()
+                if result is not _IDLE:
+                    yield result
+                elif until_idle:
+                    return
+        finally:
+            with self._condition:
+                self._listeners.remove(listener)
@@ -0,0 +1,218 @@
+#coding=utf8
+# pysberbank hot path profiler #
+"""
+Per-stage time and allocation breakdown of SberWrapper calls
+
+    profiler = Profiler(allocations=True, log_interval=60)
+    wrapper = SberWrapper(username, password, transport='pooled', metrics=profiler)
+    ...
+    print(profiler.format())
+
+or from command line with a scripted workload against the local simulator:
+
+    python -m pysberbps.profiler [--calls 500] [--transport pooled] [--latency 0.0] [--allocations]
+
+Stages of the wrapper (build, encode, decode, handle) are run by the profiler and timed with perf_counter_ns,
+transport stages (connect, tls, ttfb) are reported by the transport, call is the whole call with retries
+and rate limiter waits. Allocations are measured in a random `sample` share of the wrapper stages as
+tracemalloc peak above the memory traced at the start of the stage. Peak is global, so concurrent calls
+add noise to each other. tracemalloc traces every allocation of the process while it is on,
+so allocations=True is meant for profiling sessions.
+"""
+import collections
+import logging
+import random
+import threading
+import time
+import tracemalloc
+from .metrics import MetricsHook
+
+logger = logging.getLogger(__name__)
+
+# stages in order of the call, for format()
+STAGES = ('build', 'encode', 'connect', 'tls', 'ttfb', 'decode', 'handle', 'call')
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Profiler(MetricsHook):
+    """
+    Metrics hook keeping rolling timings of the last `window` calls per method and stage.
+    Instance is thread-safe and may be shared by wrappers
+    """
+    detailed = True
+
+    def __init__(self, window: int=1000, allocations: bool=False, sample: float=0.01, log_interval: float=None,
+                 hook: MetricsHook=None, clock=time.monotonic):
+        """
+        :param window: number of last values kept per method and stage
+        :param allocations: measure allocations with tracemalloc, it is started if it isn't tracing
+        :param sample: share of wrapper stages with measured allocations, 1 for all
+        :param log_interval: log format() at INFO level no more often than every log_interval seconds,
+                             checked when calls finish, disabled if None
+        :param hook: MetricsHook receiving all timings too, e.g. PrometheusHook
+        :param clock: time source of log_interval, monotonic by default
+        """
+        self.window = window
+        self.allocations = allocations
+        self.sample = sample
+        self.log_interval = log_interval
+        self.hook = hook
+        self.clock = clock
+        self._lock = threading.Lock()
+        # (method, stage) -> deque of nanoseconds or bytes
+        self._timings = {}
+        self._allocated = {}
+        self._logged_at = clock()
+        self._tracemalloc = False
+        if allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracemalloc = True
+
+    def _add(self, table, key, value):
+        with self._lock:
+            values = table.get(key)
+            if values is None:
+                values = table[key] = collections.deque(maxlen=self.window)
+            values.append(value)
+
+    def start(self, method: str):
+        return self.hook.start(method) if self.hook is not None else None
+
+    def observe(self, method: str, stage: str, seconds: float, context=None):
+        self._add(self._timings, (method, stage), int(seconds * 1e9))
+        if self.hook is not None:
+            self.hook.observe(method, stage, seconds, context)
+
+    def measure(self, method: str, stage: str, func, *args, context=None):
+        sampled = self.allocations and random.random() < self.sample
+        if sampled:
+            tracemalloc.reset_peak()
+            traced = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter_ns()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter_ns() - started
+            if sampled:
+                self._add(self._allocated, (method, stage), max(0, tracemalloc.get_traced_memory()[1] - traced))
+            self._add(self._timings, (method, stage), elapsed)
+            if self.hook is not None:
+                self.hook.observe(method, stage, elapsed / 1e9, context)
+
+    def error(self, method: str, code: str, context=None):
+        if self.hook is not None:
+            self.hook.error(method, code, context)
+
+    def finish(self, method: str, seconds: float, error: Exception=None, context=None):
+        self._add(self._timings, (method, 'call'), int(seconds * 1e9))
+        if self.hook is not None:
+            self.hook.finish(method, seconds, error, context)
+        if self.log_interval is not None:
+            now = self.clock()
+            with self._lock:
+                due = now - self._logged_at >= self.log_interval
+                if due:
+                    self._logged_at = now
+            if due:
+                logger.info('SberWrapper profile\n%s', self.format())
+
+    def stats(self):
+        """
+        :return: {method: {stage: dict(count, mean_us, p50_us, p99_us, max_us, alloc_bytes, alloc_samples)}},
+                 alloc_bytes is mean of sampled allocations, None if there are no samples
+        """
+        with self._lock:
+            timings = {key: sorted(values) for key, values in self._timings.items()}
+            allocated = {key: list(values) for key, values in self._allocated.items()}
+        stats = collections.defaultdict(dict)
+        for (method, stage), values in timings.items():
+            samples = allocated.get((method, stage), [])
+            stats[method][stage] = dict(
+                count=len(values), mean_us=sum(values) / len(values) / 1000,
+                p50_us=_percentile(values, 0.5) / 1000, p99_us=_percentile(values, 0.99) / 1000,
+                max_us=values[-1] / 1000, alloc_bytes=sum(samples) / len(samples) if samples else None,
+                alloc_samples=len(samples))
+        return dict(stats)
+
+    def format(self):
+        """
+        :return: table of stats() for logs and console
+        """
+        lines = ['{0:<11} {1:<8} {2:>6} {3:>10} {4:>10} {5:>10} {6:>10}'.format(
+            'method', 'stage', 'count', 'mean, us', 'p50, us', 'p99, us', 'alloc, B')]
+        for method, stages in sorted(self.stats().items()):
+            for stage in sorted(stages, key=lambda name: STAGES.index(name) if name in STAGES else len(STAGES)):
+                row = stages[stage]
+                lines.append('{0:<11} {1:<8} {2:>6} {3:>10.1f} {4:>10.1f} {5:>10.1f} {6:>10}'.format(
+                    method, stage, row['count'], row['mean_us'], row['p50_us'], row['p99_us'],
+                    '-' if row['alloc_bytes'] is None else '{0:.0f}'.format(row['alloc_bytes'])))
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._timings.clear()
+            self._allocated.clear()
+
+    def close(self):
+        """Stop tracemalloc if it was started by the profiler"""
+        if self._tracemalloc:
+            tracemalloc.stop()
+            self._tracemalloc = False
+
+
+def run_workload(wrapper, simulator, calls: int, threads: int=1):
+    """
+    Scripted workload: register orders, pay them in the simulator, request status and status_ext
+    of every order and refund part of it
+    :param calls: number of calls of every method
+    """
+    from .batch import imap_unordered
+    prefix = '{0:x}'.format(random.getrandbits(32))
+
+    def register(number):
+        order_id, _ = wrapper.register('{0}-{1}'.format(prefix, number), 1000, 'https://example.com/',
+                                       description='Order {0}'.format(number), extra={'number': str(number)})
+        simulator.pay(order_id)
+        return order_id
+
+    order_ids = [result.result for result in imap_unordered(register, range(calls), threads)
+                 if result.error is None]
+    for func in (wrapper.status, wrapper.status_ext, lambda order_id: wrapper.refund(order_id, 100)):
+        for _ in imap_unordered(func, order_ids, threads):
+            pass
+
+
+def main(argv=None):
+    import argparse
+    from .pysberbps import SberWrapper
+    from .simulator import SberSimulator
+    parser = argparse.ArgumentParser(description='Profile SberWrapper calls against the local simulator')
+    parser.add_argument('--calls', type=int, default=500, help='calls of every method')
+    parser.add_argument('--transport', default='pooled', help='urllib, pooled or http2')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated bank latency, seconds')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--allocations', action='store_true', help='measure allocations with tracemalloc')
+    parser.add_argument('--sample', type=float, default=0.1, help='share of stages with measured allocations')
+    parser.add_argument('--soap', action='store_true', help='use SOAP API')
+    args = parser.parse_args(argv)
+
+    profiler = Profiler(window=max(args.calls, 1), allocations=args.allocations, sample=args.sample)
+    with SberSimulator(latency=args.latency) as simulator:
+        options = dict(wsdl=simulator.wsdl_url, wsdl_cache=False) if args.soap else dict(urls=simulator.urls)
+        wrapper = SberWrapper('user', 'password', soap=args.soap, transport=args.transport, coalesce=False,
+                              metrics=profiler, **options)
+        try:
+            run_workload(wrapper, simulator, args.calls, args.threads)
+        finally:
+            wrapper.transport.close()
+            profiler.close()
+    print(profiler.format())
+
+
+if __name__ == '__main__':
+    main()
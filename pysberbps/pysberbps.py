@@ -1,12 +1,16 @@
 #coding=utf8
 # pysberbank 10.11.14 8:32 by mnach #
-import datetime
+# annotations aren't evaluated, datetime isn't imported for them
+from __future__ import annotations
 from enum import Enum
-import json
+import functools
 import logging
-import urllib.request
+import threading
+import time
+import types
 import urllib.parse
-import urllib.error
+from urllib.parse import quote_plus
+# urllib.request, http.client, ssl and optional features are imported on first use, see prewarm()
 logger = logging.getLogger(__name__)
 
 __author__ = 'Mikhail Nacharov'
@@ -17,6 +21,10 @@ class SberError(Exception): pass
 
 class SberNetworkError(SberError): pass
 
+class SberCircuitOpenError(SberNetworkError): pass
+
+class SberChecksumError(SberError): pass
+
 class SberRequestError(SberError):
     def __init__(self, request, code, desc):
         self.request = request
@@ -25,14 +33,50 @@ class SberRequestError(SberError):
         super(SberRequestError, self).__init__('{0.request} error {0.code}: {0.desc}'.format(self))
 
 
+class _Trace(object):
+    """
+    trace callback of one call for metrics hook with detailed=True, measure() runs wrapper stages
+    """
+    __slots__ = ('metrics', 'method', 'context')
+
+    def __init__(self, metrics, method, context):
+        self.metrics = metrics
+        self.method = method
+        self.context = context
+
+    def __call__(self, stage, seconds):
+        self.metrics.observe(self.method, stage, seconds, self.context)
+
+    def measure(self, stage, func, *args):
+        return self.metrics.measure(self.method, stage, func, *args, context=self.context)
+
+
 class SberWrapper(object):
     """
-    Sberbank acquiring API wrapper
+    Sberbank acquiring API wrapper.
+    Instance is thread-safe: configuration is read-only after construction, so one wrapper
+    may be shared by all threads of a worker process
     """
     class PageType(Enum):
         DESKTOP = 1
         MOBILE = 2
 
+    class OrderStatus(Enum):
+        # order registered but not paid
+        CREATED = 0
+        # amount is held (2 steps payments)
+        APPROVED = 1
+        # amount is authorized and deposited
+        DEPOSITED = 2
+        # authorization is reversed
+        REVERSED = 3
+        # order is refunded
+        REFUNDED = 4
+        # authorization through issuer ACS is initiated
+        ACS_AUTH = 5
+        # authorization is declined
+        DECLINED = 6
+
     # TODO: Refactor this, provide base url to quick switch between test and prod envs
     rest_urls = dict(
         # register order in sberbank
@@ -44,7 +88,11 @@ class SberWrapper(object):
         # get order extended status
         status_ext='https://3dsec.sberbank.ru/payment/rest/getOrderStatusExtended.do',
         # refund order
-        refund='https://3dsec.sberbank.ru/payment/rest/refund.do'
+        refund='https://3dsec.sberbank.ru/payment/rest/refund.do',
+        # complete payment of held order (2 steps payments)
+        deposit='https://3dsec.sberbank.ru/payment/rest/deposit.do',
+        # cancel payment of held order
+        reverse='https://3dsec.sberbank.ru/payment/rest/reverse.do'
     )
 
     rest_urls_production = dict(
@@ -57,72 +105,414 @@ class SberWrapper(object):
         # get order extended status
         status_ext='https://securepayments.sberbank.ru/payment/rest/getOrderStatusExtended.do',
         # refund order
-        refund='https://securepayments.sberbank.ru/payment/rest/refund.do'
+        refund='https://securepayments.sberbank.ru/payment/rest/refund.do',
+        # complete payment of held order (2 steps payments)
+        deposit='https://securepayments.sberbank.ru/payment/rest/deposit.do',
+        # cancel payment of held order
+        reverse='https://securepayments.sberbank.ru/payment/rest/reverse.do'
     )
 
-    soap_urls = dict()
+    # SOAP operations of API methods, endpoint is defined by WSDL
+    soap_urls = dict(
+        register='registerOrder',
+        registerPreAuth='registerOrderPreAuth',
+        status='getOrderStatus',
+        status_ext='getOrderStatusExtended',
+        refund='refundOrder',
+        deposit='depositOrder',
+        reverse='reverseOrder'
+    )
 
-    def __init__(self, username: str, password: str, soap: bool=False, post: bool=True, urls: dict=None, test_env: bool=True):
+    soap_wsdl = 'https://3dsec.sberbank.ru/payment/webservices/merchant-ws?wsdl'
+    soap_wsdl_production = 'https://securepayments.sberbank.ru/payment/webservices/merchant-ws?wsdl'
+
+    # adding charset parameter to the Content-Type header.
+    post_headers = {"Content-Type": "application/x-www-form-urlencoded;charset=utf-8"}
+    get_headers = {}
+
+    # configuration attributes, they can't be changed after __init__
+    _config = frozenset(('soap', 'post', 'urls', 'wsdl', 'wsdl_cache', 'transport', 'cache', 'timeout', 'retry',
+                         'breaker', 'metrics', 'decoder', 'typed', 'limiter', 'store'))
+
+    def __init__(self, username: str, password: str, soap: bool=False, post: bool=True, urls: dict=None, test_env: bool=True,
+                 transport=None, cache=None, coalesce: bool=True, timeout=None, retry=None, breaker=None,
+                 metrics=None, decoder=None, typed: bool=False, limiter=None, wsdl: str=None,
+                 wsdl_cache: str=None, store=None):
         """
         :param username: Store username
         :param password: Store password
-        :param use_soap: use soap api instead of REST
+        :param soap: use soap api instead of REST
         :param post: use POST request not GET
-        :param urls: dict of urls where requests will be sent
+        :param urls: dict of urls where requests will be sent, dict of SOAP operations if soap
+        :param transport: transport.Transport (e.g. PooledTransport) shared between calls or its name:
+            'urllib' (default), 'pooled' or 'http2'
+        :param cache: cache.StatusCache for status/status_ext replies, no caching if None
+        :param coalesce: share one in-flight status/status_ext request between concurrent callers
+        :param timeout: resilience.Timeout(connect, read) or seconds for both, no timeout if None
+        :param retry: resilience.RetryPolicy for idempotent calls (status, status_ext), no retries if None
+        :param breaker: resilience.CircuitBreaker, may be shared between wrappers
+        :param metrics: metrics.MetricsHook to report timings and errors, disabled if None
+        :param decoder: callable parsing reply body bytes, the fastest of orjson/ujson/json if None
+        :param typed: status/status_ext return responses.OrderStatusInfo instead of dict
+        :param limiter: ratelimit.RateLimiter, TokenBucket or other object with acquire(method),
+            waited before every attempt
+        :param wsdl: SOAP service definition url or path, test or production service of Sberbank if None
+        :param wsdl_cache: directory of compiled WSDL, see soap.load_service
+        :param store: store.OrderStore saving orders, finished orders are answered from it, disabled if None
         """
         self._username = username
         self._password = password
+        # credentials are the same in every request, so they are encoded once
+        self._auth = urllib.parse.urlencode(dict(
+            # Логин магазина, полученный при подключении
+            userName=username,
+            # Пароль магазина, полученный при подключении
+            password=password,
+        ))
 
         self.soap = soap
         self.post = post
         if self.soap and not self.post:
             raise ValueError("Soap request must be send by POST request")
 
-        if test_env:
-            self.urls = urls or self.rest_urls
+        if self.soap:
+            urls = urls or self.soap_urls
+        elif test_env:
+            urls = urls or self.rest_urls
         else:
-            self.urls = urls or self.rest_urls_production
+            urls = urls or self.rest_urls_production
+        self.urls = types.MappingProxyType(dict(urls))
+        self.wsdl = wsdl or (self.soap_wsdl if test_env else self.soap_wsdl_production)
+        self.wsdl_cache = wsdl_cache
+        self._soap_client = None
+        self._soap_lock = threading.Lock()
+        self.transport = self._create_transport(transport)
+        self.cache = cache
+        self.timeout = timeout
+        self.retry = retry
+        self.breaker = breaker
+        self.metrics = metrics
+        from .responses import default_decoder, OrderStatusInfo
+        if decoder is None and self.soap:
+            from .soap import parse_reply
+            decoder = parse_reply
+        self.decoder = decoder or default_decoder()
+        self.typed = typed
+        self.limiter = limiter
+        self.store = store
+        self._status_type = OrderStatusInfo.from_status if typed else None
+        self._status_ext_type = OrderStatusInfo.from_status_ext if typed else None
+        self._flight = None
+        if coalesce:
+            from .singleflight import SingleFlight
+            self._flight = SingleFlight()
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if name in self._config and self.__dict__.get('_frozen'):
+            raise AttributeError('{0} of {1} is read-only, create new wrapper to change it'.format(
+                name, type(self).__name__))
+        super(SberWrapper, self).__setattr__(name, value)
+
+    def __delattr__(self, name):
+        if name in self._config and self.__dict__.get('_frozen'):
+            raise AttributeError('{0} of {1} is read-only'.format(name, type(self).__name__))
+        super(SberWrapper, self).__delattr__(name)
+
+    def _build(self, method, builder, *args, **kwargs):
+        """
+        Build request by one of _<method>_request, reported as build stage to detailed metrics hook
+        :return: (url, request)
+        """
+        if self.metrics is None or not self.metrics.detailed:
+            return builder(*args, **kwargs)
+        if kwargs:
+            builder = functools.partial(builder, **kwargs)
+        return self.metrics.measure(method, 'build', builder, *args)
+
+    @staticmethod
+    def _create_transport(transport):
+        """
+        :param transport: transport instance, its name for transport.create_transport or None for urllib
+        """
+        if transport is None or isinstance(transport, str):
+            from .transport import create_transport
+            return create_transport(transport or 'urllib')
+        return transport
+
+    def _request(self, url, params, trace=None):
+        logger.debug('Request  is %r', params)
+        return self._transport_request(url, params, trace)
+
+    def _encode(self, params):
+        """
+        Urlencode request params after the precomputed credentials
+        :param params: dict of request fields except credentials, names must not need quoting
+        """
+        encoded = [self._auth]
+        for name, value in params.items():
+            encoded.append('{0}={1}'.format(name, quote_plus(value if isinstance(value, str) else str(value))))
+        return '&'.join(encoded)
 
-    def _request(self, url, params):
+    def _prepare(self, url, params):
+        """
+        Encode request for the transport
+        :param url: url or SOAP operation name
+        :return: (method, url, body, headers)
+        """
         if self.soap:
-            # todo: Soap implementation
-            raise NotImplementedError("SOAP haven't implemented yet")
-        logger.debug('Request  is {0!r}'.format(params))
+            return self._soap().prepare(url, params)
+        data = self._encode(params)
+        if self.post:
+            return 'POST', url, data.encode('utf-8'), self.post_headers
+        return 'GET', '{0}?{1}'.format(url, data), None, self.get_headers
+
+    def _soap(self):
+        """
+        :return: soap.SoapClient, WSDL is loaded on first call
+        """
+        if self._soap_client is None:
+            from .soap import SoapClient, load_service
+            with self._soap_lock:
+                if self._soap_client is None:
+                    self._soap_client = SoapClient(load_service(self.wsdl, self.wsdl_cache), self._username,
+                                                   self._password)
+        return self._soap_client
 
+    def _endpoints(self):
+        """
+        :return: one url of every host the requests are sent to
+        """
+        if self.soap:
+            return [self._soap().endpoint]
+        hosts = {}
+        for url in self.urls.values():
+            hosts.setdefault(urllib.parse.urlsplit(url)[:2], url)
+        return list(hosts.values())
+
+    def prewarm(self, connections: int=1):
+        """
+        Do the work of the first request ahead of time, e.g. in the init phase of serverless function:
+        import HTTP modules, load SOAP service and open connections of the transport to the bank
+        :param connections: connections opened to every host if transport has prewarm(url, connections, timeout)
+        :return: self
+        """
+        # modules of transports
+        import http.client
+        import urllib.request
         try:
-            if self.post:
-                request = urllib.request.Request(url)
-                # adding charset parameter to the Content-Type header.
-                request.add_header("Content-Type","application/x-www-form-urlencoded;charset=utf-8")
-                data = urllib.parse.urlencode(params)
-                data = data.encode('utf-8')
-                response = urllib.request.urlopen(request, data)
-            else:
-                response = urllib.request.urlopen('{0}?{1}'.format(url, urllib.parse.urlencode(params)))
-        except urllib.error.HTTPError as e:
-            exception_body = ''
-            try:
-                exception_body = e.fp.read()
-            except: pass
-            logger.error('Sberbank REST-server return wrong status {0.code}: {0.msg}'.format(e), exc_info=True,
-                         extra={'response': exception_body})
+            endpoints = self._endpoints()
+            prewarm = getattr(self.transport, 'prewarm', None)
+            if prewarm is not None:
+                for url in endpoints:
+                    prewarm(url, connections, self.timeout)
+        except (OSError, http.client.HTTPException) as e:
+            logger.warning('Error {0!r} happened during prewarm'.format(e), exc_info=True)
             raise SberNetworkError
+        return self
 
-        except urllib.error.URLError as e:
-            logger.warning('Error {0!r} happened during processing request'.format(e), exc_info=True)
+    def _process(self, response, trace=None):
+        """
+        Check transport response and unmarshal its body
+        :param response: transport.Response
+        :param trace: callable(stage, seconds) to report decode time
+        :return: <dict> response data
+        """
+        if response.status >= 400:
+            if self.soap and response.status == 500 and response.body:
+                from .soap import raise_fault
+                raise_fault(response.body)
+            logger.error('Sberbank REST-server return wrong status {0.status}: {0.reason}'.format(response),
+                         extra={'response': response.body})
             raise SberNetworkError
-
-        logger.debug('Response is {0.status} {0._method} {0.reason} {headers}'.format(response, headers=response.getheaders()))
-        response_body = response.read()
-        logger.debug('Response body is {0!r}'.format(response_body))
-        if response_body is None:
+        logger.debug('Response body is %r', response.body)
+        if not response.body:
             logger.error('Sberbank REST-server return empty reply with HTTPCode={0}'.format(response.status))
             raise SberNetworkError
 
-        response_dict = json.loads(response_body.decode('utf8'), encoding='utf8')
-        logger.debug('Unmarshaled response  is {0!r}'.format(response_dict))
+        measure = getattr(trace, 'measure', None)
+        if measure is not None:
+            response_dict = measure('decode', self.decoder, response.body)
+        else:
+            started = time.perf_counter()
+            response_dict = self.decoder(response.body)
+            if trace is not None:
+                trace('decode', time.perf_counter() - started)
+        logger.debug('Unmarshaled response  is %r', response_dict)
         return response_dict
 
+    def _transport_request(self, url, params, trace=None):
+        import http.client
+        measure = getattr(trace, 'measure', None)
+        prepared = self._prepare(url, params) if measure is None else measure('encode', self._prepare, url, params)
+        try:
+            response = self.transport.request(*prepared, timeout=self.timeout, trace=trace)
+        except (OSError, http.client.HTTPException) as e:
+            logger.warning('Error {0!r} happened during processing request'.format(e), exc_info=True)
+            raise SberNetworkError
+        return self._process(response, trace)
+
+    def _send(self, method, url, request, idempotent: bool=False, trace=None):
+        delays = self.retry.delays() if idempotent and self.retry is not None else iter(())
+        while True:
+            if self.limiter is not None:
+                # every attempt is counted by the bank, retries included
+                self.limiter.acquire(method)
+            if self.breaker is not None:
+                self.breaker.before_call()
+            try:
+                response = self._request(url, request, trace)
+            except SberNetworkError:
+                if self.breaker is not None:
+                    self.breaker.record(False)
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                logger.info('Network error, retry in %.3f seconds', delay)
+                time.sleep(delay)
+                continue
+            except SberError:
+                if self.breaker is not None:
+                    self.breaker.record(True)
+                raise
+            except Exception as e:
+                if self.breaker is not None:
+                    self.breaker.record(False)
+                raise SberError(e)
+            except BaseException:
+                # cancelled or interrupted call, e.g. by asyncio.wait_for timeout
+                if self.breaker is not None:
+                    self.breaker.cancel()
+                raise
+            if self.breaker is not None:
+                self.breaker.record(True)
+            return response
+
+    def _call(self, method, url, request, handler, idempotent: bool=False):
+        """
+        Send request and process reply by handler, reporting timings and errors to metrics hook
+        :param method: API method name for metrics (register, status, ...)
+        :param handler: one of _<method>_response
+        """
+        metrics = self.metrics
+        if metrics is None:
+            return handler(self._send(method, url, request, idempotent))
+
+        context = metrics.start(method)
+        started = time.perf_counter()
+        error = None
+        try:
+            if metrics.detailed:
+                trace = _Trace(metrics, method, context)
+                return trace.measure('handle', handler, self._send(method, url, request, idempotent, trace))
+            trace = functools.partial(metrics.observe, method, context=context)
+            return handler(self._send(method, url, request, idempotent, trace))
+        except SberError as e:
+            error = e
+            if isinstance(e, SberRequestError):
+                metrics.error(method, e.code, context)
+            raise
+        finally:
+            metrics.finish(method, time.perf_counter() - started, error, context)
+
+    def _cached_status(self, method, order_id, language, fetch, fresh=False):
+        """
+        Answer status request from the cache or the order store, join the same request in flight or call fetch()
+        :param fresh: call fetch() in any case, its reply is saved as usual
+        """
+        if fresh:
+            return self._fetch_and_store(method, order_id, language, fetch)
+        if self.cache is not None:
+            cached = self.cache.get(order_id, method, language)
+            if cached is not None:
+                return cached
+        if self.store is not None:
+            stored = self.store.get(order_id, method, language)
+            if stored is not None:
+                return stored
+
+        if self._flight is None:
+            return self._fetch_and_store(method, order_id, language, fetch)
+        return self._flight.do((method, order_id, language),
+                               lambda: self._fetch_and_store(method, order_id, language, fetch))
+
+    def _fetch_and_store(self, method, order_id, language, fetch):
+        # reply requested before refund, deposit or reverse of the order isn't saved after its _invalidate
+        cache_requested = self.cache.clock() if self.cache is not None else None
+        store_requested = time.time()
+        response = fetch()
+        if self.cache is not None:
+            self.cache.set(order_id, method, language, response, cache_requested)
+        if self.store is not None:
+            self.store.record_status(order_id, method, language, response, store_requested)
+        return response
+
+    def _registered(self, order_id, order, amount):
+        """
+        Save order created by register or register_many to the order store
+        """
+        if self.store is not None:
+            self.store.record_register(order_id, order, amount)
+
+    def _invalidate(self, order_id):
+        """
+        Drop cached and stored state of the order changed by refund, deposit or reverse
+        """
+        if self.cache is not None:
+            self.cache.invalidate(order_id)
+        if self.store is not None:
+            self.store.invalidate(order_id)
+
+    def _register_request(self, order: str, amount: int, success_url: str, currency: int=643, fail_url: str=None,
+                          is_pre_auth: bool=False, description: str='', language: str='RU',
+                          page_type: PageType=PageType.DESKTOP, clinet_id: str=None, session_timeout: int=1200,
+                          expiration: datetime.date=None, extra: dict=None):
+        url = self.urls['register']
+        if is_pre_auth:
+            url = self.urls['registerPreAuth']
+        request = dict(
+            # Номер (идентификатор) заказа в системе магазина
+            orderNumber=order,
+            # Сумма платежа в минимальных единицах валюты(копейки).
+            amount=amount,
+            # *Код валюты платежа ISO 4217.
+            currency=currency,
+            # Адрес, на который надо перенаправить пользователя в случае успешной оплаты
+            returnUrl=success_url,
+            # *Язык в кодировке ISO 639-1.
+            language=language,
+             # В pageView передаётся признак - мобильное устройство: MOBILE или DESKTOP
+            pageView=page_type.name,
+            # *Продолжительность сессии в секундах. default=1200
+            sessionTimeoutSecs=session_timeout,
+        )
+        if fail_url:
+            # *Адрес, на который надо перенаправить пользователя в случае неуспешной оплаты
+            request['failUrl'] = fail_url
+        if description:
+             # *Описание заказа в свободной форме
+            request['description'] = description
+        if clinet_id:
+            # *Номер (идентификатор) клиента в системе магазина
+            request['clientId'] = clinet_id
+        if extra:
+            # *Поля дополнительной информации для последующего хранения
+            import json
+            request['jsonParams'] = json.dumps(extra)
+        if expiration:
+            # *Время жизни заказа. Если не задано вычисляется по sessionTimeoutSecs
+            request['expirationDate'] = expiration.isoformat().split('.')[0]
+        return url, request
+
+    @staticmethod
+    def _register_response(response):
+        if 'errorCode' in response and response.get('errorCode') != '0':
+            raise SberRequestError('register', response['errorCode'],
+                                   response.get('errorMessage', 'Description not presented'))
+        if 'orderId' not in response or 'formUrl' not in response:
+            raise SberNetworkError('Service temporary unavailable')
+        return response['orderId'], response['formUrl']
+
     def register(self, order: str, amount: int, success_url: str, currency: int=643, fail_url: str=None,
                  is_pre_auth: bool=False, description: str='', language: str='RU', page_type: PageType=PageType.DESKTOP,
          clinet_id: str=None, session_timeout: int=1200, expiration: datetime.date=None, extra: dict=None):
@@ -144,125 +534,132 @@ class SberWrapper(object):
         :return: (order_id, form_url)
         """
         # 1. preparing data to request
-        url = self.urls['register']
-        if is_pre_auth:
-            url = self.urls['registerPreAuth']
-            request = dict(
-                # Логин магазина, полученный при подключении
-                userName=self._username,
-                # Пароль магазина, полученный при подключении
-                password=self._password,
-                # Номер (идентификатор) заказа в системе магазина
-                orderNumber=order,
-                # Сумма платежа в минимальных единицах валюты(копейки).
-                amount=amount,
-                # *Код валюты платежа ISO 4217.
-                currency=currency,
-                # Адрес, на который надо перенаправить пользователя в случае успешной оплаты
-                returnUrl=success_url,
-                # *Язык в кодировке ISO 639-1.
-                language=language,
-                 # В pageView передаётся признак - мобильное устройство: MOBILE или DESKTOP
-                pageView=page_type.name,
-                # *Продолжительность сессии в секундах. default=1200
-                sessionTimeoutSecs=session_timeout,
-            )
-            if fail_url:
-                # *Адрес, на который надо перенаправить пользователя в случае неуспешной оплаты
-                request['failUrl'] = fail_url
-            if description:
-                 # *Описание заказа в свободной форме
-                request['description'] = description
-            if clinet_id:
-                # *Номер (идентификатор) клиента в системе магазина
-                request['clientId'] = clinet_id
-            if extra:
-                # *Поля дополнительной информации для последующего хранения
-                request['jsonParams'] = extra
-            if expiration:
-                # *Время жизни заказа. Если не задано вычисляется по sessionTimeoutSecs
-                request['expirationDate'] = expiration.isoformat().split('.')[0]
-
-            # 2. send request to the server
-            try:
-                response = self._request(url, request)
-            except SberError:
-                raise
-            except Exception as e:
-                raise SberError(e)
-
-            # 3. processing reply
-            if 'errorCode' in response and response.get('errorCode') != '0':
-                raise SberRequestError('register', response['errorCode'],
-                                       response.get('errorMessage', 'Description not presented'))
-            if 'orderId' not in response or 'formUrl' not in response:
-                raise SberNetworkError('Service temporary unavailable')
-            return response['orderId'], response['formUrl']
+        url, request = self._build('register', self._register_request, order, amount, success_url, currency,
+                                   fail_url, is_pre_auth, description, language, page_type, clinet_id,
+                                   session_timeout, expiration, extra)
+        # 2. send request to the server and 3. processing reply
+        order_id, form_url = self._call('register', url, request, self._register_response)
+        self._registered(order_id, order, amount)
+        return order_id, form_url
 
-    def status(self, order_id: str, language: str='RU'):
+    def register_many(self, specs, concurrency: int=8):
         """
-        Get order status
-        :param order_id: order UID
-        :param language: Acquiring page language
-        :return: <dict> order data
+        Register many orders in parallel. Specs are read lazily, validated and built ahead of sending,
+        no more than 2 * concurrency requests wait for a thread, so memory doesn't depend on the number of orders
+        :param specs: iterable of dicts with keyword arguments of register (order, amount, success_url, extra, ...)
+                      or (order, amount, success_url) tuples
+        :param concurrency: number of simultaneous requests
+        :return: batch.RegisterBatch, iterable of batch.RegisterResult(order, order_id, form_url, error)
+                 in completion order, invalid specs have ValueError or TypeError. Its stats are set at the end
         """
-        # 1. preparing data to request
+        from .batch import RegisterBatch
+        return RegisterBatch(self, specs, concurrency)
+
+    def _status_request(self, order_id: str, language: str='RU'):
         url = self.urls['status']
         request = dict(
-            userName=self._username,
-            password=self._password,
             # Номер заказа в платежной системе. Уникален в пределах системы.
             orderId=order_id,
             # Язык в кодировке ISO 639-1. Если не указан, считается, что язык – русский.
             language=language
         )
+        return url, request
 
-        # 2. send request to the server
-        try:
-            response = self._request(url, request)
-        except SberError:
-            raise
-        except Exception as e:
-            raise SberError(e)
-
-        # 3. processing reply
+    @staticmethod
+    def _status_response(response):
         if 'ErrorCode' in response and response.get('ErrorCode') != '0':
             raise SberRequestError('status', response['ErrorCode'],
                                    response.get('ErrorMessage', 'Description not presented'))
         return response
 
-    def status_ext(self, order_id: str, language: str='RU'):
+    def status(self, order_id: str, language: str='RU', fresh: bool=False):
         """
         Get order status
         :param order_id: order UID
         :param language: Acquiring page language
+        :param fresh: request the bank even if the reply is cached or stored, e.g. to verify lost operation
         :return: <dict> order data
         """
-        # 1. preparing data to request
+        response = self._status_reply('status', order_id, language, fresh)
+        return response if self._status_type is None else self._status_type(response)
+
+    def _status_ext_request(self, order_id: str, language: str='RU'):
         url = self.urls['status_ext']
         request = dict(
-            userName=self._username,
-            password=self._password,
             # Номер заказа в платежной системе. Уникален в пределах системы.
             orderId=order_id,
             # Язык в кодировке ISO 639-1. Если не указан, считается, что язык – русский.
             language=language
         )
+        return url, request
 
-        # 2. send request to the server
-        try:
-            response = self._request(url, request)
-        except SberError:
-            raise
-        except Exception as e:
-            raise SberError(e)
-
-        # 3. processing reply
+    @staticmethod
+    def _status_ext_response(response):
         if 'errorCode' in response and response.get('errorCode') != '0':
             raise SberRequestError('status_ext', response['errorCode'],
                                    response.get('errorMessage', 'Description not presented'))
         return response
 
+    def status_ext(self, order_id: str, language: str='RU', fresh: bool=False):
+        """
+        Get order status
+        :param order_id: order UID
+        :param language: Acquiring page language
+        :param fresh: request the bank even if the reply is cached or stored, e.g. to verify lost operation
+        :return: <dict> order data
+        """
+        response = self._status_reply('status_ext', order_id, language, fresh)
+        return response if self._status_ext_type is None else self._status_ext_type(response)
+
+    def _status_reply(self, method: str, order_id: str, language: str='RU', fresh: bool=False):
+        """
+        :param method: status or status_ext
+        :return: <dict> reply before conversion to typed reply
+        """
+        url, request = self._build(method, getattr(self, '_{0}_request'.format(method)), order_id, language)
+        response_handler = getattr(self, '_{0}_response'.format(method))
+        return self._cached_status(method, order_id, language,
+                                   lambda: self._call(method, url, request, response_handler, idempotent=True), fresh)
+
+    def status_many(self, order_ids, concurrency: int=8, language: str='RU', checkpoint=None):
+        """
+        Get statuses of many orders in parallel
+        :param order_ids: iterable of order UIDs
+        :param concurrency: number of simultaneous requests
+        :param language: Acquiring page language
+        :param checkpoint: batch.Checkpoint or path to file, finished orders are skipped on the next run
+        :return: generator of batch.BatchResult(order_id, <dict> order data, SberError) in completion order
+        """
+        from .batch import map_orders
+        return map_orders(lambda order_id: self.status(order_id, language), order_ids, concurrency, checkpoint)
+
+    def status_ext_many(self, order_ids, concurrency: int=8, language: str='RU', checkpoint=None):
+        """
+        Get extended statuses of many orders in parallel, see status_many
+        :return: generator of batch.BatchResult(order_id, <dict> order data, SberError) in completion order
+        """
+        from .batch import map_orders
+        return map_orders(lambda order_id: self.status_ext(order_id, language), order_ids, concurrency, checkpoint)
+
+    def _refund_request(self, order_id: str, amount: int, language: str='RU'):
+        url = self.urls['refund']
+        request = dict(
+            # Номер заказа в платежной системе. Уникален в пределах системы.
+            orderId=order_id,
+            # Сумма платежа в копейках (или центах)
+            amount=amount,
+            # Язык в кодировке ISO 639-1. Если не указан, считается, что язык – русский.
+            language=language
+        )
+        return url, request
+
+    @staticmethod
+    def _refund_response(response):
+        if 'errorCode' in response and response.get('errorCode') != '0':
+            raise SberRequestError('refund', response['errorCode'],
+                                   response.get('errorMessage', 'Description not presented'))
+        return response.get('errorMessage', 'OK')
+
     def refund(self, order_id: str, amount: int, language: str='RU'):
         """
         Refund order and send <amount> back to user credit card
@@ -271,29 +668,79 @@ class SberWrapper(object):
         :param language: Acquiring page language
         :return: Sberbank status text
         """
-        # 1. preparing data to request
-        url = self.urls['refund']
+        url, request = self._build('refund', self._refund_request, order_id, amount, language)
+        # the order isn't answered locally while the refund is in flight, nor after a crash in the middle of it
+        self._invalidate(order_id)
+        try:
+            message = self._call('refund', url, request, self._refund_response)
+            if self.store is not None:
+                self.store.record_refund(order_id, amount)
+            return message
+        finally:
+            # status requested meanwhile may be saved with the state before the refund
+            self._invalidate(order_id)
+
+    def _deposit_request(self, order_id: str, amount: int=0, language: str='RU'):
+        url = self.urls['deposit']
         request = dict(
-            userName=self._username,
-            password=self._password,
             # Номер заказа в платежной системе. Уникален в пределах системы.
             orderId=order_id,
-            # Сумма платежа в копейках (или центах)
+            # Сумма списания в копейках (или центах), 0 - вся удержанная сумма
             amount=amount,
             # Язык в кодировке ISO 639-1. Если не указан, считается, что язык – русский.
             language=language
         )
+        return url, request
+
+    @staticmethod
+    def _deposit_response(response):
+        if 'errorCode' in response and response.get('errorCode') != '0':
+            raise SberRequestError('deposit', response['errorCode'],
+                                   response.get('errorMessage', 'Description not presented'))
+        return response.get('errorMessage', 'OK')
 
-        # 2. send request to the server
+    def deposit(self, order_id: str, amount: int=0, language: str='RU'):
+        """
+        Complete payment of order held by 2 steps payment (register with is_pre_auth=True)
+        :param order_id: Sberbank order UID
+        :param amount: Amount to charge in minimal unit of currency(penny / kopeck), whole held amount if 0
+        :param language: Acquiring page language
+        :return: Sberbank status text
+        """
+        url, request = self._build('deposit', self._deposit_request, order_id, amount, language)
+        self._invalidate(order_id)
         try:
-            response = self._request(url, request)
-        except SberError:
-            raise
-        except Exception as e:
-            raise SberError(e)
+            return self._call('deposit', url, request, self._deposit_response)
+        finally:
+            self._invalidate(order_id)
 
-        # 3. processing reply
+    def _reverse_request(self, order_id: str, language: str='RU'):
+        url = self.urls['reverse']
+        request = dict(
+            # Номер заказа в платежной системе. Уникален в пределах системы.
+            orderId=order_id,
+            # Язык в кодировке ISO 639-1. Если не указан, считается, что язык – русский.
+            language=language
+        )
+        return url, request
+
+    @staticmethod
+    def _reverse_response(response):
         if 'errorCode' in response and response.get('errorCode') != '0':
-            raise SberRequestError('refund', response['errorCode'],
+            raise SberRequestError('reverse', response['errorCode'],
                                    response.get('errorMessage', 'Description not presented'))
         return response.get('errorMessage', 'OK')
+
+    def reverse(self, order_id: str, language: str='RU'):
+        """
+        Cancel payment of held order, held amount is released on user credit card
+        :param order_id: Sberbank order UID
+        :param language: Acquiring page language
+        :return: Sberbank status text
+        """
+        url, request = self._build('reverse', self._reverse_request, order_id, language)
+        self._invalidate(order_id)
+        try:
+            return self._call('reverse', url, request, self._reverse_response)
+        finally:
+            self._invalidate(order_id)
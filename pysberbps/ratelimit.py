@@ -0,0 +1,245 @@
+#coding=utf8
+# pysberbank client side rate limiting #
+"""
+Client side rate limiting of acquiring API calls
+
+    limiter = RateLimiter(register=(20, 5), status=(50, 10), refund=(5, 1))
+    wrapper = SberWrapper(username, password, limiter=limiter)
+
+    # batch job yields to interactive calls made with the same limiter
+    with priority(BATCH):
+        for result in wrapper.status_many(order_ids):
+            ...
+"""
+import contextlib
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+
+# priorities of waiting callers, lower goes first
+INTERACTIVE, NORMAL, BATCH = 0, 1, 2
+
+_priority = contextvars.ContextVar('sberbank_priority', default=NORMAL)
+
+
+@contextlib.contextmanager
+def priority(value: int):
+    """
+    Set priority of API calls made in the block by the current thread or coroutine
+    :param value: INTERACTIVE, NORMAL or BATCH
+    """
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket(object):
+    """
+    Token bucket: allows `rate` calls per second on average with bursts up to `burst` calls.
+    acquire() blocks the calling thread until a token is available. Instance is thread-safe
+    """
+    def __init__(self, rate: float, burst: int=None, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param rate: tokens added per second
+        :param burst: bucket capacity, rate rounded up if None
+        :param clock: time source, monotonic by default
+        :param sleep: function to wait with
+        """
+        self.rate = rate
+        self.burst = burst or max(1, int(rate + 0.999))
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = float(self.burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: int=1):
+        """
+        Take tokens if they are available
+        :return: 0 on success or seconds to wait till the tokens are available
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, method: str=None, tokens: int=1):
+        """
+        Wait for tokens and take them
+        :param method: API method name, ignored by the bucket
+        """
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            self.sleep(wait)
+
+    async def acquire_async(self, method: str=None, tokens: int=1):
+        """Coroutine version of acquire"""
+        import asyncio
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+class _Waiter(object):
+    __slots__ = ('priority', 'seq', 'wake')
+
+    def __init__(self, priority, seq, wake):
+        self.priority = priority
+        self.seq = seq
+        self.wake = wake
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _Family(object):
+    __slots__ = ('bucket', 'waiters', 'acquired', 'max_queued', 'waited')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.waiters = []
+        self.acquired = self.max_queued = 0
+        self.waited = 0.0
+
+
+class RateLimiter(object):
+    """
+    Token buckets per family of API methods. Callers waiting for a token are queued by priority
+    (see priority()), then by arrival. Works for threads (acquire) and coroutines (acquire_async)
+    sharing the same instance. Methods without configured family aren't limited
+    """
+    families = dict(register='register', status='status', status_ext='status', refund='refund',
+                    deposit='capture', reverse='capture')
+
+    def __init__(self, clock=time.monotonic, **limits):
+        """
+        :param clock: time source, monotonic by default
+        :param limits: family name -> (rate per second, burst)
+        """
+        self.clock = clock
+        self._families = {name: _Family(TokenBucket(rate, burst, clock=clock))
+                          for name, (rate, burst) in limits.items()}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def _family(self, method):
+        return self._families.get(self.families.get(method, method))
+
+    def _enqueue(self, family, wake):
+        """
+        Take token at once if nobody waits, or put waiter to the queue
+        :return: waiter or None if token is taken
+        """
+        with self._lock:
+            if not family.waiters and not family.bucket.try_acquire():
+                family.acquired += 1
+                return None
+            waiter = _Waiter(_priority.get(), next(self._seq), wake)
+            heapq.heappush(family.waiters, waiter)
+            family.max_queued = max(family.max_queued, len(family.waiters))
+            return waiter
+
+    def _try_take(self, family, waiter):
+        """
+        :return: 0 if token is taken, seconds to wait if waiter is first in the queue, None otherwise
+        """
+        with self._lock:
+            if family.waiters[0] is not waiter:
+                return None
+            wait = family.bucket.try_acquire()
+            if not wait:
+                heapq.heappop(family.waiters)
+                family.acquired += 1
+                if family.waiters:
+                    family.waiters[0].wake()
+            return wait
+
+    def _leave(self, family, waiter, waited):
+        with self._lock:
+            family.waited += waited
+            if waiter in family.waiters:
+                head = family.waiters[0] is waiter
+                family.waiters.remove(waiter)
+                heapq.heapify(family.waiters)
+                if head and family.waiters:
+                    family.waiters[0].wake()
+
+    def acquire(self, method: str):
+        """
+        Block the thread until the call of method is allowed
+        """
+        family = self._family(method)
+        if family is None:
+            return
+        event = threading.Event()
+        waiter = self._enqueue(family, event.set)
+        if waiter is None:
+            return
+        started = self.clock()
+        try:
+            while True:
+                event.clear()
+                wait = self._try_take(family, waiter)
+                if wait == 0:
+                    return
+                event.wait(wait)
+        finally:
+            self._leave(family, waiter, self.clock() - started)
+
+    async def acquire_async(self, method: str):
+        """
+        Wait until the call of method is allowed without blocking the event loop
+        """
+        family = self._family(method)
+        if family is None:
+            return
+        import asyncio
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = self._enqueue(family, lambda: loop.call_soon_threadsafe(event.set))
+        if waiter is None:
+            return
+        started = self.clock()
+        try:
+            while True:
+                event.clear()
+                wait = self._try_take(family, waiter)
+                if wait == 0:
+                    return
+                try:
+                    await asyncio.wait_for(event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._leave(family, waiter, self.clock() - started)
+
+    def queue_depth(self, method: str):
+        """
+        :return: number of callers waiting for the method family
+        """
+        family = self._family(method)
+        return len(family.waiters) if family is not None else 0
+
+    def stats(self):
+        """
+        :return: {family: dict(queued, max_queued, acquired, waited)}, waited is total wait time in seconds
+        """
+        with self._lock:
+            return {name: dict(queued=len(family.waiters), max_queued=family.max_queued,
+                               acquired=family.acquired, waited=family.waited)
+                    for name, family in self._families.items()}
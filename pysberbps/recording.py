@@ -0,0 +1,225 @@
+#coding=utf8
+# pysberbank record/replay transports #
+"""
+Recording of API traffic and its replay without the bank, e.g. for load tests
+
+    wrapper = SberWrapper(username, password, transport=RecordingTransport('traffic.sbr'))
+    ...
+    wrapper = SberWrapper(username, password, transport=ReplayTransport('traffic.sbr', latency=1.0))
+
+File is a magic header and append-only records: struct RECORD (request length, body length, HTTP status,
+latency in seconds), redacted request ('METHOD url\\n' and request body) and reply body.
+Credentials (userName and password params, SOAP Username and Password) are replaced with '***'
+before writing. Replies to the same request are replayed in recorded order, cyclically.
+"""
+import collections
+import mmap
+import re
+import struct
+import threading
+import time
+import urllib.parse
+from .transport import Response, Transport
+
+MAGIC = b'SBRR\x01\x00\x00\x00'
+RECORD = struct.Struct('<IIHf')
+
+SECRET_PARAMS = frozenset(('userName', 'password'))
+_SOAP_SECRETS = re.compile(rb'(<(?:\w+:)?(?:Username|Password)\b[^>]*>)[^<]*(<)')
+
+
+class ReplayMissError(LookupError):
+    """Request wasn't recorded"""
+
+
+def _redact_query(query, ignore=()):
+    params = [(name, '***' if name in SECRET_PARAMS else value)
+              for name, value in urllib.parse.parse_qsl(query, keep_blank_values=True) if name not in ignore]
+    return urllib.parse.urlencode(params, safe='*')
+
+
+def redact(method: str, url: str, body: bytes=None, ignore=()):
+    """
+    :param ignore: names of form params excluded from request, e.g. orderNumber
+    :return: request bytes without credentials
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.query:
+        url = urllib.parse.urlunsplit(parts._replace(query=_redact_query(parts.query, ignore)))
+    if body and body.lstrip().startswith(b'<'):
+        body = _SOAP_SECRETS.sub(rb'\1***\2', body)
+    elif body:
+        body = _redact_query(body.decode('utf-8'), ignore).encode('utf-8')
+    return '{0} {1}\n'.format(method, url).encode('utf-8') + (body or b'')
+
+
+class _Writer(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+            self._file.flush()
+        self._lock = threading.Lock()
+
+    def write(self, method, url, body, response, latency):
+        request = redact(method, url, body)
+        record = RECORD.pack(len(request), len(response.body), response.status, latency) + request + response.body
+        with self._lock:
+            self._file.write(record)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class RecordingTransport(Transport):
+    """
+    Sends requests through another transport and appends request/reply pairs to the file. Thread-safe
+    """
+    def __init__(self, path: str, transport=None):
+        """
+        :param path: file of records, new records are appended
+        :param transport: transport sending requests, PooledTransport if None
+        """
+        if transport is None:
+            from .transport import PooledTransport
+            transport = PooledTransport()
+        self.transport = transport
+        self._writer = _Writer(path)
+
+    def request(self, method: str, url: str, body: bytes=None, headers: dict=None, timeout=None, trace=None):
+        started = time.perf_counter()
+        response = self.transport.request(method, url, body, headers, timeout=timeout, trace=trace)
+        self._writer.write(method, url, body, response, time.perf_counter() - started)
+        return response
+
+    def prewarm(self, url: str, connections: int=1, timeout=None):
+        prewarm = getattr(self.transport, 'prewarm', None)
+        if prewarm is not None:
+            prewarm(url, connections, timeout)
+
+    def close(self):
+        self.transport.close()
+        self._writer.close()
+
+
+class AsyncRecordingTransport(RecordingTransport):
+    """RecordingTransport for AsyncSberWrapper"""
+    def __init__(self, path: str, transport=None):
+        """
+        :param transport: asyncio transport sending requests, aio.AsyncPooledTransport if None
+        """
+        if transport is None:
+            from .aio import AsyncPooledTransport
+            transport = AsyncPooledTransport()
+        super(AsyncRecordingTransport, self).__init__(path, transport)
+
+    async def request(self, method: str, url: str, body: bytes=None, headers: dict=None, timeout=None,
+                      trace=None):
+        started = time.perf_counter()
+        response = await self.transport.request(method, url, body, headers, timeout=timeout, trace=trace)
+        self._writer.write(method, url, body, response, time.perf_counter() - started)
+        return response
+
+    async def prewarm(self, url: str, connections: int=1, timeout=None):
+        prewarm = getattr(self.transport, 'prewarm', None)
+        if prewarm is not None:
+            await prewarm(url, connections, timeout)
+
+    async def close(self):
+        await self.transport.close()
+        self._writer.close()
+
+
+class ReplayTransport(Transport):
+    """
+    Serves recorded replies from memory-mapped file. Thread-safe
+    """
+    def __init__(self, path: str, latency: float=0.0, ignore=(), sleep=time.sleep):
+        """
+        :param path: file written by RecordingTransport
+        :param latency: recorded latency multiplier, replies are sent at once if 0
+        :param ignore: form params not matched, e.g. ('orderNumber',) to replay register with new order numbers
+        :param sleep: function to wait with
+        """
+        self.path = path
+        self.latency = latency
+        self.ignore = frozenset(ignore)
+        self.sleep = sleep
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self._map.close()
+            raise ValueError('{0} is not a recording'.format(path))
+        # request key -> list of (body offset, body length, status, latency)
+        self._replies = collections.defaultdict(list)
+        self._cursors = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        offset, size = len(MAGIC), len(self._map)
+        while offset + RECORD.size <= size:
+            request_length, body_length, status, latency = RECORD.unpack_from(self._map, offset)
+            offset += RECORD.size
+            if offset + request_length + body_length > size:
+                # record is being written or the writer crashed
+                break
+            request = self._map[offset:offset + request_length]
+            offset += request_length
+            self._replies[self._key(request)].append((offset, body_length, status, latency))
+            offset += body_length
+
+    def _key(self, request):
+        if not self.ignore:
+            return request
+        head, _, body = request.partition(b'\n')
+        method, url = head.decode('utf-8').split(' ', 1)
+        return redact(method, url, body, self.ignore)
+
+    def __len__(self):
+        return sum(len(replies) for replies in self._replies.values())
+
+    def _reply(self, method, url, body):
+        key = redact(method, url, body, self.ignore)
+        replies = self._replies.get(key)
+        if not replies:
+            raise ReplayMissError('{0} {1} was not recorded'.format(method, url))
+        with self._lock:
+            cursor = self._cursors.get(key, 0)
+            self._cursors[key] = (cursor + 1) % len(replies)
+        offset, length, status, latency = replies[cursor]
+        return Response(status, '', None, self._map[offset:offset + length]), latency * self.latency
+
+    def request(self, method: str, url: str, body: bytes=None, headers: dict=None, timeout=None, trace=None):
+        """
+        :raise ReplayMissError: if request wasn't recorded
+        """
+        response, delay = self._reply(method, url, body)
+        if delay:
+            self.sleep(delay)
+        return response
+
+    def close(self):
+        self._map.close()
+
+
+class AsyncReplayTransport(ReplayTransport):
+    """ReplayTransport for AsyncSberWrapper, latency is emulated with asyncio.sleep"""
+
+    async def request(self, method: str, url: str, body: bytes=None, headers: dict=None, timeout=None,
+                      trace=None):
+        import asyncio
+        response, delay = self._reply(method, url, body)
+        if delay:
+            await asyncio.sleep(delay)
+        return response
+
+    async def prewarm(self, url: str, connections: int=1, timeout=None):
+        pass
+
+    async def close(self):
+        self._map.close()
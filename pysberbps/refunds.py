@@ -0,0 +1,178 @@
+#coding=utf8
+# pysberbank batch refunds #
+"""
+Mass refunds with a local journal of attempts
+
+    with RefundJournal('refunds.sqlite') as journal, open('refunds.csv') as f:
+        for result in BatchRefund(wrapper, journal).run(read_csv(f)):
+            if result.error is not None:
+                print(result.key, result.error)
+
+Every attempt is appended to the journal before the request is sent and after the reply is received.
+Started again with the same journal, the batch skips refunded orders and checks orders with unknown
+outcome (crash or network error during the request) with status_ext before sending refund again.
+Refunded amount of the order is journaled before every attempt, the attempt is verified if the bank
+reports at least its amount refunded above that baseline. The check asks the bank directly,
+replies cached or stored by the wrapper may be older than the refund.
+"""
+import collections
+import csv
+import sqlite3
+import threading
+import time
+from .batch import imap_unordered
+from .pysberbps import SberWrapper, SberNetworkError, SberRequestError
+
+STARTED, DONE, FAILED, UNCERTAIN = 'started', 'done', 'failed', 'uncertain'
+
+RefundStats = collections.namedtuple('RefundStats', 'done verified skipped failed uncertain')
+
+
+def read_csv(stream, header: bool=True, delimiter: str=','):
+    """
+    Read (order_id, amount) rows lazily from CSV stream, first two columns are used
+    :param stream: file object opened in text mode
+    :param header: skip the first line
+    """
+    reader = csv.reader(stream, delimiter=delimiter)
+    if header:
+        next(reader, None)
+    for row in reader:
+        if row:
+            yield row[0].strip(), int(row[1])
+
+
+class RefundJournal(object):
+    """
+    Append-only SQLite journal of refund attempts. State of order is the state of its last attempt.
+    Uses WAL mode, records survive crash of the process
+    """
+    def __init__(self, path: str):
+        """
+        :param path: database file, ':memory:' for a temporary journal
+        """
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS attempts (id INTEGER PRIMARY KEY, order_id TEXT NOT NULL, '
+                         'amount INTEGER NOT NULL, state TEXT NOT NULL, detail TEXT, created REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS attempts_order ON attempts (order_id, id)')
+        if 'refunded' not in [row[1] for row in self._db.execute('PRAGMA table_info(attempts)')]:
+            # journal created by older version
+            self._db.execute('ALTER TABLE attempts ADD COLUMN refunded INTEGER')
+        self._lock = threading.Lock()
+
+    def record(self, order_id: str, amount: int, state: str, detail: str=None, refunded: int=None):
+        """
+        :param refunded: amount refunded by the bank before the attempt, recorded with STARTED state
+        """
+        with self._lock:
+            self._db.execute('INSERT INTO attempts (order_id, amount, state, detail, created, refunded) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (order_id, amount, state, detail, time.time(), refunded))
+
+    def state(self, order_id: str):
+        """
+        :return: state of the last attempt or None if order wasn't refunded by the journal
+        """
+        with self._lock:
+            row = self._db.execute('SELECT state FROM attempts WHERE order_id = ? ORDER BY id DESC LIMIT 1',
+                                   (order_id,)).fetchone()
+        return row[0] if row else None
+
+    def baseline(self, order_id: str):
+        """
+        :return: amount refunded before the last started attempt, None if it isn't known
+        """
+        with self._lock:
+            row = self._db.execute('SELECT refunded FROM attempts WHERE order_id = ? AND state = ? '
+                                   'ORDER BY id DESC LIMIT 1', (order_id, STARTED)).fetchone()
+        return row[0] if row else None
+
+    def history(self, order_id: str):
+        """
+        :return: list of (amount, state, detail, created) of the order attempts
+        """
+        with self._lock:
+            return self._db.execute('SELECT amount, state, detail, created FROM attempts WHERE order_id = ? '
+                                    'ORDER BY id', (order_id,)).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class BatchRefund(object):
+    """
+    Refund pipeline: rows are read lazily and refunded by `concurrency` threads, so memory doesn't depend
+    on the number of rows. Expects one row per order, order already refunded by the journal is skipped
+    """
+    def __init__(self, wrapper: SberWrapper, journal: RefundJournal, concurrency: int=8, language: str='RU'):
+        """
+        :param wrapper: SberWrapper used for refund and status_ext calls
+        :param journal: RefundJournal or path to journal file
+        :param concurrency: number of simultaneous requests
+        """
+        self.wrapper = wrapper
+        self.journal = RefundJournal(journal) if isinstance(journal, str) else journal
+        self.concurrency = concurrency
+        self.language = language
+        self.stats = RefundStats(0, 0, 0, 0, 0)
+
+    def _refunded(self, order_id):
+        """
+        :return: amount refunded by the bank, asked directly. Reply dict is read, so typed wrappers work too
+        """
+        response = self.wrapper._status_reply('status_ext', order_id, self.language, fresh=True)
+        return int((response.get('paymentAmountInfo') or {}).get('refundedAmount') or 0)
+
+    def _refund(self, row):
+        order_id, amount = row
+        refunded = self._refunded(order_id)
+        if self.journal.state(order_id) in (STARTED, UNCERTAIN):
+            # outcome of the previous attempt is unknown, don't refund twice. Earlier refunds of the order
+            # are in the baseline, journals of older versions have none
+            if refunded - (self.journal.baseline(order_id) or 0) >= amount:
+                self.journal.record(order_id, amount, DONE, 'verified')
+                return 'verified'
+        self.journal.record(order_id, amount, STARTED, refunded=refunded)
+        try:
+            message = self.wrapper.refund(order_id, amount, self.language)
+        except SberRequestError as e:
+            self.journal.record(order_id, amount, FAILED, '{0}: {1}'.format(e.code, e.desc))
+            raise
+        except SberNetworkError:
+            self.journal.record(order_id, amount, UNCERTAIN, 'network error')
+            raise
+        self.journal.record(order_id, amount, DONE, message)
+        return message
+
+    def _pending(self, rows):
+        for order_id, amount in rows:
+            if self.journal.state(order_id) == DONE:
+                self.stats = self.stats._replace(skipped=self.stats.skipped + 1)
+                continue
+            yield order_id, amount
+
+    def run(self, rows):
+        """
+        Refund orders, yield batch.BatchResult((order_id, amount), message, error) in completion order.
+        Refunded orders aren't yielded, they are counted in stats.skipped
+        :param rows: iterable of (order_id, amount), see read_csv
+        """
+        self.stats = RefundStats(0, 0, 0, 0, 0)
+        for result in imap_unordered(self._refund, self._pending(rows), self.concurrency):
+            if result.error is None:
+                field = 'verified' if result.result == 'verified' else 'done'
+            elif isinstance(result.error, SberRequestError):
+                field = 'failed'
+            else:
+                field = 'uncertain'
+            self.stats = self.stats._replace(**{field: getattr(self.stats, field) + 1})
+            yield result
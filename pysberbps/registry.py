@@ -0,0 +1,114 @@
+#coding=utf8
+# pysberbank multi-merchant client registry #
+import collections
+import threading
+from .pysberbps import SberWrapper
+from .ratelimit import TokenBucket
+from .transport import PooledTransport, DNSCache
+
+Merchant = collections.namedtuple('Merchant', 'username password test_env rate burst')
+
+
+class SberClientPool(object):
+    """
+    Registry of SberWrapper clients for many store accounts. Clients are created on first use,
+    all clients of the same environment (test or production) share one connection pool and DNS cache,
+    so socket count doesn't grow with the number of merchants
+
+        pool = SberClientPool(retry=RetryPolicy())
+        pool.add('store-1', username, password, rate=10)
+        pool['store-1'].status(order_id)
+    """
+    # SberWrapper arguments set by the pool for every client
+    reserved = ('username', 'password', 'test_env', 'transport', 'limiter')
+
+    def __init__(self, test_env: bool=True, maxsize: int=10, dns_ttl: float=300.0, transport_factory=None,
+                 **options):
+        """
+        :param test_env: default environment of merchants
+        :param maxsize: idle connections kept per host in every environment pool
+        :param dns_ttl: lifetime of resolved addresses, seconds
+        :param transport_factory: callable(resolver) creating shared transport, PooledTransport if None
+        :param options: other SberWrapper keyword arguments (cache, retry, breaker, metrics, ...)
+        :raise TypeError: if options has arguments set by the pool: credentials, test_env, transport or limiter
+        """
+        reserved = sorted(set(options) & set(self.reserved))
+        if reserved:
+            raise TypeError('{0} of clients are set by SberClientPool, use add() arguments and transport_factory '
+                            'instead of options {1}'.format(', '.join(self.reserved), ', '.join(reserved)))
+        self.test_env = test_env
+        self.maxsize = maxsize
+        self.resolver = DNSCache(dns_ttl)
+        self.transport_factory = transport_factory or (lambda resolver: PooledTransport(maxsize, resolver=resolver))
+        self.options = options
+        self._merchants = {}
+        self._clients = {}
+        self._transports = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, username: str, password: str, test_env: bool=None, rate: float=None,
+            burst: int=None):
+        """
+        Register merchant credentials
+        :param name: merchant key in the registry
+        :param test_env: merchant environment, pool default if None
+        :param rate: allowed requests per second for the merchant, unlimited if None
+        :param burst: allowed burst of requests, see ratelimit.TokenBucket
+        """
+        merchant = Merchant(username, password, self.test_env if test_env is None else test_env, rate, burst)
+        with self._lock:
+            self._merchants[name] = merchant
+            # credentials may be changed, client will be created again
+            self._clients.pop(name, None)
+
+    def remove(self, name: str):
+        with self._lock:
+            del self._merchants[name]
+            self._clients.pop(name, None)
+
+    def transport(self, test_env: bool):
+        """
+        :return: shared transport of the environment
+        """
+        with self._lock:
+            return self._transport(test_env)
+
+    def _transport(self, test_env):
+        transport = self._transports.get(test_env)
+        if transport is None:
+            transport = self._transports[test_env] = self.transport_factory(self.resolver)
+        return transport
+
+    def get(self, name: str):
+        """
+        :return: SberWrapper of the merchant
+        :raise KeyError: if merchant isn't registered
+        """
+        client = self._clients.get(name)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(name)
+            if client is None:
+                merchant = self._merchants[name]
+                limiter = TokenBucket(merchant.rate, merchant.burst) if merchant.rate else None
+                client = self._clients[name] = SberWrapper(
+                    merchant.username, merchant.password, test_env=merchant.test_env,
+                    transport=self._transport(merchant.test_env), limiter=limiter, **self.options)
+            return client
+
+    __getitem__ = get
+
+    def __contains__(self, name):
+        return name in self._merchants
+
+    def __len__(self):
+        return len(self._merchants)
+
+    def close(self):
+        """Close connections of all environments"""
+        with self._lock:
+            transports, self._transports = list(self._transports.values()), {}
+            self._clients.clear()
+        for transport in transports:
+            transport.close()
@@ -0,0 +1,113 @@
+#coding=utf8
+# pysberbank retry and circuit breaker policies #
+import collections
+import logging
+import random
+import threading
+import time
+from .pysberbps import SberCircuitOpenError
+logger = logging.getLogger(__name__)
+
+Timeout = collections.namedtuple('Timeout', 'connect read')
+Timeout.__doc__ = """Socket timeouts in seconds: for establishing connection and for waiting the reply"""
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter. Used only for idempotent calls (status, status_ext)
+    and only on SberNetworkError
+    """
+    def __init__(self, attempts: int=3, backoff: float=0.1, max_backoff: float=2.0, jitter: bool=True):
+        """
+        :param attempts: total number of attempts including the first one
+        :param backoff: delay before the first retry, seconds. Doubles on every next retry
+        :param max_backoff: upper bound of the delay, seconds
+        :param jitter: randomize delay in [0, delay] to spread retries of many clients
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def delays(self):
+        """
+        :return: iterator of delays before every retry
+        """
+        for attempt in range(self.attempts - 1):
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+            yield random.uniform(0, delay) if self.jitter else delay
+
+
+class CircuitBreaker(object):
+    """
+    Fails calls fast with SberCircuitOpenError when the share of network errors among the last
+    `window` calls exceeds `failure_rate`. After `cooldown` seconds one trial call is let through
+    (half-open state): its success closes the circuit, its failure opens it again.
+    Instance is thread-safe and may be shared between wrappers talking to the same host.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_rate: float=0.5, window: int=20, min_calls: int=10, cooldown: float=30.0,
+                 clock=time.monotonic):
+        """
+        :param failure_rate: share of failed calls in the window which opens the circuit
+        :param window: number of last calls to take into account
+        :param min_calls: don't open the circuit until this number of calls is recorded
+        :param cooldown: seconds to stay open before the trial call
+        :param clock: time source, monotonic by default
+        """
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = self.CLOSED
+        self._calls = collections.deque(maxlen=window)
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        :raise SberCircuitOpenError: if the call must not be done
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and self.clock() - self._opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self._trial = False
+            if self.state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+        raise SberCircuitOpenError('Circuit is open, request is not sent')
+
+    def record(self, success: bool):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if success:
+                    logger.info('Circuit is closed')
+                    self.state = self.CLOSED
+                    self._calls.clear()
+                else:
+                    self._open()
+                return
+            self._calls.append(success)
+            failures = self._calls.count(False)
+            if (self.state == self.CLOSED and len(self._calls) >= self.min_calls
+                    and failures > self.failure_rate * len(self._calls)):
+                self._open()
+
+    def cancel(self):
+        """
+        Call let through by before_call ended without result, e.g. it was cancelled:
+        the trial call slot of half-open circuit is given to the next call
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial = False
+
+    def _open(self):
+        logger.warning('Circuit is opened for %s seconds', self.cooldown)
+        self.state = self.OPEN
+        self._opened_at = self.clock()
+        self._calls.clear()
@@ -0,0 +1,92 @@
+#coding=utf8
+# pysberbank reply decoding and typed replies #
+import json
+from .pysberbps import SberWrapper
+
+
+def json_loads(body: bytes):
+    """stdlib decoder, explicit decode is faster than json.loads detecting bytes encoding"""
+    return json.loads(body.decode('utf-8'))
+
+
+def default_decoder():
+    """
+    :return: the fastest installed JSON decoder accepting bytes: orjson, ujson or stdlib json
+    """
+    try:
+        import orjson
+        return orjson.loads
+    except ImportError:
+        pass
+    try:
+        import ujson
+        return ujson.loads
+    except ImportError:
+        return json_loads
+
+
+class CardAuthInfo(object):
+    """Card used for payment"""
+    __slots__ = ('pan', 'expiration', 'cardholder_name', 'approval_code')
+
+    def __init__(self, pan: str=None, expiration: str=None, cardholder_name: str=None, approval_code: str=None):
+        self.pan = pan
+        self.expiration = expiration
+        self.cardholder_name = cardholder_name
+        self.approval_code = approval_code
+
+    def __repr__(self):
+        return 'CardAuthInfo(pan={0.pan!r}, expiration={0.expiration!r})'.format(self)
+
+
+class OrderStatusInfo(object):
+    """
+    Compact typed status/status_ext reply. Keeps only the fields below, so it is several times smaller
+    than the reply dict when many statuses are held in memory
+    """
+    __slots__ = ('order_number', 'status', 'amount', 'currency', 'error_code', 'error_message', 'date', 'card')
+
+    def __init__(self, order_number: str=None, status: SberWrapper.OrderStatus=None, amount: int=None,
+                 currency: str=None, error_code: str=None, error_message: str=None, date: int=None,
+                 card: CardAuthInfo=None):
+        self.order_number = order_number
+        self.status = status
+        self.amount = amount
+        self.currency = currency
+        self.error_code = error_code
+        self.error_message = error_message
+        self.date = date
+        self.card = card
+
+    @staticmethod
+    def _status(value):
+        try:
+            return SberWrapper.OrderStatus(int(value))
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def from_status(cls, payload: dict):
+        """Build from getOrderStatus.do reply"""
+        card = None
+        if 'Pan' in payload:
+            card = CardAuthInfo(payload['Pan'], payload.get('expiration'), payload.get('cardholderName'),
+                                payload.get('approvalCode'))
+        return cls(payload.get('OrderNumber'), cls._status(payload.get('OrderStatus')), payload.get('Amount'),
+                   payload.get('currency'), payload.get('ErrorCode'), payload.get('ErrorMessage'), None, card)
+
+    @classmethod
+    def from_status_ext(cls, payload: dict):
+        """Build from getOrderStatusExtended.do reply"""
+        card = None
+        auth = payload.get('cardAuthInfo')
+        if auth:
+            card = CardAuthInfo(auth.get('pan'), auth.get('expiration'), auth.get('cardholderName'),
+                                auth.get('approvalCode'))
+        return cls(payload.get('orderNumber'), cls._status(payload.get('orderStatus')), payload.get('amount'),
+                   payload.get('currency'), payload.get('errorCode'), payload.get('errorMessage'),
+                   payload.get('date'), card)
+
+    def __repr__(self):
+        return 'OrderStatusInfo(order_number={0.order_number!r}, status={0.status}, amount={0.amount!r})'.format(
+            self)
@@ -0,0 +1,403 @@
+#coding=utf8
+# pysberbank local REST stub #
+"""
+Local simulator of Sberbank acquiring REST and SOAP API. It's used by tests and benchmarks,
+so they don't need credentials and network access to 3dsec.sberbank.ru
+
+    with SberSimulator() as sim:
+        wrapper = SberWrapper('user', 'pass', urls=sim.urls)
+        soap_wrapper = SberWrapper('user', 'pass', soap=True, wsdl=sim.wsdl_url)
+
+It can be started as a separate process as well:
+
+    python -m pysberbps.simulator --port 8080 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import collections
+import http.server
+import json
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+SOAP_NAMESPACE = 'http://engine.paymentgate.ru/webservices/merchant'
+
+_WSDL = '''<?xml version="1.0" encoding="UTF-8"?>
+<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+    xmlns:tns="{namespace}" name="MerchantServiceImplService" targetNamespace="{namespace}">
+  <wsdl:portType name="MerchantService">{port_operations}
+  </wsdl:portType>
+  <wsdl:binding name="MerchantServiceImplServiceSoapBinding" type="tns:MerchantService">
+    <soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>{binding_operations}
+  </wsdl:binding>
+  <wsdl:service name="MerchantServiceImplService">
+    <wsdl:port binding="tns:MerchantServiceImplServiceSoapBinding" name="MerchantServiceImplPort">
+      <soap:address location="{location}"/>
+    </wsdl:port>
+  </wsdl:service>
+</wsdl:definitions>
+'''
+
+# SOAP operation -> REST endpoint
+_SOAP_OPERATIONS = dict(registerOrder='register', registerOrderPreAuth='registerPreAuth',
+                        getOrderStatus='getOrderStatus', getOrderStatusExtended='getOrderStatusExtended',
+                        refundOrder='refund', depositOrder='deposit', reverseOrder='reverse')
+# <order> attribute -> REST param
+_SOAP_PARAMS = dict(merchantOrderNumber='orderNumber', refundAmount='amount', depositAmount='amount')
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self):
+        parts = urllib.parse.urlsplit(self.path)
+        data = b''
+        if self.command == 'POST':
+            data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        simulator = self.server.simulator
+        simulator.count(parts.path)
+        status, delay, reset = simulator.next_fault()
+        delay += simulator.delay()
+        if delay:
+            time.sleep(delay)
+        if reset == 'request':
+            # connection is closed before any byte of the reply, request isn't processed
+            self.close_connection = True
+            return
+        content_type = 'application/json;charset=utf-8'
+        if status is not None:
+            body = b'Injected fault'
+        elif parts.path.endswith('/merchant-ws'):
+            status, body = simulator.handle_soap(parts.query, data)
+            content_type = 'text/xml;charset=utf-8'
+        else:
+            query = data.decode('utf-8') if self.command == 'POST' else parts.query
+            reply = simulator.handle(parts.path.rsplit('/', 1)[-1], dict(urllib.parse.parse_qsl(query)))
+            if reply is None:
+                status, body = 404, b'Not found'
+            else:
+                status, body = 200, json.dumps(reply).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if reset == 'reply':
+            # request is processed, connection is reset in the middle of the reply body
+            self.wfile.write(body[:len(body) // 2])
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.connection.close()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    do_GET = do_POST = _dispatch
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # clients drop connections on timeouts, it isn't an error of the simulator
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super(_Server, self).handle_error(request, client_address)
+
+
+class SberSimulator(object):
+    """
+    In-memory acquiring server on 127.0.0.1 with register.do, registerPreAuth.do, getOrderStatus.do,
+    getOrderStatusExtended.do, refund.do, deposit.do and reverse.do endpoints and the same operations
+    of merchant-ws SOAP service
+    """
+    def __init__(self, host: str='127.0.0.1', port: int=0, ssl_context=None, latency: float=0.0,
+                 jitter: float=0.0, error_rate: float=0.0, error_status: int=500):
+        """
+        :param host: interface to listen on
+        :param port: port to listen on, random free port if 0
+        :param ssl_context: server side ssl.SSLContext to serve https
+        :param latency: delay in seconds before every reply
+        :param jitter: random extra delay in [0, jitter] seconds
+        :param error_rate: probability of replying with error_status instead of processing request
+        :param error_status: HTTP status of random errors
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._server = _Server((host, port), _Handler)
+        if ssl_context is not None:
+            self._server.socket = ssl_context.wrap_socket(self._server.socket, server_side=True)
+        self._scheme = 'https' if ssl_context is not None else 'http'
+        self._server.simulator = self
+        self._thread = None
+        self._lock = threading.Lock()
+        self.orders = {}
+        self.requests = {}
+        self._faults = collections.deque()
+        self._numbers = set()
+
+    @property
+    def base_url(self):
+        return '{0}://{1}:{2}/payment/rest/'.format(self._scheme, *self._server.server_address)
+
+    @property
+    def urls(self):
+        return dict(
+            register=self.base_url + 'register.do',
+            registerPreAuth=self.base_url + 'registerPreAuth.do',
+            status=self.base_url + 'getOrderStatus.do',
+            status_ext=self.base_url + 'getOrderStatusExtended.do',
+            refund=self.base_url + 'refund.do',
+            deposit=self.base_url + 'deposit.do',
+            reverse=self.base_url + 'reverse.do',
+        )
+
+    @property
+    def soap_url(self):
+        return '{0}://{1}:{2}/payment/webservices/merchant-ws'.format(self._scheme, *self._server.server_address)
+
+    @property
+    def wsdl_url(self):
+        return self.soap_url + '?wsdl'
+
+    def wsdl(self):
+        """
+        :return: WSDL document of the SOAP service, operations only, without schema of messages
+        """
+        port = binding = ''
+        for operation in _SOAP_OPERATIONS:
+            port += '\n    <wsdl:operation name="{0}"/>'.format(operation)
+            binding += ('\n    <wsdl:operation name="{0}"><soap:operation soapAction=""/>'
+                        '<wsdl:input><soap:body use="literal"/></wsdl:input>'
+                        '<wsdl:output><soap:body use="literal"/></wsdl:output></wsdl:operation>').format(operation)
+        return _WSDL.format(namespace=SOAP_NAMESPACE, port_operations=port, binding_operations=binding,
+                            location=self.soap_url)
+
+    def handle_soap(self, query, data):
+        """
+        :return: (HTTP status, body) of SOAP reply or WSDL
+        """
+        if not data:
+            return (200, self.wsdl().encode('utf-8')) if query == 'wsdl' else (404, b'Not found')
+        try:
+            envelope = ElementTree.fromstring(data)
+            request = envelope.find('{http://schemas.xmlsoap.org/soap/envelope/}Body')[0]
+            operation = request.tag.rsplit('}', 1)[-1]
+            order = request[0]
+        except (ElementTree.ParseError, TypeError, IndexError):
+            return 500, self._soap_fault('soap:Client', 'Malformed request')
+        if operation not in _SOAP_OPERATIONS:
+            return 500, self._soap_fault('soap:Client', 'Unknown operation ' + operation)
+
+        params = {_SOAP_PARAMS.get(name, name): value for name, value in order.attrib.items()}
+        extra = {}
+        for child in order:
+            if child.tag == 'params':
+                extra[child.get('name')] = child.get('value')
+            else:
+                params[child.tag] = child.text
+        if extra:
+            params['jsonParams'] = json.dumps(extra)
+        for element in envelope.iter():
+            name = element.tag.rsplit('}', 1)[-1]
+            if name == 'Username':
+                params['userName'] = element.text
+            elif name == 'Password':
+                params['password'] = element.text
+
+        reply = self.handle(_SOAP_OPERATIONS[operation], params)
+        attributes, children = [], []
+        for name, value in reply.items():
+            if isinstance(value, dict):
+                children.append('<{0}{1}/>'.format(name, ''.join(' {0}={1}'.format(key, quoteattr(str(item)))
+                                                                  for key, item in value.items())))
+            elif name == 'formUrl':
+                children.append('<formUrl>{0}</formUrl>'.format(escape(value)))
+            else:
+                attributes.append(' {0}={1}'.format(name[0].lower() + name[1:], quoteattr(str(value))))
+        body = ('<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>'
+                '<ns1:{0}Response xmlns:ns1="{1}"><return{2}>{3}</return></ns1:{0}Response>'
+                '</soap:Body></soap:Envelope>').format(operation, SOAP_NAMESPACE, ''.join(attributes),
+                                                       ''.join(children))
+        return 200, body.encode('utf-8')
+
+    @staticmethod
+    def _soap_fault(code, message):
+        return ('<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body><soap:Fault>'
+                '<faultcode>{0}</faultcode><faultstring>{1}</faultstring></soap:Fault></soap:Body>'
+                '</soap:Envelope>').format(code, escape(message)).encode('utf-8')
+
+    def count(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def handle(self, endpoint, params):
+        if params.get('userName') is None or params.get('password') is None:
+            return dict(errorCode='5', errorMessage='Access denied')
+        handler = getattr(self, '_' + endpoint.replace('.do', ''), None)
+        return handler(params) if handler else None
+
+    def _register(self, params, pre_auth=False):
+        if not params.get('orderNumber') or not str(params.get('amount', '')).isdigit():
+            return dict(errorCode='4', errorMessage='Order number or amount is empty')
+        order_id = str(uuid.uuid4())
+        with self._lock:
+            if params['orderNumber'] in self._numbers:
+                return dict(errorCode='1', errorMessage='Order with this number was already processed')
+            self._numbers.add(params['orderNumber'])
+            self.orders[order_id] = dict(orderNumber=params['orderNumber'], amount=int(params['amount']),
+                                         currency=params.get('currency', '643'), status=0, deposited=0, refunded=0,
+                                         pre_auth=pre_auth, date=int(time.time() * 1000))
+        return dict(orderId=order_id, formUrl='https://3dsec.sberbank.ru/payment/merchants/test/'
+                                              'payment_ru.html?mdOrder=' + order_id)
+
+    def _registerPreAuth(self, params):
+        return self._register(params, pre_auth=True)
+
+    def _getOrderStatus(self, params):
+        order = self.orders.get(params.get('orderId'))
+        if order is None:
+            return dict(ErrorCode='6', ErrorMessage='Unknown order')
+        reply = dict(OrderNumber=order['orderNumber'], OrderStatus=order['status'], Amount=order['amount'],
+                     currency=order['currency'], Ip='127.0.0.1', ErrorCode='2' if order['status'] == 6 else '0',
+                     ErrorMessage='Success')
+        if order['status'] in (1, 2, 3, 4):
+            reply.update(Pan='411111**1111', expiration='201912', cardholderName='KENNY MCCORMICK',
+                         approvalCode='123456')
+        return reply
+
+    def _getOrderStatusExtended(self, params):
+        order = self.orders.get(params.get('orderId'))
+        if order is None:
+            return dict(errorCode='6', errorMessage='Unknown order')
+        reply = dict(orderNumber=order['orderNumber'], orderStatus=order['status'], amount=order['amount'],
+                     currency=order['currency'], ip='127.0.0.1', date=order['date'], errorCode='0',
+                     errorMessage='Success',
+                     paymentAmountInfo=dict(approvedAmount=order['amount'], depositedAmount=order['deposited'],
+                                            refundedAmount=order['refunded']))
+        if order['status'] in (1, 2, 3, 4):
+            reply['cardAuthInfo'] = dict(pan='411111**1111', expiration='201912', cardholderName='KENNY MCCORMICK',
+                                         approvalCode='123456')
+        return reply
+
+    def _refund(self, params):
+        with self._lock:
+            order = self.orders.get(params.get('orderId'))
+            if order is None or order['status'] not in (2, 4):
+                return dict(errorCode='7', errorMessage='Payment must be in a correct state')
+            order['refunded'] += int(params['amount'])
+            if order['refunded'] >= order['amount']:
+                order['status'] = 4
+        return dict(errorCode='0', errorMessage='Success')
+
+    def _deposit(self, params):
+        with self._lock:
+            order = self.orders.get(params.get('orderId'))
+            if order is None or order['status'] != 1:
+                return dict(errorCode='7', errorMessage='Payment must be in a correct state')
+            amount = int(params.get('amount') or 0) or order['amount']
+            if amount > order['amount']:
+                return dict(errorCode='6', errorMessage='Deposit amount exceeds approved amount')
+            order['deposited'] = amount
+            order['status'] = 2
+        return dict(errorCode='0', errorMessage='Success')
+
+    def _reverse(self, params):
+        with self._lock:
+            order = self.orders.get(params.get('orderId'))
+            if order is None or order['status'] != 1:
+                return dict(errorCode='7', errorMessage='Payment must be in a correct state')
+            order['status'] = 3
+        return dict(errorCode='0', errorMessage='Success')
+
+    def fail(self, count: int=1, status: int=503, delay: float=0.0, reset: str=None):
+        """
+        Inject faults into the next `count` requests
+        :param status: reply with this HTTP status, reply normally if None
+        :param delay: extra delay before reply, seconds
+        :param reset: 'request' to close connection without reply and processing of request,
+                      'reply' to process request and reset connection in the middle of reply body
+        """
+        with self._lock:
+            self._faults.extend([(status, delay, reset)] * count)
+
+    def next_fault(self):
+        """
+        :return: (status, delay, reset) of the fault for the current request, (None, 0, None) if there is no fault
+        """
+        with self._lock:
+            if self._faults:
+                return self._faults.popleft()
+        if self.error_rate and random.random() < self.error_rate:
+            return self.error_status, 0.0, None
+        return None, 0.0, None
+
+    def delay(self):
+        """
+        :return: delay of the current reply, seconds
+        """
+        return self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def pay(self, order_id: str):
+        """Emulate successful payment of the order by user, pre-auth orders become held"""
+        with self._lock:
+            order = self.orders[order_id]
+            order['status'] = 1 if order['pre_auth'] else 2
+            if not order['pre_auth']:
+                order['deposited'] = order['amount']
+
+    def decline(self, order_id: str):
+        """Emulate declined payment of the order"""
+        with self._lock:
+            self.orders[order_id]['status'] = 6
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local simulator of Sberbank acquiring REST API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='delay before every reply, seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra delay, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of HTTP 500 reply')
+    args = parser.parse_args()
+
+    simulator = SberSimulator(args.host, args.port, latency=args.latency, jitter=args.jitter,
+                              error_rate=args.error_rate)
+    # first line of output is base url, so the simulator may be started from scripts with port 0
+    print(simulator.base_url, flush=True)
+    try:
+        simulator._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator._server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#coding=utf8
+# pysberbank request coalescing #
+import threading
+
+
+class _Call(object):
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = self.error = None
+
+
+class SingleFlight(object):
+    """
+    Deduplicates concurrent calls with the same key: while the first call is in flight,
+    other threads wait for it and get the same result or exception
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """
+        Call func() unless a call with the same key is already in flight
+        :param key: hashable call identifier
+        :param func: callable without arguments
+        :return: func() result
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
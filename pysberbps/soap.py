@@ -0,0 +1,231 @@
+#coding=utf8
+# pysberbank SOAP (merchant-ws) protocol #
+"""
+SOAP flavour of acquiring API used by SberWrapper(soap=True)
+
+WSDL is parsed once per process and compiled to a small service description: endpoint, SOAPAction
+and envelope templates of every operation. It is kept in memory and in the cache directory
+(~/.cache/pysberbps), so later processes don't download and parse the WSDL again.
+Remove the cache file to refresh it after the service definition is changed.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import urllib.request
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import escape, quoteattr
+from .pysberbps import SberRequestError
+
+WSDL = 'http://schemas.xmlsoap.org/wsdl/'
+WSDL_SOAP = 'http://schemas.xmlsoap.org/wsdl/soap/'
+ENVELOPE = 'http://schemas.xmlsoap.org/soap/envelope/'
+WSSE = 'http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd'
+PASSWORD_TEXT = ('http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-username-token-profile-1.0'
+                 '#PasswordText')
+
+# bump when format of compiled service is changed
+VERSION = 1
+
+# REST request field -> attribute of <order> element
+_ATTRIBUTES = dict(orderNumber='merchantOrderNumber')
+_OPERATION_ATTRIBUTES = dict(refundOrder=dict(amount='refundAmount'), depositOrder=dict(amount='depositAmount'))
+# REST request fields sent as child elements of <order>
+_CHILDREN = ('returnUrl', 'failUrl')
+# reply fields which are numbers in REST replies
+_NUMBERS = frozenset(('orderStatus', 'amount', 'date', 'actionCode', 'approvedAmount', 'depositedAmount',
+                      'refundedAmount'))
+# reply elements which may be repeated
+_LISTS = frozenset(('attributes', 'merchantOrderParams', 'params'))
+# getOrderStatus.do REST reply has capitalized names of these fields
+_STATUS_NAMES = dict(orderStatus='OrderStatus', errorCode='ErrorCode', errorMessage='ErrorMessage',
+                     orderNumber='OrderNumber', pan='Pan', amount='Amount', ip='Ip')
+
+_services = {}
+_lock = threading.Lock()
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pysberbps')
+
+
+def compile_operation(namespace: str, operation: str, action: str):
+    """
+    :return: dict(action, prefix, suffix), prefix has {username} and {password} placeholders
+    """
+    prefix = ('<?xml version="1.0" encoding="UTF-8"?>'
+              '<soapenv:Envelope xmlns:soapenv="{0}" xmlns:mer="{1}"><soapenv:Header>'
+              '<wsse:Security xmlns:wsse="{2}" soapenv:mustUnderstand="1"><wsse:UsernameToken>'
+              '<wsse:Username>{{username}}</wsse:Username><wsse:Password Type="{3}">{{password}}</wsse:Password>'
+              '</wsse:UsernameToken></wsse:Security></soapenv:Header><soapenv:Body><mer:{4}>').format(
+        ENVELOPE, namespace, WSSE, PASSWORD_TEXT, operation)
+    suffix = '</mer:{0}></soapenv:Body></soapenv:Envelope>'.format(operation)
+    return dict(action=action, prefix=prefix, suffix=suffix)
+
+
+def parse_wsdl(data: bytes):
+    """
+    Compile service description from WSDL document
+    :return: dict(version, endpoint, operations={name: dict(action, prefix, suffix)})
+    """
+    root = ElementTree.fromstring(data)
+    namespace = root.get('targetNamespace')
+    address = root.find('{0}service/{0}port/{1}address'.format('{%s}' % WSDL, '{%s}' % WSDL_SOAP))
+    if address is None:
+        raise ValueError('WSDL has no SOAP service address')
+    operations = {}
+    for operation in root.iterfind('{0}binding/{0}operation'.format('{%s}' % WSDL)):
+        soap_operation = operation.find('{%s}operation' % WSDL_SOAP)
+        action = soap_operation.get('soapAction', '') if soap_operation is not None else ''
+        operations[operation.get('name')] = compile_operation(namespace, operation.get('name'), action)
+    return dict(version=VERSION, endpoint=address.get('location'), operations=operations)
+
+
+def _fetch(wsdl):
+    if wsdl.startswith(('http://', 'https://')):
+        with urllib.request.urlopen(wsdl, timeout=30) as response:
+            return response.read()
+    with open(wsdl, 'rb') as f:
+        return f.read()
+
+
+def _read_cache(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            service = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return service if service.get('version') == VERSION else None
+
+
+def _write_cache(path, service):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(service, f)
+        # concurrent processes never see half-written file
+        os.replace(temp, path)
+    except OSError:
+        pass
+
+
+def load_service(wsdl: str, cache_dir: str=None):
+    """
+    Compiled service from memory, cache directory or parsed WSDL
+    :param wsdl: WSDL url or file path
+    :param cache_dir: directory of compiled services, default_cache_dir() if None, False disables disk cache
+    """
+    service = _services.get(wsdl)
+    if service is not None:
+        return service
+    path = None
+    if cache_dir is not False:
+        name = hashlib.sha1(wsdl.encode('utf-8')).hexdigest() + '.json'
+        path = os.path.join(cache_dir or default_cache_dir(), name)
+        service = _read_cache(path)
+    if service is None:
+        service = parse_wsdl(_fetch(wsdl))
+        if path is not None:
+            _write_cache(path, service)
+    with _lock:
+        return _services.setdefault(wsdl, service)
+
+
+def encode_order(operation: str, params: dict):
+    """
+    Render REST request params as <order> element of SOAP operation
+    """
+    renamed = _OPERATION_ATTRIBUTES.get(operation, {})
+    attributes, children = [], []
+    for name, value in params.items():
+        value = value if isinstance(value, str) else str(value)
+        if name in _CHILDREN:
+            children.append('<{0}>{1}</{0}>'.format(name, escape(value)))
+        elif name == 'jsonParams':
+            for key, item in json.loads(value).items():
+                children.append('<params name={0} value={1}/>'.format(quoteattr(key), quoteattr(str(item))))
+        else:
+            attributes.append(' {0}={1}'.format(renamed.get(name) or _ATTRIBUTES.get(name, name), quoteattr(value)))
+    return '<order{0}>{1}</order>'.format(''.join(attributes), ''.join(children))
+
+
+class SoapClient(object):
+    """
+    Encoder of SOAP requests with credentials rendered into envelope templates once
+    """
+    def __init__(self, service: dict, username: str, password: str):
+        self.endpoint = service['endpoint']
+        username, password = escape(username), escape(password)
+        self._operations = {
+            name: (operation['prefix'].replace('{username}', username).replace('{password}', password),
+                   operation['suffix'],
+                   {'Content-Type': 'text/xml;charset=utf-8', 'SOAPAction': '"{0}"'.format(operation['action'])})
+            for name, operation in service['operations'].items()}
+
+    def prepare(self, operation: str, params: dict):
+        """
+        :param operation: SOAP operation name, e.g. getOrderStatusExtended
+        :return: (method, url, body, headers) for the transport
+        """
+        try:
+            prefix, suffix, headers = self._operations[operation]
+        except KeyError:
+            raise ValueError('Operation {0} is not defined by WSDL'.format(operation))
+        return 'POST', self.endpoint, (prefix + encode_order(operation, params) + suffix).encode('utf-8'), headers
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _value(name, value):
+    return int(value) if name in _NUMBERS and value.isdigit() else value
+
+
+def _fault(reply):
+    if _local(reply.tag) == 'Fault':
+        raise SberRequestError('soap', reply.findtext('faultcode'), reply.findtext('faultstring'))
+
+
+def raise_fault(body: bytes):
+    """
+    Raise SberRequestError if body is SOAP fault, faults are sent with HTTP status 500
+    """
+    try:
+        reply = ElementTree.fromstring(body).find('{%s}Body' % ENVELOPE)
+    except ElementTree.ParseError:
+        return
+    if reply is not None and len(reply):
+        _fault(reply[0])
+
+
+def parse_reply(body: bytes):
+    """
+    Decode SOAP reply to dict of the same shape as reply of REST API
+    """
+    reply = ElementTree.fromstring(body).find('{%s}Body' % ENVELOPE)
+    if reply is None or not len(reply):
+        raise ValueError('SOAP reply has no body')
+    reply = reply[0]
+    _fault(reply)
+    result = next((child for child in reply if _local(child.tag) == 'return'), None)
+    if result is None:
+        raise ValueError('SOAP reply has no return element')
+
+    data = {name: _value(name, value) for name, value in result.attrib.items()}
+    for child in result:
+        name = _local(child.tag)
+        if child.attrib:
+            value = {key: _value(key, item) for key, item in child.attrib.items()}
+        else:
+            value = child.text
+        if name in _LISTS:
+            data.setdefault(name, []).append(value)
+        else:
+            data[name] = value
+    if _local(reply.tag) == 'getOrderStatusResponse':
+        data = {_STATUS_NAMES.get(name, name): value for name, value in data.items()}
+    return data
@@ -0,0 +1,254 @@
+#coding=utf8
+# pysberbank local order state store #
+"""
+Durable local index of orders known to the wrapper
+
+    store = OrderStore('orders.sqlite')
+    wrapper = SberWrapper(username, password, store=store)
+    wrapper.status_ext(order_id)            # finished orders are answered from the store
+    store.refresh(wrapper)                  # poll the bank for orders which may still change
+    for order in store.scan(start=datetime(2024, 1, 1).timestamp(), status=SberWrapper.OrderStatus.DEPOSITED):
+        ...
+
+Results of register, status and status_ext are written by the wrapper. refund, deposit and reverse
+mark the order as open, so its next status request goes to the bank. Replies of orders in a terminal
+state (see StatusCache.terminal) are served locally, the other orders are refreshed with refresh().
+"""
+import collections
+import json
+import sqlite3
+import threading
+import time
+from .cache import StatusCache
+from .pysberbps import SberWrapper
+
+OrderRecord = collections.namedtuple('OrderRecord', 'order_id order_number amount status refunded created updated '
+                                                    'final')
+
+_COLUMNS = 'order_id, order_number, amount, status, refunded, created, updated, final'
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS orders (order_id TEXT PRIMARY KEY, order_number TEXT, amount INTEGER, '
+    'status INTEGER, refunded INTEGER NOT NULL DEFAULT 0, created REAL, updated REAL NOT NULL, '
+    'final INTEGER NOT NULL DEFAULT 0)',
+    'CREATE INDEX IF NOT EXISTS orders_number ON orders (order_number)',
+    'CREATE INDEX IF NOT EXISTS orders_created ON orders (created)',
+    # refresh() reads open orders only, they are a small part of the table
+    'CREATE INDEX IF NOT EXISTS orders_open ON orders (updated) WHERE final = 0',
+    'CREATE TABLE IF NOT EXISTS replies (order_id TEXT NOT NULL, method TEXT NOT NULL, language TEXT NOT NULL, '
+    'reply BLOB NOT NULL, PRIMARY KEY (order_id, method, language)) WITHOUT ROWID',
+)
+
+
+class OrderStore(object):
+    """
+    SQLite store of order state with indexes on order id, order number and creation date. Uses WAL mode,
+    instance is thread-safe and may be shared by wrappers of all threads
+    """
+    terminal = StatusCache.terminal
+
+    def __init__(self, path: str, decoder=None):
+        """
+        :param path: database file, ':memory:' for a temporary store
+        :param decoder: callable parsing stored reply, the fastest of orjson/ujson/json if None
+        """
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        for statement in _SCHEMA:
+            self._db.execute(statement)
+        if decoder is None:
+            from .responses import default_decoder
+            decoder = default_decoder()
+        self.decoder = decoder
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def record_register(self, order_id: str, order_number: str, amount: int, created: float=None):
+        """
+        Add registered order, its status is CREATED
+        :param created: registration time, seconds since epoch, now if None
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR IGNORE INTO orders (order_id, order_number, amount, status, created, updated) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (order_id, order_number, int(amount),
+                                                           SberWrapper.OrderStatus.CREATED.value, created or now, now))
+
+    def record_status(self, order_id: str, method: str, language: str, response: dict, requested: float=None):
+        """
+        Save status or status_ext reply, order is added if it is unknown
+        :param requested: time.time() before the request of the reply. Reply isn't saved if the order
+                          was updated after it, e.g. by refund or notification
+        """
+        status = StatusCache.order_status(response)
+        if status is None:
+            return
+        order_number = response.get('orderNumber', response.get('OrderNumber'))
+        amount = response.get('amount', response.get('Amount'))
+        created = response.get('date')
+        refunded = (response.get('paymentAmountInfo') or {}).get('refundedAmount')
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute('BEGIN')
+            if requested is not None:
+                row = self._db.execute('SELECT updated FROM orders WHERE order_id = ?', (order_id,)).fetchone()
+                if row is not None and row[0] > requested:
+                    return
+            self._db.execute(
+                'INSERT INTO orders (order_id, order_number, amount, status, refunded, created, updated, final) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (order_id) DO UPDATE SET '
+                'order_number = coalesce(excluded.order_number, order_number), '
+                'amount = coalesce(excluded.amount, amount), status = excluded.status, '
+                'refunded = max(refunded, excluded.refunded), created = coalesce(created, excluded.created), '
+                'updated = excluded.updated, final = excluded.final',
+                (order_id, order_number, int(amount) if amount is not None else None, status.value,
+                 int(refunded or 0), int(created) / 1000 if created else None, now, int(status in self.terminal)))
+            if status not in self.terminal:
+                # stale replies of other methods aren't served for open orders
+                self._db.execute('DELETE FROM replies WHERE order_id = ?', (order_id,))
+            self._db.execute('INSERT OR REPLACE INTO replies (order_id, method, language, reply) VALUES (?, ?, ?, ?)',
+                             (order_id, method, language, json.dumps(response, ensure_ascii=False).encode('utf-8')))
+
+    def record_refund(self, order_id: str, amount: int):
+        """
+        Add refunded amount and open the order, its state is requested from the bank again
+        """
+        with self._lock:
+            self._db.execute('UPDATE orders SET refunded = refunded + ?, final = 0, updated = ? WHERE order_id = ?',
+                             (int(amount), time.time(), order_id))
+
+    def invalidate(self, order_id: str):
+        """
+        Open the order after operation changing its state, e.g. deposit or reverse
+        """
+        with self._lock, self._db:
+            self._db.execute('BEGIN')
+            self._db.execute('UPDATE orders SET final = 0, updated = ? WHERE order_id = ?', (time.time(), order_id))
+            self._db.execute('DELETE FROM replies WHERE order_id = ?', (order_id,))
+
+    def update_status(self, order_id: str, status: SberWrapper.OrderStatus):
+        """
+        Set status of the order reported by a verified notification. The order stays open,
+        its full reply is requested from the bank by the next status request or refresh()
+        """
+        with self._lock, self._db:
+            self._db.execute('BEGIN')
+            self._db.execute('UPDATE orders SET status = ?, final = 0, updated = ? WHERE order_id = ?',
+                             (status.value, time.time(), order_id))
+            self._db.execute('DELETE FROM replies WHERE order_id = ?', (order_id,))
+
+    def get(self, order_id: str, method: str, language: str):
+        """
+        :return: stored reply of the order in a terminal state or None
+        """
+        with self._lock:
+            row = self._db.execute('SELECT reply FROM replies JOIN orders USING (order_id) WHERE order_id = ? '
+                                   'AND method = ? AND language = ? AND final = 1',
+                                   (order_id, method, language)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return self.decoder(row[0])
+
+    def order(self, order_id: str):
+        """
+        :return: OrderRecord or None if order isn't stored
+        """
+        with self._lock:
+            row = self._db.execute('SELECT {0} FROM orders WHERE order_id = ?'.format(_COLUMNS),
+                                   (order_id,)).fetchone()
+        return OrderRecord(*row) if row else None
+
+    def find(self, order_number: str):
+        """
+        :return: list of OrderRecord with the order number of the store
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT {0} FROM orders WHERE order_number = ?'.format(_COLUMNS),
+                                    (order_number,)).fetchall()
+        return [OrderRecord(*row) for row in rows]
+
+    def scan(self, start: float=None, end: float=None, status: SberWrapper.OrderStatus=None, chunk: int=1000):
+        """
+        Range scan by creation date for reports, orders are read by chunks
+        :param start: created at or after, seconds since epoch
+        :param end: created before, seconds since epoch
+        :param status: only orders in this status
+        :return: generator of OrderRecord ordered by creation date
+        """
+        conditions, params = ['created >= ?'], [start if start is not None else float('-inf')]
+        if end is not None:
+            conditions.append('created < ?')
+            params.append(end)
+        if status is not None:
+            conditions.append('status = ?')
+            params.append(status.value)
+        query = 'SELECT {0} FROM orders WHERE {1} AND (created > ? OR created = ? AND order_id > ?) ' \
+                'ORDER BY created, order_id LIMIT ?'.format(_COLUMNS, ' AND '.join(conditions))
+        last_created, last_id = float('-inf'), ''
+        while True:
+            # keyset pagination, the lock isn't held between chunks
+            with self._lock:
+                rows = self._db.execute(query, params + [last_created, last_created, last_id, chunk]).fetchall()
+            for row in rows:
+                yield OrderRecord(*row)
+            if len(rows) < chunk:
+                return
+            last_created, last_id = rows[-1][5], rows[-1][0]
+
+    def pending(self, limit: int=None):
+        """
+        :return: ids of orders not in a terminal state, least recently updated first
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT order_id FROM orders WHERE final = 0 ORDER BY updated LIMIT ?',
+                                    (limit if limit is not None else -1,)).fetchall()
+        return [row[0] for row in rows]
+
+    def refresh(self, wrapper: SberWrapper, method: str='status_ext', concurrency: int=8, language: str='RU',
+                limit: int=None):
+        """
+        Request state of open orders from the bank and save it, finished orders aren't requested
+        :param wrapper: SberWrapper, its own store may be other or None
+        :param method: status or status_ext
+        :param limit: refresh no more than this number of least recently updated orders
+        :return: dict(refreshed, finished, errors)
+        """
+        from .batch import map_orders
+        counters = dict(refreshed=0, finished=0, errors=0)
+        # reply dict of the bank, typed wrappers convert it only after it is saved
+        for result in map_orders(lambda order_id: wrapper._status_reply(method, order_id, language, fresh=True),
+                                 self.pending(limit), concurrency):
+            if result.error is not None:
+                counters['errors'] += 1
+                continue
+            response = result.result
+            if wrapper.store is not self:
+                self.record_status(result.key, method, language, response)
+            counters['refreshed'] += 1
+            counters['finished'] += StatusCache.order_status(response) in self.terminal
+        return counters
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT count(*) FROM orders').fetchone()[0]
+
+    def stats(self):
+        """
+        :return: dict(hits, misses, orders, open)
+        """
+        with self._lock:
+            orders, open_orders = self._db.execute('SELECT count(*), count(*) - total(final) FROM orders').fetchone()
+            return dict(hits=self.hits, misses=self.misses, orders=orders, open=int(open_orders))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
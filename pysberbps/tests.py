@@ -1,10 +1,19 @@
 #coding=utf8
 # pysberbank 07.11.14 10:50 by mnach #
+import asyncio
 import datetime
 import getpass
+import hashlib
+import hmac
+import io
 import json
 import random
 import string
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
 import urllib
 import urllib.request
@@ -12,7 +21,27 @@ import urllib.parse
 import logging
 from os import path
 import sys
-from sber.pysberbps import SberRequestError
+from pysberbps.pysberbps import (SberError, SberRequestError, SberNetworkError, SberCircuitOpenError,
+                                 SberChecksumError, SberWrapper)
+from pysberbps.simulator import SberSimulator
+from pysberbps.transport import PooledTransport, UrllibTransport, Transport, Response
+from pysberbps.http2 import Http2Transport
+from pysberbps.aio import AsyncSberWrapper, AsyncPooledTransport, AsyncSingleFlight
+from pysberbps.cache import StatusCache
+from pysberbps.store import OrderStore
+from pysberbps.resilience import Timeout, RetryPolicy, CircuitBreaker
+from pysberbps.metrics import MetricsHook, OpenTelemetryHook
+from pysberbps.profiler import Profiler, STAGES
+from pysberbps.responses import OrderStatusInfo
+from pysberbps.registry import SberClientPool
+from pysberbps import soap
+from pysberbps.poller import StatusPoller
+from pysberbps.recording import (RecordingTransport, ReplayTransport, AsyncReplayTransport, ReplayMissError,
+                                 AsyncRecordingTransport)
+from pysberbps.callbacks import CallbackProcessor, Notification, checksum
+from pysberbps.capture import BatchCapture, REVERSE
+from pysberbps.refunds import BatchRefund, RefundJournal, read_csv, DONE, STARTED, UNCERTAIN
+from pysberbps.ratelimit import TokenBucket, RateLimiter, priority, INTERACTIVE, BATCH
 
 logger = logging.getLogger(__name__)
 
@@ -173,7 +202,6 @@ class RestTestCase(unittest.TestCase):
 class WrapperTestCase(unittest.TestCase):
 
     def setUp(self):
-        from sber.pysberbps import SberWrapper
         self.wrapper = SberWrapper(Credentials.username, Credentials.password)
 
     def test_register(self):
@@ -234,6 +262,1780 @@ class WrapperTestCase(unittest.TestCase):
         self.assertRaisesRegex(SberRequestError, 'refund error 7.*', self.wrapper.refund, order_id, amount)
 
 
+class SimulatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator().start()
+        self.wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport=PooledTransport())
+
+    def tearDown(self):
+        self.simulator.stop()
+
+    def test_register(self):
+        order_id, _ = self.wrapper.register('A1', 100, 'https://u6.ru/')
+        self.assertRaisesRegex(SberRequestError, 'register error 1.*', self.wrapper.register, 'A1', 100,
+                               'https://u6.ru/')
+        self.assertEqual(self.wrapper.status(order_id)['OrderStatus'], 0)
+
+    def test_pre_auth(self):
+        order_id, _ = self.wrapper.register('A1', 100, 'https://u6.ru/', is_pre_auth=True)
+        self.simulator.pay(order_id)
+        self.assertEqual(self.wrapper.status_ext(order_id)['orderStatus'], 1)
+
+    def test_deposit_reverse(self):
+        held, _ = self.wrapper.register('A1', 100, 'https://u6.ru/', is_pre_auth=True)
+        self.assertRaisesRegex(SberRequestError, 'deposit error 7.*', self.wrapper.deposit, held)
+        self.simulator.pay(held)
+        self.assertRaisesRegex(SberRequestError, 'deposit error 6.*', self.wrapper.deposit, held, 200)
+        self.assertEqual(self.wrapper.deposit(held, 60), 'Success')
+        response = self.wrapper.status_ext(held)
+        self.assertEqual((response['orderStatus'], response['paymentAmountInfo']['depositedAmount']), (2, 60))
+        self.assertRaisesRegex(SberRequestError, 'reverse error 7.*', self.wrapper.reverse, held)
+
+        cancelled, _ = self.wrapper.register('A2', 100, 'https://u6.ru/', is_pre_auth=True)
+        self.simulator.pay(cancelled)
+        self.assertEqual(self.wrapper.reverse(cancelled), 'Success')
+        self.assertEqual(self.wrapper.status(cancelled)['OrderStatus'], 3)
+
+    def test_decline(self):
+        order_id, _ = self.wrapper.register('A1', 100, 'https://u6.ru/')
+        self.simulator.decline(order_id)
+        self.assertRaisesRegex(SberRequestError, 'status error 2.*', self.wrapper.status, order_id)
+
+    def test_error_rate(self):
+        self.simulator.error_rate = 1
+        self.assertRaises(SberNetworkError, self.wrapper.register, 'A1', 100, 'https://u6.ru/')
+
+
+class EncodingTestCase(unittest.TestCase):
+
+    def test_register(self):
+        wrapper = SberWrapper('user name', 'p&ss')
+        url, request = wrapper._register_request('A1', 100, 'https://u6.ru/?a=1', extra={'key': 'значение'},
+                                                 expiration=datetime.datetime(2015, 1, 2, 3, 4, 5, 6))
+        method, url, body, headers = wrapper._prepare(url, request)
+        self.assertEqual(method, 'POST')
+        self.assertEqual(headers['Content-Type'], 'application/x-www-form-urlencoded;charset=utf-8')
+        params = dict(urllib.parse.parse_qsl(body.decode('utf-8')))
+        self.assertEqual(params['userName'], 'user name')
+        self.assertEqual(params['password'], 'p&ss')
+        self.assertEqual(params['returnUrl'], 'https://u6.ru/?a=1')
+        self.assertEqual(params['amount'], '100')
+        self.assertEqual(params['expirationDate'], '2015-01-02T03:04:05')
+        self.assertEqual(json.loads(params['jsonParams']), {'key': 'значение'})
+
+    def test_get(self):
+        wrapper = SberWrapper('user', 'password', post=False)
+        method, url, body, headers = wrapper._prepare(*wrapper._status_request('976495d3', 'EN'))
+        self.assertEqual(method, 'GET')
+        self.assertIsNone(body)
+        self.assertTrue(url.endswith('getOrderStatus.do?userName=user&password=password&orderId=976495d3&language=EN'))
+
+
+class PooledTransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator().start()
+        self.transport = PooledTransport(maxsize=2)
+        self.wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport=self.transport)
+        self.order_id = self.simulator._register(dict(orderNumber='A1', amount=100))['orderId']
+
+    def tearDown(self):
+        self.transport.close()
+        self.simulator.stop()
+
+    def test_register(self):
+        order_id, form_url = self.wrapper.register('B1', 100, 'https://u6.ru/')
+        self.assertIn(order_id, self.simulator.orders)
+        self.assertTrue(form_url.endswith(order_id))
+        order_id, _ = self.wrapper.register('B2', 100, 'https://u6.ru/', is_pre_auth=True)
+        self.assertEqual(self.simulator.requests['/payment/rest/registerPreAuth.do'], 1)
+
+    def test_status(self):
+        result = self.wrapper.status(self.order_id)
+        for key in ('OrderNumber', 'Amount', 'Ip', 'ErrorCode'):
+            self.assertIn(key, result)
+
+    def test_connection_reuse(self):
+        for _ in range(5):
+            self.wrapper.status_ext(self.order_id)
+        self.assertEqual(self.simulator.requests['/payment/rest/getOrderStatusExtended.do'], 5)
+        self.assertEqual(sum(len(idle) for idle in self.transport._idle.values()), 1)
+
+    def test_idle_size(self):
+        # maxsize bounds idle connections, concurrent requests above it open their own
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport=self.transport, coalesce=False)
+        self.simulator.fail(4, status=None, delay=0.2)
+        threads = [threading.Thread(target=wrapper.status, args=(self.order_id,)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.simulator.requests['/payment/rest/getOrderStatus.do'], 4)
+        self.assertEqual(sum(len(idle) for idle in self.transport._idle.values()), 2)
+
+    def test_get_request(self):
+        wrapper = SberWrapper('user', 'password', post=False, urls=self.simulator.urls, transport=self.transport)
+        self.assertEqual(wrapper.status_ext(self.order_id)['orderNumber'], 'A1')
+
+    def test_network_error(self):
+        urls = dict(self.simulator.urls, status='http://127.0.0.1:1/payment/rest/getOrderStatus.do')
+        wrapper = SberWrapper('user', 'password', urls=urls, transport=self.transport)
+        self.assertRaises(SberNetworkError, wrapper.status, self.order_id)
+
+    def test_http_error(self):
+        urls = dict(self.simulator.urls, status=self.simulator.base_url + 'unknown.do')
+        wrapper = SberWrapper('user', 'password', urls=urls, transport=self.transport)
+        self.assertRaises(SberNetworkError, wrapper.status, self.order_id)
+
+    def test_request_error(self):
+        self.assertRaisesRegex(SberRequestError, 'refund error 7.*', self.wrapper.refund, self.order_id, 100)
+
+    def test_prewarm(self):
+        self.assertIs(self.wrapper.prewarm(connections=3), self.wrapper)
+        # all urls are on one host, pool keeps maxsize connections
+        self.assertEqual(sum(len(idle) for idle in self.transport._idle.values()), 2)
+        self.wrapper.status(self.order_id)
+        self.assertEqual(sum(len(idle) for idle in self.transport._idle.values()), 2)
+        urls = dict(self.simulator.urls, status='http://127.0.0.1:1/payment/rest/getOrderStatus.do')
+        wrapper = SberWrapper('user', 'password', urls=urls, transport=self.transport)
+        self.assertRaises(SberNetworkError, wrapper.prewarm)
+
+    def test_stale_connection(self):
+        self.wrapper.status(self.order_id)
+        self.simulator.fail(1, status=None, reset='request')
+        # pooled connection is closed without reply, the request is sent again on a new one
+        self.assertEqual(self.wrapper.status(self.order_id)['OrderNumber'], 'A1')
+        self.assertEqual(self.simulator.requests['/payment/rest/getOrderStatus.do'], 3)
+
+    def test_no_resend_after_reply(self):
+        self.simulator.pay(self.order_id)
+        self.wrapper.status(self.order_id)
+        self.simulator.fail(1, status=None, reset='reply')
+        self.assertRaises(SberNetworkError, self.wrapper.refund, self.order_id, 40)
+        self.assertEqual(self.simulator.requests['/payment/rest/refund.do'], 1)
+        self.assertEqual(self.simulator.orders[self.order_id]['refunded'], 40)
+
+
+class TransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator().start()
+        self.order_id = self.simulator._register(dict(orderNumber='A1', amount=100))['orderId']
+
+    def tearDown(self):
+        self.simulator.stop()
+
+    def test_selection(self):
+        self.assertIsInstance(SberWrapper('user', 'password').transport, UrllibTransport)
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport='pooled')
+        self.assertIsInstance(wrapper.transport, PooledTransport)
+        self.assertEqual(wrapper.status(self.order_id)['OrderNumber'], 'A1')
+        self.assertRaises(ValueError, SberWrapper, 'user', 'password', transport='ftp')
+        self.assertIsInstance(AsyncSberWrapper('user', 'password').transport, AsyncPooledTransport)
+
+    def test_urllib(self):
+        with UrllibTransport(timeout=Timeout(connect=1, read=1)) as transport:
+            response = transport.request('GET', self.simulator.base_url + 'unknown.do?userName=u&password=p')
+            self.assertEqual(response.status, 404)
+            self.simulator.fail(1, status=503)
+            response = transport.request('POST', self.simulator.urls['status'], b'userName=u&password=p')
+            self.assertEqual(response.status, 503)
+            response = transport.request('POST', self.simulator.urls['status'],
+                                         'userName=u&password=p&orderId={0}'.format(self.order_id).encode())
+            self.assertEqual((response.status, json.loads(response.body)['OrderNumber']), (200, 'A1'))
+            self.assertRaises(OSError, transport.request, 'GET', 'http://127.0.0.1:1/')
+
+    def test_interface(self):
+        class StaticTransport(Transport):
+            def request(self, method, url, body=None, headers=None, timeout=None, trace=None):
+                return Response(200, 'OK', None, b'{"errorCode": "0", "OrderStatus": 2}')
+
+        wrapper = SberWrapper('user', 'password', transport=StaticTransport())
+        self.assertIs(wrapper.prewarm(), wrapper)
+        self.assertEqual(wrapper.status('1')['OrderStatus'], 2)
+        self.assertRaises(NotImplementedError, Transport().request, 'GET', 'http://127.0.0.1/')
+
+    def test_http2(self):
+        try:
+            import httpx, h2
+        except ImportError:
+            self.assertRaisesRegex(ImportError, 'pip install', SberWrapper, 'user', 'password', transport='http2')
+            return
+        # the simulator speaks HTTP/1.1, the transport falls back to it
+        with Http2Transport() as transport:
+            wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport=transport)
+            self.assertEqual(wrapper.status(self.order_id)['OrderNumber'], 'A1')
+            urls = dict(self.simulator.urls, status='http://127.0.0.1:1/payment/rest/getOrderStatus.do')
+            wrapper = SberWrapper('user', 'password', urls=urls, transport=transport)
+            self.assertRaises(SberNetworkError, wrapper.status, self.order_id)
+
+
+class ThreadSafetyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator(latency=0.002).start()
+        self.wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport='pooled')
+
+    def tearDown(self):
+        self.wrapper.transport.close()
+        self.simulator.stop()
+
+    def test_read_only(self):
+        for name in ('urls', 'post', 'soap', 'transport', 'timeout', 'cache', 'decoder'):
+            self.assertRaises(AttributeError, setattr, self.wrapper, name, None)
+        self.assertRaises(AttributeError, delattr, self.wrapper, 'urls')
+        with self.assertRaises(TypeError):
+            self.wrapper.urls['status'] = 'http://127.0.0.1:1/'
+        urls = dict(self.simulator.urls)
+        wrapper = SberWrapper('user', 'password', urls=urls)
+        urls['status'] = 'http://127.0.0.1:1/'
+        self.assertEqual(wrapper.urls['status'], self.simulator.urls['status'])
+
+    def run_threads(self, wrapper, threads, orders, prefix):
+        """
+        :return: errors
+        """
+        errors = []
+        calls = [0]
+        lock = threading.Lock()
+
+        def check(condition, message):
+            if not condition:
+                errors.append(message)
+
+        def worker(number):
+            done = 0
+            for index in range(orders):
+                order_number = '{0}-{1}-{2}'.format(prefix, number, index)
+                amount = 100 + number * orders + index
+                order_id, form_url = wrapper.register(order_number, amount, 'https://example.com/')
+                check(form_url.endswith(order_id), 'form of {0}'.format(order_number))
+                status = wrapper.status(order_id)
+                check((status['OrderNumber'], status['Amount']) == (order_number, amount),
+                      'status of {0}: {1}'.format(order_number, status))
+                self.simulator.pay(order_id)
+                wrapper.refund(order_id, amount)
+                status = wrapper.status_ext(order_id)
+                check((status['orderNumber'], status['paymentAmountInfo']['refundedAmount']) == (order_number, amount),
+                      'status_ext of {0}: {1}'.format(order_number, status))
+                done += 4
+            with lock:
+                calls[0] += done
+
+        workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(calls[0], threads * orders * 4)
+        return errors
+
+    def test_stress(self):
+        errors = self.run_threads(self.wrapper, 16, 40, 'stress')
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.simulator.orders), 16 * 40)
+
+    def test_shared_state(self):
+        # throughput scaling is measured by benchmarks/bench_threads.py
+        with OrderStore(':memory:') as store:
+            cache = StatusCache(ttl=60)
+            wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport=self.wrapper.transport,
+                                  cache=cache, store=store)
+            errors = self.run_threads(wrapper, 8, 20, 'shared')
+            self.assertEqual(errors, [])
+            self.assertEqual(len(store), 8 * 20)
+            self.assertEqual(store.stats()['open'], 0)
+            self.assertEqual(cache.stats()['misses'], 8 * 20 * 2)
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator().start()
+        self.order_id = self.simulator._register(dict(orderNumber='A1', amount=100))['orderId']
+
+    def tearDown(self):
+        self.simulator.stop()
+
+    def test_stages(self):
+        hook = RecordingHook()
+        profiler = Profiler(allocations=True, sample=1, hook=hook)
+        try:
+            wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport='pooled', metrics=profiler)
+            wrapper.status(self.order_id)
+            wrapper.status(self.order_id)
+            self.assertRaises(SberRequestError, wrapper.refund, self.order_id, 100)
+        finally:
+            profiler.close()
+            wrapper.transport.close()
+        self.assertFalse(tracemalloc.is_tracing())
+        stats = profiler.stats()
+        self.assertEqual(sorted(stats['status'], key=STAGES.index),
+                         ['build', 'encode', 'connect', 'ttfb', 'decode', 'handle', 'call'])
+        self.assertEqual(stats['status']['build']['count'], 2)
+        self.assertEqual(stats['status']['connect']['count'], 1)
+        self.assertEqual(stats['status']['encode']['alloc_samples'], 2)
+        self.assertGreater(stats['status']['decode']['alloc_bytes'], 0)
+        self.assertIsNone(stats['status']['ttfb']['alloc_bytes'])
+        self.assertTrue(0 < stats['status']['encode']['mean_us'] < stats['status']['call']['mean_us'])
+        # handle raised the request error
+        self.assertEqual(stats['refund']['handle']['count'], 1)
+        self.assertEqual(hook.stages[:5], [('status', 'build'), ('status', 'encode'), ('status', 'connect'),
+                                           ('status', 'ttfb'), ('status', 'decode')])
+        self.assertEqual(hook.errors, [('refund', '7')])
+        self.assertIn('{0:<11} handle'.format('refund'), profiler.format())
+
+    def test_async(self):
+        profiler = Profiler(window=2)
+
+        async def run():
+            async with AsyncSberWrapper('user', 'password', urls=self.simulator.urls, metrics=profiler) as wrapper:
+                for _ in range(3):
+                    await wrapper.status_ext(self.order_id)
+        asyncio.run(run())
+        stats = profiler.stats()['status_ext']
+        self.assertEqual(set(stats), {'build', 'encode', 'connect', 'ttfb', 'decode', 'handle', 'call'})
+        self.assertEqual(stats['call']['count'], 2)
+        self.assertIsNone(stats['build']['alloc_bytes'])
+
+    def test_log(self):
+        now = [0]
+        profiler = Profiler(log_interval=10, clock=lambda: now[0])
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, metrics=profiler)
+        with self.assertLogs('pysberbps.profiler', logging.INFO) as logs:
+            wrapper.status(self.order_id)
+            now[0] = 10
+            wrapper.status(self.order_id)
+            wrapper.status(self.order_id)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('{0:<11} ttfb'.format('status'), logs.output[0])
+
+    def test_cli(self):
+        output = subprocess.run([sys.executable, '-m', 'pysberbps.profiler', '--calls', '5', '--allocations'],
+                                stdout=subprocess.PIPE, universal_newlines=True, check=True,
+                                cwd=path.dirname(path.dirname(path.abspath(__file__)))).stdout
+        for method in ('register', 'status', 'status_ext', 'refund'):
+            self.assertIn('{0:<11} build'.format(method), output)
+
+
+class LazyImportTestCase(unittest.TestCase):
+
+    def run_python(self, code):
+        return subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, universal_newlines=True,
+                              check=True, cwd=path.dirname(path.dirname(path.abspath(__file__)))).stdout.split()
+
+    def test_import(self):
+        loaded = self.run_python('import sys, pysberbps; print(*[name for name in ('
+                                 '"urllib.request", "http.client", "ssl", "asyncio", "datetime", "json", '
+                                 '"pysberbps.transport", "pysberbps.aio") if name in sys.modules])')
+        self.assertEqual(loaded, [])
+
+    def test_lazy_names(self):
+        import pysberbps
+        for name in pysberbps.__all__:
+            self.assertIsNotNone(getattr(pysberbps, name))
+        self.assertIs(pysberbps.PooledTransport, PooledTransport)
+        self.assertIn('AsyncSberWrapper', dir(pysberbps))
+        with self.assertRaises(AttributeError):
+            pysberbps.UnknownName
+
+
+class AsyncWrapperTestCase(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator().start()
+        self.order_id = self.simulator._register(dict(orderNumber='A1', amount=100))['orderId']
+
+    def tearDown(self):
+        self.simulator.stop()
+
+    async def test_prewarm(self):
+        async with AsyncSberWrapper('user', 'password', urls=self.simulator.urls) as wrapper:
+            self.assertIs(await wrapper.prewarm(connections=2), wrapper)
+            self.assertEqual(sum(len(idle) for idle in wrapper.transport._idle.values()), 2)
+            await wrapper.status(self.order_id)
+            self.assertEqual(self.simulator.requests['/payment/rest/getOrderStatus.do'], 1)
+            self.assertEqual(sum(len(idle) for idle in wrapper.transport._idle.values()), 2)
+
+    async def test_register_and_refund(self):
+        async with AsyncSberWrapper('user', 'password', urls=self.simulator.urls) as wrapper:
+            order_id, form_url = await wrapper.register('B1', 100, 'https://u6.ru/')
+            self.assertTrue(form_url.endswith(order_id))
+            with self.assertRaisesRegex(SberRequestError, 'refund error 7.*'):
+                await wrapper.refund(order_id, 100)
+            self.simulator.pay(order_id)
+            self.assertEqual(await wrapper.refund(order_id, 100), 'Success')
+
+    async def test_get_request(self):
+        async with AsyncSberWrapper('user', 'password', post=False, urls=self.simulator.urls) as wrapper:
+            self.assertEqual((await wrapper.status(self.order_id))['OrderNumber'], 'A1')
+
+    async def test_concurrent_status(self):
+        transport = AsyncPooledTransport(limit_per_host=10)
+        async with AsyncSberWrapper('user', 'password', urls=self.simulator.urls, transport=transport) as wrapper:
+            results = await asyncio.gather(*(wrapper.status_ext(self.order_id) for _ in range(500)))
+            self.assertEqual({result['orderNumber'] for result in results}, {'A1'})
+            self.assertLessEqual(sum(len(idle) for idle in transport._idle.values()), 10)
+
+    async def test_network_error(self):
+        urls = dict(self.simulator.urls, status='http://127.0.0.1:1/payment/rest/getOrderStatus.do')
+        async with AsyncSberWrapper('user', 'password', urls=urls) as wrapper:
+            with self.assertRaises(SberNetworkError):
+                await wrapper.status(self.order_id)
+            with self.assertRaisesRegex(SberRequestError, 'status_ext error 6.*'):
+                await wrapper.status_ext('unknown')
+
+    async def test_stale_connection(self):
+        self.simulator.pay(self.order_id)
+        async with AsyncSberWrapper('user', 'password', urls=self.simulator.urls) as wrapper:
+            await wrapper.status(self.order_id)
+            self.simulator.fail(1, status=None, reset='request')
+            self.assertEqual((await wrapper.status(self.order_id))['OrderNumber'], 'A1')
+            self.assertEqual(self.simulator.requests['/payment/rest/getOrderStatus.do'], 3)
+            self.simulator.fail(1, status=None, reset='reply')
+            with self.assertRaises(SberNetworkError):
+                await wrapper.refund(self.order_id, 40)
+            self.assertEqual(self.simulator.requests['/payment/rest/refund.do'], 1)
+            self.assertEqual(self.simulator.orders[self.order_id]['refunded'], 40)
+
+    async def test_bulk(self):
+        order_ids = [self.simulator._register(dict(orderNumber='N{0}'.format(i), amount=100))['orderId']
+                     for i in range(20)]
+        async with AsyncSberWrapper('user', 'password', urls=self.simulator.urls) as wrapper:
+            results = [result async for result in wrapper.status_many(order_ids + ['unknown'], concurrency=4)]
+            by_id = {result.key: result for result in results}
+            self.assertEqual(len(by_id), 21)
+            self.assertEqual(by_id[order_ids[3]].result['OrderNumber'], 'N3')
+            self.assertIsInstance(by_id['unknown'].error, SberRequestError)
+            results = [result async for result in wrapper.status_ext_many(iter(order_ids), concurrency=4)]
+            self.assertEqual({result.result['orderNumber'] for result in results},
+                             {'N{0}'.format(i) for i in range(20)})
+
+            batch = wrapper.register_many([('R1', 100, 'https://example.com/'), ('R2', 0, 'https://example.com/'),
+                                           dict(order='R3', amount=300, success_url='https://example.com/')])
+            self.assertRaises(TypeError, iter, batch)
+            results = {result.order: result async for result in batch}
+            self.assertEqual(self.simulator.orders[results['R3'].order_id]['amount'], 300)
+            self.assertIsInstance(results['R2'].error, ValueError)
+            self.assertEqual(batch.stats[:4], (2, 0, 1, 0))
+
+
+class StatusManyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator(latency=0.01).start()
+        self.transport = PooledTransport(maxsize=8)
+        self.wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport=self.transport)
+        self.order_ids = [self.simulator._register(dict(orderNumber=str(i), amount=100))['orderId']
+                          for i in range(30)]
+
+    def tearDown(self):
+        self.transport.close()
+        self.simulator.stop()
+
+    def test_status_many(self):
+        results = list(self.wrapper.status_ext_many(self.order_ids + ['unknown'], concurrency=8))
+        self.assertEqual(len(results), 31)
+        by_id = {result.key: result for result in results}
+        for number, order_id in enumerate(self.order_ids):
+            self.assertEqual(by_id[order_id].result['orderNumber'], str(number))
+            self.assertIsNone(by_id[order_id].error)
+        self.assertIsInstance(by_id['unknown'].error, SberRequestError)
+        self.assertEqual(list(self.wrapper.status_many(iter(self.order_ids[:2]), concurrency=1))[0].key,
+                         self.order_ids[0])
+
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = path.join(directory, 'status.checkpoint')
+            batch = self.wrapper.status_many(self.order_ids, concurrency=1, checkpoint=checkpoint)
+            finished = {result.key for _, result in zip(range(10), batch)}
+            batch.close()
+            results = list(self.wrapper.status_many(self.order_ids, concurrency=4, checkpoint=checkpoint))
+        self.assertEqual(len(results), 20)
+        self.assertFalse(finished & {result.key for result in results})
+
+
+class RegisterManyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator(latency=0.01).start()
+        self.wrapper = SberWrapper('user', 'password', urls=self.simulator.urls,
+                                   transport=PooledTransport(maxsize=8))
+
+    def tearDown(self):
+        self.wrapper.transport.close()
+        self.simulator.stop()
+
+    def test_concurrency(self):
+        second = threading.Event()
+
+        class CountingTransport(PooledTransport):
+            lock = threading.Lock()
+            in_flight = peak = 0
+
+            def request(self, *args, **kwargs):
+                with self.lock:
+                    CountingTransport.in_flight += 1
+                    CountingTransport.peak = max(self.peak, self.in_flight)
+                    first = self.in_flight == 1
+                if not first:
+                    second.set()
+                try:
+                    if first:
+                        # the first request is in flight until the second one is sent
+                        second.wait(5)
+                    return super(CountingTransport, self).request(*args, **kwargs)
+                finally:
+                    with self.lock:
+                        CountingTransport.in_flight -= 1
+
+        transport = CountingTransport()
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport=transport)
+        batch = wrapper.register_many([('P{0}'.format(number), 100, 'https://example.com/') for number in range(8)],
+                                      concurrency=4)
+        self.assertEqual(len(list(batch)), 8)
+        transport.close()
+        self.assertTrue(second.is_set())
+        self.assertTrue(2 <= CountingTransport.peak <= 4)
+
+    def test_register_many(self):
+        def specs():
+            for number in range(100):
+                yield dict(order='M{0}'.format(number), amount=100 + number, success_url='https://example.com/',
+                           extra={'invoice': number})
+            yield ('M0', 100, 'https://example.com/')
+            yield dict(order='M-bad', amount='100', success_url='https://example.com/')
+            yield dict(order='M-typo', amount=100, success_url='https://example.com/', amout=1)
+            yield None
+
+        batch = self.wrapper.register_many(specs(), concurrency=8)
+        results = {result.order: result for result in batch}
+        self.assertEqual(len(results), 103)
+        for number in range(100):
+            result = results['M{0}'.format(number)]
+            if result.error is None:
+                self.assertEqual(self.simulator.orders[result.order_id]['amount'], 100 + number)
+                self.assertTrue(result.form_url.endswith(result.order_id))
+        # duplicate order number is rejected by the bank
+        self.assertEqual(len(self.simulator.orders), 100)
+        self.assertIsInstance(results['M-bad'].error, ValueError)
+        self.assertIsInstance(results['M-typo'].error, TypeError)
+        # row which isn't a tuple or dict is invalid too, the batch goes on
+        self.assertIsInstance(results[None].error, TypeError)
+        self.assertEqual(batch.stats[:4], (100, 1, 3, 0))
+        self.assertGreater(batch.stats.rate, 0)
+
+    def test_backpressure(self):
+        consumed = []
+
+        def specs():
+            for number in range(1000):
+                consumed.append(number)
+                yield 'B{0}'.format(number), 100, 'https://example.com/'
+
+        batch = iter(self.wrapper.register_many(specs(), concurrency=4))
+        next(batch)
+        # specs are read ahead no more than 2 * concurrency
+        self.assertLessEqual(len(consumed), 10)
+        batch.close()
+
+
+class StatusCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.simulator = SberSimulator().start()
+        self.cache = StatusCache(maxsize=2, ttl=2, clock=lambda: self.now)
+        self.wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, cache=self.cache)
+        self.order_id = self.simulator._register(dict(orderNumber='A1', amount=100))['orderId']
+
+    def tearDown(self):
+        self.simulator.stop()
+
+    def requests(self, endpoint='getOrderStatus.do'):
+        return self.simulator.requests.get('/payment/rest/' + endpoint, 0)
+
+    def test_ttl(self):
+        self.wrapper.status(self.order_id)
+        self.wrapper.status(self.order_id)
+        self.assertEqual(self.requests(), 1)
+        self.now = 3
+        self.wrapper.status(self.order_id)
+        self.assertEqual(self.requests(), 2)
+        self.assertEqual(self.cache.stats(), dict(hits=1, misses=2, size=1))
+
+    def test_terminal_state(self):
+        self.simulator.pay(self.order_id)
+        self.wrapper.status_ext(self.order_id)
+        self.now = 1000
+        self.assertEqual(self.wrapper.status_ext(self.order_id)['orderStatus'], 2)
+        self.assertEqual(self.requests('getOrderStatusExtended.do'), 1)
+
+    def test_refund_invalidates(self):
+        self.simulator.pay(self.order_id)
+        self.wrapper.status(self.order_id)
+        self.wrapper.refund(self.order_id, 100)
+        self.assertEqual(self.wrapper.status(self.order_id)['OrderStatus'], 4)
+        self.assertEqual(self.requests(), 2)
+
+    def test_lru_eviction(self):
+        order_ids = [self.order_id] + [self.simulator._register(dict(orderNumber=str(i), amount=1))['orderId']
+                                       for i in range(2)]
+        for order_id in order_ids:
+            self.wrapper.status(order_id)
+        self.assertEqual(len(self.cache), 2)
+        self.wrapper.status(self.order_id)
+        self.assertEqual(self.requests(), 4)
+
+
+class OrderStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator().start()
+        self.store = OrderStore(':memory:')
+        self.wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, store=self.store)
+
+    def tearDown(self):
+        self.store.close()
+        self.simulator.stop()
+
+    def requests(self, endpoint):
+        return self.simulator.requests.get('/payment/rest/' + endpoint, 0)
+
+    def test_local_answers(self):
+        order_id, _ = self.wrapper.register('S1', 100, 'https://example.com/')
+        self.assertEqual(self.store.order(order_id)[1:4], ('S1', 100, 0))
+        self.assertEqual(self.store.pending(), [order_id])
+        self.wrapper.status_ext(order_id)
+        self.wrapper.status_ext(order_id)
+        # open order is requested every time
+        self.assertEqual(self.requests('getOrderStatusExtended.do'), 2)
+
+        self.simulator.pay(order_id)
+        self.assertEqual(self.wrapper.status_ext(order_id)['orderStatus'], 2)
+        for _ in range(3):
+            self.assertEqual(self.wrapper.status_ext(order_id)['orderNumber'], 'S1')
+        self.assertEqual(self.requests('getOrderStatusExtended.do'), 3)
+        # stored reply survives the wrapper
+        other = SberWrapper('user', 'password', urls=self.simulator.urls, store=self.store, typed=True)
+        self.assertEqual(other.status_ext(order_id).status, SberWrapper.OrderStatus.DEPOSITED)
+        self.assertEqual(self.requests('getOrderStatusExtended.do'), 3)
+        self.assertEqual(self.store.pending(), [])
+
+        self.wrapper.refund(order_id, 100)
+        self.assertEqual(self.store.order(order_id).refunded, 100)
+        self.assertEqual(self.store.pending(), [order_id])
+        self.assertEqual(self.wrapper.status_ext(order_id)['orderStatus'], 4)
+        self.assertEqual(self.requests('getOrderStatusExtended.do'), 4)
+        self.assertEqual(self.store.stats(), dict(hits=4, misses=4, orders=1, open=0))
+
+    def test_open_in_flight(self):
+        order_id, _ = self.wrapper.register('F1', 100, 'https://example.com/')
+        self.simulator.pay(order_id)
+        self.wrapper.status_ext(order_id)
+        self.assertEqual(self.store.order(order_id).final, 1)
+        store, finals = self.store, []
+
+        class InspectingTransport(UrllibTransport):
+            def request(self, method, url, body=None, headers=None, timeout=None, trace=None):
+                if url.endswith('/refund.do'):
+                    # a crash here must not leave the order answered locally
+                    finals.append(store.order(order_id).final)
+                return super(InspectingTransport, self).request(method, url, body, headers, timeout, trace)
+
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, store=self.store,
+                              transport=InspectingTransport())
+        wrapper.refund(order_id, 100)
+        self.assertEqual(finals, [0])
+        self.assertEqual(wrapper.status_ext(order_id)['orderStatus'], 4)
+
+    def test_stale_reply(self):
+        order_id, _ = self.wrapper.register('F2', 100, 'https://example.com/')
+        self.simulator.pay(order_id)
+        cache = StatusCache(ttl=60)
+        refunding = SberWrapper('user', 'password', urls=self.simulator.urls, store=self.store, cache=cache)
+
+        class RacingTransport(UrllibTransport):
+            def request(self, method, url, body=None, headers=None, timeout=None, trace=None):
+                response = super(RacingTransport, self).request(method, url, body, headers, timeout, trace)
+                if url.endswith('/getOrderStatusExtended.do'):
+                    # refund is done while the paid order reply is on its way
+                    refunding.refund(order_id, 100)
+                return response
+
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, store=self.store, cache=cache,
+                              transport=RacingTransport())
+        self.assertEqual(wrapper.status_ext(order_id)['orderStatus'], 2)
+        self.assertEqual(self.store.order(order_id).final, 0)
+        self.assertIsNone(self.store.get(order_id, 'status_ext', 'RU'))
+        self.assertIsNone(cache.get(order_id, 'status_ext', 'RU'))
+        self.assertEqual(refunding.status_ext(order_id)['orderStatus'], 4)
+
+    def test_refresh(self):
+        order_ids = [self.wrapper.register('R{0}'.format(number), 100, 'https://example.com/')[0]
+                     for number in range(5)]
+        self.simulator.pay(order_ids[0])
+        self.simulator.decline(order_ids[1])
+        plain = SberWrapper('user', 'password', urls=self.simulator.urls)
+        self.assertEqual(self.store.refresh(plain), dict(refreshed=5, finished=2, errors=0))
+        self.assertEqual(sorted(self.store.pending()), sorted(order_ids[2:]))
+        self.assertEqual(self.store.refresh(plain, limit=1), dict(refreshed=1, finished=0, errors=0))
+        self.assertEqual(self.requests('getOrderStatusExtended.do'), 6)
+        self.assertEqual(self.store.order(order_ids[1]).status, 6)
+
+    def test_refresh_typed(self):
+        order_id, _ = self.wrapper.register('T1', 100, 'https://example.com/')
+        self.simulator.pay(order_id)
+        typed = SberWrapper('user', 'password', urls=self.simulator.urls, typed=True)
+        self.assertEqual(self.store.refresh(typed), dict(refreshed=1, finished=1, errors=0))
+        self.assertEqual(self.store.order(order_id).status, 2)
+        self.assertEqual(self.store.pending(), [])
+        self.assertEqual(self.wrapper.status_ext(order_id)['orderStatus'], 2)
+        self.assertEqual(self.requests('getOrderStatusExtended.do'), 1)
+
+    def test_register_many(self):
+        results = list(self.wrapper.register_many([('B{0}'.format(number), 100, 'https://example.com/')
+                                                   for number in range(3)]))
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertEqual([record.order_id for record in self.store.find(result.order)], [result.order_id])
+        self.assertEqual(len(self.store.pending()), 3)
+
+        async def run():
+            async with AsyncSberWrapper('user', 'password', urls=self.simulator.urls, store=self.store) as wrapper:
+                return [result async for result in wrapper.register_many([('B3', 100, 'https://example.com/')])]
+        result, = asyncio.run(run())
+        self.assertEqual(self.store.order(result.order_id)[1:3], ('B3', 100))
+
+    def test_scan(self):
+        for number in range(25):
+            self.store.record_register('id{0:02}'.format(number), 'N{0}'.format(number % 10), 100 + number,
+                                       created=1000.0 + number // 2)
+        self.store.record_status('id03', 'status', 'RU', dict(OrderStatus=2, OrderNumber='N3', Amount=103,
+                                                               ErrorCode='0'))
+        records = list(self.store.scan(1001.0, 1010.0, chunk=4))
+        self.assertEqual([record.order_id for record in records], ['id{0:02}'.format(n) for n in range(2, 20)])
+        self.assertEqual([record.order_id for record in self.store.scan(status=SberWrapper.OrderStatus.DEPOSITED)],
+                         ['id03'])
+        self.assertEqual(len(list(self.store.scan(chunk=5))), 25)
+        self.assertEqual(sorted(record.order_id for record in self.store.find('N3')), ['id03', 'id13', 'id23'])
+        self.assertEqual(len(self.store), 25)
+        self.assertIsNone(self.store.order('unknown'))
+
+    def test_durable(self):
+        with tempfile.TemporaryDirectory() as directory:
+            database = path.join(directory, 'orders.sqlite')
+            with OrderStore(database) as store:
+                wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, store=store)
+                order_id, _ = wrapper.register('D1', 100, 'https://example.com/')
+                self.simulator.decline(order_id)
+                self.assertRaises(SberRequestError, wrapper.status, order_id)
+                self.assertEqual(wrapper.status_ext(order_id)['orderStatus'], 6)
+            with OrderStore(database) as store:
+                wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, store=store)
+                self.assertEqual(wrapper.status_ext(order_id)['orderStatus'], 6)
+                self.assertEqual(self.requests('getOrderStatusExtended.do'), 1)
+
+
+class CoalescingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator(latency=0.3).start()
+        self.order_id = self.simulator._register(dict(orderNumber='A1', amount=100))['orderId']
+
+    def tearDown(self):
+        self.simulator.stop()
+
+    def run_threads(self, wrapper, order_id, count=100):
+        results, errors = [], []
+
+        def worker():
+            try:
+                results.append(wrapper.status(order_id))
+            except SberRequestError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_threads(self):
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport=PooledTransport())
+        results, errors = self.run_threads(wrapper, self.order_id)
+        self.assertEqual(self.simulator.requests['/payment/rest/getOrderStatus.do'], 1)
+        self.assertEqual(len(results), 100)
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_shared_error(self):
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls)
+        results, errors = self.run_threads(wrapper, 'unknown', 20)
+        self.assertEqual(self.simulator.requests['/payment/rest/getOrderStatus.do'], 1)
+        self.assertEqual(len(errors), 20)
+
+    def test_coroutines(self):
+        async def run():
+            async with AsyncSberWrapper('user', 'password', urls=self.simulator.urls) as wrapper:
+                return await asyncio.gather(*(wrapper.status_ext(self.order_id) for _ in range(100)))
+        results = asyncio.run(run())
+        self.assertEqual(self.simulator.requests['/payment/rest/getOrderStatusExtended.do'], 1)
+        self.assertEqual(len(results), 100)
+
+    def test_cancelled_leader(self):
+        async def run():
+            flight = AsyncSingleFlight()
+            released = asyncio.Event()
+
+            async def fetch():
+                await released.wait()
+                return 'reply'
+            leader = asyncio.ensure_future(flight.do('key', fetch))
+            await asyncio.sleep(0)
+            followers = [asyncio.ensure_future(flight.do('key', fetch)) for _ in range(3)]
+            await asyncio.sleep(0)
+            leader.cancel()
+            await asyncio.sleep(0)
+            released.set()
+            results = await asyncio.gather(*followers)
+            with self.assertRaises(asyncio.CancelledError):
+                await leader
+            self.assertEqual(flight._calls, {})
+            return results
+        self.assertEqual(asyncio.run(run()), ['reply'] * 3)
+
+    def test_disabled(self):
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport=PooledTransport(),
+                              coalesce=False)
+        self.run_threads(wrapper, self.order_id, 5)
+        self.assertEqual(self.simulator.requests['/payment/rest/getOrderStatus.do'], 5)
+
+
+class ResilienceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator().start()
+        self.transport = PooledTransport()
+        self.order_id = self.simulator._register(dict(orderNumber='A1', amount=100))['orderId']
+
+    def tearDown(self):
+        self.transport.close()
+        self.simulator.stop()
+
+    def wrapper(self, **kwargs):
+        return SberWrapper('user', 'password', urls=self.simulator.urls, transport=self.transport, **kwargs)
+
+    def test_read_timeout(self):
+        self.simulator.fail(1, status=None, delay=0.5)
+        wrapper = self.wrapper(timeout=Timeout(connect=1, read=0.1))
+        self.assertRaises(SberNetworkError, wrapper.status, self.order_id)
+        self.assertEqual(wrapper.status(self.order_id)['OrderNumber'], 'A1')
+
+    def test_urlopen_timeout(self):
+        self.simulator.fail(1, status=None, delay=0.5)
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, timeout=0.1)
+        self.assertRaises(SberNetworkError, wrapper.status, self.order_id)
+
+    def test_retry(self):
+        self.simulator.fail(2, status=503)
+        wrapper = self.wrapper(retry=RetryPolicy(attempts=3, backoff=0.01))
+        self.assertEqual(wrapper.status_ext(self.order_id)['orderNumber'], 'A1')
+        self.assertEqual(self.simulator.requests['/payment/rest/getOrderStatusExtended.do'], 3)
+
+        self.simulator.fail(3, status=503)
+        self.assertRaises(SberNetworkError, wrapper.status_ext, self.order_id)
+
+    def test_no_retry_for_refund(self):
+        self.simulator.pay(self.order_id)
+        self.simulator.fail(1, status=503)
+        wrapper = self.wrapper(retry=RetryPolicy(attempts=3, backoff=0.01))
+        self.assertRaises(SberNetworkError, wrapper.refund, self.order_id, 100)
+        self.assertEqual(self.simulator.requests['/payment/rest/refund.do'], 1)
+
+    def test_circuit_breaker(self):
+        now = [0]
+        breaker = CircuitBreaker(failure_rate=0.5, window=4, min_calls=4, cooldown=10, clock=lambda: now[0])
+        wrapper = self.wrapper(breaker=breaker)
+        self.simulator.fail(4, status=500)
+        for _ in range(4):
+            self.assertRaises(SberNetworkError, wrapper.status, self.order_id)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(SberCircuitOpenError, wrapper.status, self.order_id)
+        self.assertEqual(self.simulator.requests['/payment/rest/getOrderStatus.do'], 4)
+
+        now[0] = 10
+        self.simulator.fail(1, status=500)
+        self.assertRaises(SberNetworkError, wrapper.status, self.order_id)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        now[0] = 20
+        wrapper.status(self.order_id)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_cancelled_trial(self):
+        now = [0]
+        breaker = CircuitBreaker(failure_rate=0.5, window=2, min_calls=2, cooldown=10, clock=lambda: now[0])
+        self.simulator.fail(2, status=500)
+
+        async def run():
+            async with AsyncSberWrapper('user', 'password', urls=self.simulator.urls, breaker=breaker,
+                                        coalesce=False) as wrapper:
+                for _ in range(2):
+                    with self.assertRaises(SberNetworkError):
+                        await wrapper.status(self.order_id)
+                now[0] = 10
+                self.simulator.fail(1, status=None, delay=0.5)
+                with self.assertRaises(asyncio.TimeoutError):
+                    await asyncio.wait_for(wrapper.status(self.order_id), 0.05)
+                self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+                # trial slot is free again
+                await wrapper.status(self.order_id)
+                self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        asyncio.run(run())
+
+    def test_backoff(self):
+        policy = RetryPolicy(attempts=5, backoff=0.1, max_backoff=0.3, jitter=False)
+        self.assertEqual(list(policy.delays()), [0.1, 0.2, 0.3, 0.3])
+        policy.jitter = True
+        self.assertTrue(all(0 <= delay <= 0.3 for delay in policy.delays()))
+
+
+class RecordingHook(MetricsHook):
+
+    def __init__(self):
+        self.stages, self.errors, self.calls = [], [], []
+
+    def observe(self, method, stage, seconds, context=None):
+        self.stages.append((method, stage))
+
+    def error(self, method, code, context=None):
+        self.errors.append((method, code))
+
+    def finish(self, method, seconds, error=None, context=None):
+        self.calls.append((method, type(error).__name__ if error else None))
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator().start()
+        self.order_id = self.simulator._register(dict(orderNumber='A1', amount=100))['orderId']
+        self.hook = RecordingHook()
+
+    def tearDown(self):
+        self.simulator.stop()
+
+    def test_pooled_transport(self):
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport=PooledTransport(),
+                              metrics=self.hook)
+        wrapper.status(self.order_id)
+        wrapper.status(self.order_id)
+        self.assertRaises(SberRequestError, wrapper.refund, self.order_id, 100)
+        self.assertEqual(self.hook.stages, [('status', 'connect'), ('status', 'ttfb'), ('status', 'decode'),
+                                            ('status', 'ttfb'), ('status', 'decode'),
+                                            ('refund', 'ttfb'), ('refund', 'decode')])
+        self.assertEqual(self.hook.errors, [('refund', '7')])
+        self.assertEqual(self.hook.calls, [('status', None), ('status', None), ('refund', 'SberRequestError')])
+
+    def test_urlopen(self):
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, metrics=self.hook)
+        wrapper.status_ext(self.order_id)
+        self.assertEqual(self.hook.stages, [('status_ext', 'ttfb'), ('status_ext', 'decode')])
+
+    def test_async(self):
+        async def run():
+            async with AsyncSberWrapper('user', 'password', urls=self.simulator.urls, metrics=self.hook) as wrapper:
+                await wrapper.status(self.order_id)
+        asyncio.run(run())
+        self.assertEqual(self.hook.stages, [('status', 'connect'), ('status', 'ttfb'), ('status', 'decode')])
+        self.assertEqual(self.hook.calls, [('status', None)])
+
+    def test_open_telemetry(self):
+        class Span(dict):
+            ended = False
+            def set_attribute(self, key, value):
+                self[key] = value
+            def record_exception(self, error):
+                self['error'] = error
+            def end(self):
+                self.ended = True
+
+        class Tracer(list):
+            def start_span(self, name):
+                self.append((name, Span()))
+                return self[-1][1]
+
+        tracer = Tracer()
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport=PooledTransport(),
+                              metrics=OpenTelemetryHook(tracer))
+        self.assertRaises(SberRequestError, wrapper.status_ext, 'unknown')
+        name, span = tracer[0]
+        self.assertEqual(name, 'sberbank.status_ext')
+        self.assertTrue(span.ended)
+        self.assertEqual(span['sberbank.error_code'], '6')
+        self.assertIn('sberbank.ttfb_seconds', span)
+        self.assertIsInstance(span['error'], SberRequestError)
+
+    def test_open_telemetry_profiler(self):
+        class Span(dict):
+            def set_attribute(self, key, value):
+                self[key] = value
+            def end(self):
+                pass
+
+        class Tracer(list):
+            def start_span(self, name):
+                self.append(Span())
+                return self[-1]
+
+        tracer = Tracer()
+        profiler = Profiler(hook=OpenTelemetryHook(tracer))
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, metrics=profiler)
+        self.assertEqual(wrapper.status(self.order_id)['OrderStatus'], 0)
+        span, = tracer
+        self.assertIn('sberbank.decode_seconds', span)
+        self.assertEqual(profiler.stats()['status']['build']['count'], 1)
+
+
+class ResponsesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator().start()
+        self.order_id = self.simulator._register(dict(orderNumber='A1', amount=100))['orderId']
+        self.simulator.pay(self.order_id)
+
+    def tearDown(self):
+        self.simulator.stop()
+
+    def test_typed_status(self):
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, typed=True)
+        for result in (wrapper.status(self.order_id), wrapper.status_ext(self.order_id)):
+            self.assertIsInstance(result, OrderStatusInfo)
+            self.assertEqual(result.order_number, 'A1')
+            self.assertEqual(result.status, SberWrapper.OrderStatus.DEPOSITED)
+            self.assertEqual(result.amount, 100)
+            self.assertEqual(result.card.pan, '411111**1111')
+            self.assertFalse(hasattr(result, '__dict__'))
+
+    def test_typed_async(self):
+        async def run():
+            async with AsyncSberWrapper('user', 'password', urls=self.simulator.urls, typed=True) as wrapper:
+                return await wrapper.status_ext(self.order_id)
+        self.assertEqual(asyncio.run(run()).status, SberWrapper.OrderStatus.DEPOSITED)
+
+    def test_decoder(self):
+        bodies = []
+
+        def decoder(body):
+            bodies.append(body)
+            return json.loads(body)
+
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, decoder=decoder)
+        self.assertEqual(wrapper.status(self.order_id)['OrderNumber'], 'A1')
+        self.assertIsInstance(bodies[0], bytes)
+
+    def test_invalid_body(self):
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, decoder=lambda body: json.loads(b'{'))
+        self.assertRaises(SberError, wrapper.status, self.order_id)
+
+
+class ClientPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator().start()
+        self.pool = SberClientPool(urls=self.simulator.urls)
+        for number in range(40):
+            self.pool.add('store-{0}'.format(number), 'user-{0}'.format(number), 'password')
+
+    def tearDown(self):
+        self.pool.close()
+        self.simulator.stop()
+
+    def test_shared_transport(self):
+        self.assertEqual(len(self.pool._clients), 0)
+        for number in range(40):
+            self.pool['store-{0}'.format(number)].register(str(number), 100, 'https://u6.ru/')
+        self.assertEqual(len(self.pool._clients), 40)
+        self.assertEqual(len(self.pool._transports), 1)
+        transport = self.pool.transport(True)
+        self.assertTrue(all(client.transport is transport for client in self.pool._clients.values()))
+        self.assertEqual(sum(len(idle) for idle in transport._idle.values()), 1)
+        self.assertIs(self.pool.get('store-1'), self.pool['store-1'])
+        self.assertRaises(KeyError, self.pool.get, 'unknown')
+
+    def test_environments(self):
+        self.pool.add('prod', 'user', 'password', test_env=False)
+        self.assertIsNot(self.pool.transport(False), self.pool.transport(True))
+        self.pool.add('store-1', 'user', 'new password')
+        self.assertEqual(self.pool['store-1']._password, 'new password')
+
+    def test_rate_limit(self):
+        self.pool.add('limited', 'user', 'password', rate=1000, burst=1)
+        limiter = self.pool['limited'].limiter
+        self.assertIsInstance(limiter, TokenBucket)
+        self.assertIsNone(self.pool['store-1'].limiter)
+
+    def test_reserved_options(self):
+        for option in ('transport', 'limiter'):
+            self.assertRaisesRegex(TypeError, 'options {0}$'.format(option), SberClientPool,
+                                   urls=self.simulator.urls, **{option: None})
+
+    def test_dns_cache(self):
+        calls = []
+        resolve = self.pool.resolver.resolve
+
+        def counting_resolve(host, port):
+            calls.append(host)
+            return resolve(host, port)
+
+        self.pool.resolver.resolve = counting_resolve
+        self.pool['store-1'].register('1', 100, 'https://u6.ru/')
+        self.assertEqual(calls, ['127.0.0.1'])
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def test_acquire(self):
+        now = [0.0]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+
+        bucket = TokenBucket(rate=10, burst=2, clock=lambda: now[0], sleep=sleep)
+        for _ in range(4):
+            bucket.acquire('status')
+        self.assertEqual(len(sleeps), 2)
+        self.assertAlmostEqual(now[0], 0.2)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def wait_queued(self, limiter, method, depth):
+        for _ in range(1000):
+            if limiter.queue_depth(method) == depth:
+                return
+            threading.Event().wait(0.001)
+        self.fail('queue depth {0} is not reached'.format(depth))
+
+    def test_priority_threads(self):
+        limiter = RateLimiter(status=(20, 1))
+        limiter.acquire('status')
+        order = []
+
+        def call(name, value):
+            with priority(value):
+                limiter.acquire('status_ext')
+            order.append(name)
+
+        threads = [threading.Thread(target=call, args=('batch', BATCH))]
+        threads[0].start()
+        self.wait_queued(limiter, 'status', 1)
+        threads.append(threading.Thread(target=call, args=('interactive', INTERACTIVE)))
+        threads[1].start()
+        self.wait_queued(limiter, 'status', 2)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['interactive', 'batch'])
+        stats = limiter.stats()['status']
+        self.assertEqual((stats['queued'], stats['max_queued'], stats['acquired']), (0, 2, 3))
+        # waits of both threads are counted: tokens are refilled at 20 per second, the batch one waits for two
+        self.assertGreaterEqual(stats['waited'], 0.05 + 0.1 - 0.02)
+        # other families aren't limited
+        for _ in range(10):
+            limiter.acquire('register')
+
+    def test_priority_async(self):
+        limiter = RateLimiter(refund=(20, 1))
+        order = []
+
+        async def call(name, value):
+            with priority(value):
+                await limiter.acquire_async('refund')
+            order.append(name)
+
+        async def run():
+            await limiter.acquire_async('refund')
+            tasks = [asyncio.ensure_future(call('batch-{0}'.format(i), BATCH)) for i in range(2)]
+            await asyncio.sleep(0)
+            tasks.append(asyncio.ensure_future(call('interactive', INTERACTIVE)))
+            await asyncio.sleep(0)
+            self.assertEqual(limiter.queue_depth('refund'), 3)
+            # cancelled waiter leaves the queue
+            tasks[0].cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run(run())
+        self.assertEqual(order, ['interactive', 'batch-1'])
+        self.assertEqual(limiter.queue_depth('refund'), 0)
+
+    def test_wrapper(self):
+        with SberSimulator() as simulator:
+            order_id = simulator._register(dict(orderNumber='A1', amount=100))['orderId']
+            limiter = RateLimiter(status=(1000, 1))
+            wrapper = SberWrapper('user', 'password', urls=simulator.urls, limiter=limiter, coalesce=False)
+            with priority(BATCH):
+                results = list(wrapper.status_many([order_id] * 4, concurrency=4))
+            self.assertTrue(all(result.error is None for result in results))
+
+            async def run():
+                async with AsyncSberWrapper('user', 'password', urls=simulator.urls, limiter=limiter) as wrapper:
+                    await wrapper.status(order_id)
+            asyncio.run(run())
+            self.assertEqual(limiter.stats()['status']['acquired'], 5)
+
+    def test_retries(self):
+        with SberSimulator() as simulator:
+            order_id = simulator._register(dict(orderNumber='A1', amount=100))['orderId']
+            limiter = RateLimiter(status=(1000, 1))
+            wrapper = SberWrapper('user', 'password', urls=simulator.urls, limiter=limiter,
+                                  retry=RetryPolicy(attempts=3, backoff=0.001))
+            simulator.fail(2, status=503)
+            wrapper.status_ext(order_id)
+
+            async def run():
+                async with AsyncSberWrapper('user', 'password', urls=simulator.urls, limiter=limiter,
+                                            retry=RetryPolicy(attempts=3, backoff=0.001)) as wrapper:
+                    simulator.fail(1, status=503)
+                    await wrapper.status_ext(order_id)
+            asyncio.run(run())
+            # every attempt takes a token
+            self.assertEqual(limiter.stats()['status']['acquired'], 5)
+
+
+class BatchRefundTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator().start()
+        self.wrapper = SberWrapper('user', 'password', urls=self.simulator.urls)
+        self.orders = []
+        for number in range(5):
+            order_id = self.simulator._register(dict(orderNumber='R{0}'.format(number), amount=100))['orderId']
+            self.simulator.pay(order_id)
+            self.orders.append(order_id)
+        self.journal = RefundJournal(':memory:')
+
+    def tearDown(self):
+        self.journal.close()
+        self.simulator.stop()
+
+    def test_csv(self):
+        stream = io.StringIO('order_id,amount\n{0},100\n\n{1}, 50\n'.format(*self.orders))
+        self.assertEqual(list(read_csv(stream)), [(self.orders[0], 100), (self.orders[1], 50)])
+
+    def test_run(self):
+        unpaid = self.simulator._register(dict(orderNumber='R5', amount=100))['orderId']
+        # refunded by the previous run
+        self.journal.record(self.orders[0], 100, DONE, 'Success')
+        # previous run crashed after the refund was sent
+        self.simulator._refund(dict(orderId=self.orders[1], amount='100'))
+        self.journal.record(self.orders[1], 100, STARTED, refunded=0)
+        # previous run got network error before the refund was sent
+        self.journal.record(self.orders[2], 100, UNCERTAIN, 'network error')
+
+        pipeline = BatchRefund(self.wrapper, self.journal, concurrency=2)
+        rows = iter([(order_id, 100) for order_id in self.orders] + [(unpaid, 100)])
+        results = {result.key[0]: result for result in pipeline.run(rows)}
+        self.assertNotIn(self.orders[0], results)
+        self.assertEqual(results[self.orders[1]].result, 'verified')
+        self.assertEqual(results[unpaid].error.code, '7')
+        self.assertEqual(tuple(pipeline.stats), (3, 1, 1, 1, 0))
+        self.assertEqual(self.simulator.requests['/payment/rest/refund.do'], 4)
+        self.assertEqual([order['refunded'] for order in self.simulator.orders.values()], [0] + [100] * 4 + [0])
+        self.assertEqual([state for _, state, _, _ in self.journal.history(self.orders[2])],
+                         [UNCERTAIN, STARTED, DONE])
+
+        # all orders are refunded, nothing to do on restart
+        results = list(BatchRefund(self.wrapper, self.journal).run((order_id, 100) for order_id in self.orders))
+        self.assertEqual(results, [])
+
+    def test_stale_store(self):
+        store = OrderStore(':memory:')
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, store=store)
+        self.assertEqual(wrapper.status_ext(self.orders[0])['orderStatus'], 2)
+        # previous run crashed after the refund was sent, the store still has the paid order
+        self.simulator._refund(dict(orderId=self.orders[0], amount='100'))
+        self.journal.record(self.orders[0], 100, STARTED, refunded=0)
+        result, = BatchRefund(wrapper, self.journal).run([(self.orders[0], 100)])
+        self.assertEqual(result.result, 'verified')
+        self.assertEqual(self.simulator.requests.get('/payment/rest/refund.do', 0), 0)
+        self.assertEqual(self.simulator.orders[self.orders[0]]['refunded'], 100)
+        self.assertEqual(wrapper.status_ext(self.orders[0])['orderStatus'], 4)
+        store.close()
+
+    def test_typed(self):
+        wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, typed=True)
+        self.simulator._refund(dict(orderId=self.orders[0], amount='100'))
+        self.journal.record(self.orders[0], 100, STARTED, refunded=0)
+        result, = BatchRefund(wrapper, self.journal).run([(self.orders[0], 100)])
+        self.assertEqual(result.result, 'verified')
+        self.assertEqual(self.simulator.orders[self.orders[0]]['refunded'], 100)
+
+    def test_earlier_refund(self):
+        # refunded before the batch, then the batch crashed before its refund reached the bank
+        self.simulator._refund(dict(orderId=self.orders[0], amount='40'))
+        self.journal.record(self.orders[0], 50, STARTED, refunded=40)
+        result, = BatchRefund(self.wrapper, self.journal).run([(self.orders[0], 50)])
+        self.assertEqual(result.result, 'Success')
+        self.assertEqual(self.simulator.orders[self.orders[0]]['refunded'], 90)
+        self.assertEqual(self.journal.baseline(self.orders[0]), 40)
+
+        # crashed after the refund: verified against the baseline of the last attempt
+        self.journal.record(self.orders[0], 10, STARTED, refunded=90)
+        self.simulator._refund(dict(orderId=self.orders[0], amount='10'))
+        result, = BatchRefund(self.wrapper, self.journal).run([(self.orders[0], 10)])
+        self.assertEqual(result.result, 'verified')
+        self.assertEqual(self.simulator.orders[self.orders[0]]['refunded'], 100)
+
+    def test_network_error(self):
+        # status_ext of the refunded amount passes, refund fails
+        self.simulator.fail(1, status=None)
+        self.simulator.fail(1)
+        pipeline = BatchRefund(self.wrapper, self.journal, concurrency=1)
+        result, = pipeline.run([(self.orders[0], 100)])
+        self.assertIsInstance(result.error, SberNetworkError)
+        self.assertEqual(self.journal.state(self.orders[0]), UNCERTAIN)
+        self.assertEqual(pipeline.stats.uncertain, 1)
+
+
+class BatchCaptureTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator(latency=0.01).start()
+        self.wrapper = SberWrapper('user', 'password', urls=self.simulator.urls,
+                                   transport=PooledTransport(maxsize=16))
+        self.orders = []
+        for number in range(64):
+            order_id = self.simulator._registerPreAuth(dict(orderNumber='C{0}'.format(number),
+                                                            amount=100))['orderId']
+            self.simulator.pay(order_id)
+            self.orders.append(order_id)
+
+    def tearDown(self):
+        self.wrapper.transport.close()
+        self.simulator.stop()
+
+    def test_run(self):
+        unpaid = self.simulator._registerPreAuth(dict(orderNumber='C64', amount=100))['orderId']
+        rows = [(order_id, 0) for order_id in self.orders[:60]] + \
+            [(order_id, 0, REVERSE) for order_id in self.orders[60:]] + [(unpaid, 0)]
+        capture = BatchCapture(self.wrapper, concurrency=16)
+        results = {result.order_id: result for result in capture.run(iter(rows))}
+        self.assertEqual(len(results), 65)
+        self.assertEqual(self.simulator.orders[self.orders[0]]['status'], 2)
+        self.assertEqual(self.simulator.orders[self.orders[-1]]['status'], 3)
+        self.assertEqual(results[unpaid].error.code, '7')
+        self.assertEqual(results[self.orders[-1]].operation, REVERSE)
+        self.assertEqual(capture.stats[:4], (60, 4, 1, 0))
+        self.assertTrue(0.01 <= capture.stats.p50 <= capture.stats.p99)
+        self.assertGreater(capture.stats.rate, 0)
+
+    def test_network_error(self):
+        self.simulator.fail(1, status=503)
+        capture = BatchCapture(self.wrapper, concurrency=1)
+        results = list(capture.run([(self.orders[0], 50), (self.orders[1], 0)]))
+        self.assertIsInstance(results[0].error, SberNetworkError)
+        self.assertEqual(capture.stats[:4], (1, 0, 0, 1))
+        self.assertEqual(self.simulator.orders[self.orders[1]]['deposited'], 100)
+
+    def test_invalid_row(self):
+        capture = BatchCapture(self.wrapper, concurrency=2)
+        results = {result.order_id: result for result in capture.run([(self.orders[0], 0, 'refund'),
+                                                                      (self.orders[1], 0)])}
+        self.assertIsInstance(results[self.orders[0]].error, ValueError)
+        self.assertIsNone(results[self.orders[1]].error)
+        self.assertEqual(capture.stats[:5], (1, 0, 0, 0, 1))
+        self.assertEqual(self.simulator.orders[self.orders[0]]['status'], 1)
+
+
+class SoapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator().start()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        soap._services.clear()
+        self.wsdl_path = '/payment/webservices/merchant-ws'
+
+    def tearDown(self):
+        soap._services.clear()
+        self.cache_dir.cleanup()
+        self.simulator.stop()
+
+    def wrapper(self, **kwargs):
+        return SberWrapper('user', 'pass<&>', soap=True, wsdl=self.simulator.wsdl_url,
+                           wsdl_cache=self.cache_dir.name, **kwargs)
+
+    def test_methods(self):
+        for wrapper in (self.wrapper(), self.wrapper(transport=PooledTransport())):
+            order_id, form_url = wrapper.register('S{0}'.format(id(wrapper)), 100, 'https://example.com/?a=1&b=2',
+                                                  description='<b>', extra={'email': 'user@example.com'})
+            self.assertTrue(form_url.endswith(order_id))
+            self.simulator.pay(order_id)
+            self.assertEqual(wrapper.status(order_id)['OrderStatus'], 2)
+            self.assertEqual(wrapper.refund(order_id, 40), 'Success')
+            response = wrapper.status_ext(order_id)
+            self.assertEqual((response['orderStatus'], response['paymentAmountInfo']['refundedAmount']), (2, 40))
+            self.assertEqual(response['cardAuthInfo']['pan'], '411111**1111')
+            with self.assertRaises(SberRequestError) as error:
+                wrapper.status('unknown')
+            self.assertEqual(error.exception.code, '6')
+
+    def test_two_steps(self):
+        wrapper = self.wrapper()
+        held, _ = wrapper.register('S1', 100, 'https://example.com/', is_pre_auth=True)
+        cancelled, _ = wrapper.register('S2', 100, 'https://example.com/', is_pre_auth=True)
+        self.simulator.pay(held)
+        self.simulator.pay(cancelled)
+        self.assertEqual(wrapper.deposit(held, 70), 'Success')
+        self.assertEqual(wrapper.status_ext(held)['paymentAmountInfo']['depositedAmount'], 70)
+        self.assertEqual(wrapper.reverse(cancelled), 'Success')
+        self.assertEqual(wrapper.status(cancelled)['OrderStatus'], 3)
+
+    def test_envelope(self):
+        service = soap.parse_wsdl(self.simulator.wsdl().encode('utf-8'))
+        self.assertEqual(service['endpoint'], self.simulator.soap_url)
+        client = soap.SoapClient(service, 'user', 'pass<&>')
+        method, url, body, headers = client.prepare('refundOrder', dict(orderId='976495d3', amount=100))
+        self.assertEqual((method, url, headers['SOAPAction']), ('POST', self.simulator.soap_url, '""'))
+        self.assertIn(b'<wsse:Password Type="', body)
+        self.assertIn(b'>pass&lt;&amp;&gt;</wsse:Password>', body)
+        self.assertIn(b'<order orderId="976495d3" refundAmount="100"></order>', body)
+        with self.assertRaises(ValueError):
+            client.prepare('deleteOrder', {})
+
+    def test_service_cache(self):
+        for _ in range(2):
+            with self.assertRaises(SberRequestError):
+                self.wrapper().status_ext('unknown')
+        # one WSDL download, two calls
+        self.assertEqual(self.simulator.requests[self.wsdl_path], 3)
+        # new process loads compiled service from disk
+        soap._services.clear()
+        with self.assertRaises(SberRequestError):
+            self.wrapper().status_ext('unknown')
+        self.assertEqual(self.simulator.requests[self.wsdl_path], 4)
+
+    def test_fault(self):
+        body = self.simulator._soap_fault('soap:Server', 'Internal error')
+        with self.assertRaises(SberRequestError) as error:
+            soap.parse_reply(body)
+        self.assertEqual(error.exception.code, 'soap:Server')
+        wrapper = self.wrapper()
+        with self.assertRaises(SberRequestError):
+            wrapper.status('unknown')
+        # status 500 without SOAP fault
+        self.simulator.fail(1, status=500)
+        with self.assertRaises(SberNetworkError):
+            wrapper.status('unknown')
+
+
+class CallbackTestCase(unittest.TestCase):
+    key = b'store secret'
+
+    def setUp(self):
+        self.processor = CallbackProcessor(self.key, workers=2)
+        self.received = []
+        self.processor.add_handler(self.received.append)
+
+    def tearDown(self):
+        self.processor.close()
+
+    def params(self, order_id='976495d3', operation='deposited', status='1', **params):
+        params = dict(mdOrder=order_id, orderNumber='A1', operation=operation, status=status, amount='100',
+                      **params)
+        params['checksum'] = checksum(params, self.key)
+        return params
+
+    def test_checksum(self):
+        params = self.params()
+        message = b'amount;100;mdOrder;976495d3;operation;deposited;orderNumber;A1;status;1;'
+        self.assertEqual(params['checksum'], hmac.new(self.key, message, hashlib.sha256).hexdigest().upper())
+        with self.assertRaises(SberChecksumError):
+            self.processor.process(dict(params, amount='1000000'))
+        with self.assertRaises(SberChecksumError):
+            self.processor.process(dict(params, checksum=''))
+        self.assertEqual(self.processor.stats()['rejected'], 2)
+
+    def test_dispatch(self):
+        deposited = []
+        self.processor.add_handler(deposited.append, 'deposited')
+        self.processor.add_handler(lambda notification: 1 / 0, 'refunded')
+        for operation in ('approved', 'deposited', 'refunded'):
+            self.processor.process(self.params(operation=operation))
+        notification = self.processor.process(self.params('1', operation='declinedByTimeout', status='0'))
+        self.processor.close()
+
+        self.assertIsInstance(notification, Notification)
+        self.assertIsInstance(notification, OrderStatusInfo)
+        self.assertEqual((notification.success, notification.status), (False, None))
+        # one order is handled by one worker in order of arrival
+        self.assertEqual([item.status for item in self.received if item.order_id == '976495d3'],
+                         [SberWrapper.OrderStatus.APPROVED, SberWrapper.OrderStatus.DEPOSITED,
+                          SberWrapper.OrderStatus.REFUNDED])
+        self.assertEqual((deposited[0].order_number, deposited[0].amount), ('A1', 100))
+        self.assertEqual(self.processor.stats(), dict(received=4, rejected=0, handled=5, failed=1, queued=0))
+
+    def test_cache(self):
+        with SberSimulator() as simulator:
+            order_id = simulator._register(dict(orderNumber='A1', amount=100))['orderId']
+            cache = StatusCache(ttl=60)
+            wrapper = SberWrapper('user', 'password', urls=simulator.urls, cache=cache)
+            self.assertEqual(wrapper.status(order_id)['OrderStatus'], 0)
+            simulator.pay(order_id)
+            processor = CallbackProcessor(self.key, cache=cache)
+            processor.process(self.params(order_id))
+            processor.close()
+            # notified status is served from the cache
+            self.assertEqual(wrapper.status(order_id)['OrderStatus'], 2)
+            self.assertEqual(cache.get(order_id, 'status', 'RU')['OrderStatus'], 2)
+            self.assertEqual(simulator.requests['/payment/rest/getOrderStatus.do'], 1)
+            processor.process(self.params(order_id, operation='refunded'))
+            processor.close()
+            self.assertIsNone(cache.get(order_id, 'status', 'RU'))
+
+    def test_store(self):
+        with SberSimulator() as simulator, OrderStore(':memory:') as store:
+            paid, created = [simulator._register(dict(orderNumber=number, amount=100))['orderId']
+                             for number in ('A1', 'A2')]
+            simulator.pay(paid)
+            wrapper = SberWrapper('user', 'password', urls=simulator.urls, store=store)
+            for order_id in (paid, created):
+                wrapper.status_ext(order_id)
+            self.assertEqual(store.order(paid).final, 1)
+            simulator.orders[paid].update(refunded=100, status=4)
+            processor = CallbackProcessor(self.key, store=store)
+            processor.process(self.params(paid, operation='refunded'))
+            processor.process(self.params(created))
+            processor.close()
+            # refunded order is open, it isn't answered from the store
+            self.assertEqual(store.order(paid).final, 0)
+            self.assertEqual(wrapper.status_ext(paid)['orderStatus'], 4)
+            self.assertEqual(store.order(paid).status, SberWrapper.OrderStatus.REFUNDED.value)
+            record = store.order(created)
+            self.assertEqual((record.status, record.final), (SberWrapper.OrderStatus.DEPOSITED.value, 0))
+
+    def test_unverified(self):
+        with self.assertRaises(TypeError):
+            CallbackProcessor(cache=StatusCache(ttl=60))
+        with OrderStore(':memory:') as store:
+            self.assertRaises(TypeError, CallbackProcessor, None, store=store)
+
+    def test_wsgi(self):
+        def call(method, params):
+            query = urllib.parse.urlencode(params)
+            environ = dict(REQUEST_METHOD=method, QUERY_STRING=query if method == 'GET' else '',
+                           CONTENT_LENGTH=str(len(query)), **{'wsgi.input': io.BytesIO(query.encode())})
+            statuses = []
+            body = self.processor.wsgi(environ, lambda status, headers: statuses.append(status))
+            return statuses[0], b''.join(body)
+
+        self.assertEqual(call('GET', self.params()), ('200 OK', b'OK'))
+        self.assertEqual(call('POST', self.params()), ('200 OK', b'OK'))
+        self.assertEqual(call('GET', dict(self.params(), status='0'))[0], '403 Forbidden')
+        self.assertEqual(call('GET', dict(checksum=checksum({}, self.key)))[0], '400 Bad Request')
+
+    def test_asgi(self):
+        async def call(params, processor=self.processor):
+            body = urllib.parse.urlencode(params).encode()
+            messages = [dict(type='http.request', body=body[:10], more_body=True),
+                        dict(type='http.request', body=body[10:])]
+            sent = []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message)
+            await processor.asgi(dict(type='http', method='POST'), receive, send)
+            return sent[0]['status'], sent[1]['body']
+
+        self.assertEqual(asyncio.run(call(self.params())), (200, b'OK'))
+        self.assertEqual(asyncio.run(call(dict(self.params(), amount='1'))), (403, b'Wrong checksum'))
+
+        class Store(object):
+            threads = []
+
+            def update_status(self, order_id, status):
+                self.threads.append(threading.current_thread())
+        processor = CallbackProcessor(self.key, store=Store())
+        self.assertEqual(asyncio.run(call(self.params(), processor)), (200, b'OK'))
+        processor.close()
+        # SQLite store isn't called by the event loop thread
+        self.assertNotIn(threading.current_thread(), Store.threads)
+        self.assertEqual(len(Store.threads), 1)
+
+    def test_backpressure(self):
+        release = threading.Event()
+        processor = CallbackProcessor(self.key, workers=1, queue_size=1, timeout=0.01)
+        processor.add_handler(lambda notification: release.wait())
+        processor.process(self.params('1'))
+        # the first is taken by the worker, the second waits in the queue
+        for _ in range(100):
+            if processor.queue_depth() == 0:
+                break
+            threading.Event().wait(0.01)
+        processor.process(self.params('2'))
+        environ = dict(REQUEST_METHOD='GET', QUERY_STRING=urllib.parse.urlencode(self.params('3')))
+        statuses = []
+        processor.wsgi(environ, lambda status, headers: statuses.append(status))
+        self.assertEqual(statuses, ['503 Service Unavailable'])
+        release.set()
+        processor.close()
+        self.assertEqual(processor.stats()['handled'], 2)
+
+
+class StatusPollerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = SberSimulator().start()
+        self.transport = PooledTransport(maxsize=4)
+        self.wrapper = SberWrapper('user', 'password', urls=self.simulator.urls, transport=self.transport,
+                                   coalesce=False)
+        self.poller = StatusPoller(self.wrapper, interval=0.01, max_interval=0.04, concurrency=4)
+        self.orders = [self.simulator._register(dict(orderNumber='P{0}'.format(number), amount=100))['orderId']
+                       for number in range(20)]
+
+    def tearDown(self):
+        self.poller.close()
+        self.transport.close()
+        self.simulator.stop()
+
+    def test_watch(self):
+        results = {}
+        for order_id in self.orders:
+            self.poller.watch(order_id, timeout=0.5, callback=lambda result: results.update({result.order_id: result}))
+        self.poller.watch('unknown', callback=lambda result: results.update({result.order_id: result}))
+        self.assertEqual(len(self.poller), 21)
+        for order_id in self.orders[:10]:
+            self.simulator.pay(order_id)
+        self.simulator.decline(self.orders[10])
+        self.poller.unwatch(self.orders[11])
+        self.assertTrue(self.poller.wait(5))
+
+        self.assertEqual(len(results), 20)
+        for order_id in self.orders[:10]:
+            self.assertEqual(results[order_id].response['OrderStatus'], 2)
+            self.assertFalse(results[order_id].expired)
+        self.assertEqual(results['unknown'].error.code, '6')
+        self.assertEqual(results[self.orders[10]].error.code, '2')
+        for order_id in self.orders[12:]:
+            self.assertTrue(results[order_id].expired)
+            self.assertEqual(results[order_id].response['OrderStatus'], 0)
+
+    def test_backoff(self):
+        self.poller.watch(self.orders[0], timeout=0.3)
+        self.assertTrue(self.poller.wait(5))
+        # intervals 0.01, 0.015, 0.0225, 0.03375 and 0.04 afterwards
+        self.assertLess(self.poller.polls, 12)
+        self.assertEqual(self.poller.polls, self.simulator.requests['/payment/rest/getOrderStatus.do'])
+
+    def test_rate(self):
+        poller = StatusPoller(self.wrapper, interval=0.0, max_interval=0.0, rate=100)
+        started = time.monotonic()
+        for order_id in self.orders:
+            poller.watch(order_id, timeout=0.2)
+        poller.wait(5)
+        poller.close()
+        self.assertLessEqual(poller.polls, (time.monotonic() - started) * 100 + 100)
+
+    def test_results(self):
+        async def collect():
+            for order_id in self.orders[:5]:
+                self.poller.watch(order_id, timeout=5, callback=lambda result: None)
+                self.simulator.pay(order_id)
+            return [result async for result in self.poller.results()]
+        results = asyncio.run(collect())
+        self.assertEqual(sorted(result.order_id for result in results), sorted(self.orders[:5]))
+
+
+class RecordingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = path.join(self.directory.name, 'traffic.sbr')
+        with SberSimulator() as simulator:
+            transport = RecordingTransport(self.path)
+            wrapper = SberWrapper('shop-login', 'top-secret', urls=simulator.urls, transport=transport, coalesce=False)
+            self.order_id, _ = wrapper.register('A1', 100, 'https://example.com/')
+            wrapper.status(self.order_id)
+            simulator.pay(self.order_id)
+            wrapper.status(self.order_id)
+            get_wrapper = SberWrapper('shop-login', 'top-secret', post=False, urls=simulator.urls, transport=transport)
+            get_wrapper.status_ext(self.order_id)
+            soap_wrapper = SberWrapper('shop-login', 'top-secret', soap=True, wsdl=simulator.wsdl_url,
+                                       wsdl_cache=False, transport=transport)
+            soap_wrapper.status_ext(self.order_id)
+            transport.close()
+            self.urls = simulator.urls
+            self.wsdl = simulator.wsdl()
+            soap._services.clear()
+
+    def tearDown(self):
+        soap._services.clear()
+        self.directory.cleanup()
+
+    def test_redacted(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self.assertNotIn(b'top-secret', data)
+        self.assertNotIn(b'shop-login', data)
+        self.assertIn(b'userName=***&password=***', data)
+        self.assertIn(b'<wsse:Password Type=', data)
+
+    def test_replay(self):
+        transport = ReplayTransport(self.path)
+        self.assertEqual(len(transport), 5)
+        wrapper = SberWrapper('other', 'credentials', urls=self.urls, transport=transport, coalesce=False)
+        self.assertEqual(wrapper.register('A1', 100, 'https://example.com/')[0], self.order_id)
+        # replies of the same request are replayed in order, cyclically
+        self.assertEqual([wrapper.status(self.order_id)['OrderStatus'] for _ in range(3)], [0, 2, 0])
+        get_wrapper = SberWrapper('other', 'credentials', post=False, urls=self.urls, transport=transport)
+        self.assertEqual(get_wrapper.status_ext(self.order_id)['orderStatus'], 2)
+        with tempfile.NamedTemporaryFile('w', suffix='.wsdl') as wsdl:
+            wsdl.write(self.wsdl)
+            wsdl.flush()
+            soap_wrapper = SberWrapper('other', 'credentials', soap=True, wsdl=wsdl.name, wsdl_cache=False,
+                                       transport=transport)
+            self.assertEqual(soap_wrapper.status_ext(self.order_id)['orderStatus'], 2)
+        with self.assertRaises(SberError) as error:
+            wrapper.register('A2', 100, 'https://example.com/')
+        self.assertIsInstance(error.exception.args[0], ReplayMissError)
+        transport.close()
+
+    def test_ignore_and_latency(self):
+        delays = []
+        transport = ReplayTransport(self.path, latency=2.0, ignore=('orderNumber',), sleep=delays.append)
+        wrapper = SberWrapper('other', 'credentials', urls=self.urls, transport=transport)
+        self.assertEqual(wrapper.register('A2', 100, 'https://example.com/')[0], self.order_id)
+        self.assertEqual(len(delays), 1)
+        self.assertGreater(delays[0], 0)
+        transport.close()
+
+    def test_truncated(self):
+        with open(self.path, 'ab') as f:
+            f.write(b'\x10\x00')
+        transport = ReplayTransport(self.path)
+        self.assertEqual(len(transport), 5)
+        transport.close()
+        with open(self.path, 'wb') as f:
+            f.write(b'not a recording')
+        self.assertRaises(ValueError, ReplayTransport, self.path)
+
+    def test_async(self):
+        async def run():
+            with SberSimulator() as simulator:
+                transport = AsyncRecordingTransport(self.path)
+                async with AsyncSberWrapper('shop-login', 'top-secret', urls=simulator.urls,
+                                            transport=transport) as wrapper:
+                    order_id, _ = await wrapper.register('B1', 100, 'https://example.com/')
+            async with AsyncSberWrapper('user', 'password', urls=simulator.urls,
+                                        transport=AsyncReplayTransport(self.path)) as wrapper:
+                self.assertEqual((await wrapper.register('B1', 100, 'https://example.com/'))[0], order_id)
+        asyncio.run(run())
+
 
 def init_logger():
     handler = logging.FileHandler(path.join(path.dirname(path.abspath(__file__)), 'tests.log'), mode='w')
@@ -0,0 +1,348 @@
+#coding=utf8
+# pysberbank transport layer #
+"""
+HTTP layer of SberWrapper. Transport is any object with methods
+
+    request(method, url, body=None, headers=None, timeout=None, trace=None) -> Response
+    close()
+    prewarm(url, connections=1, timeout=None)      # optional
+
+request() returns replies with any HTTP status and raises OSError or http.client.HTTPException
+on network errors. Implementations: UrllibTransport (urlopen, new connection per request),
+PooledTransport (HTTP/1.1 keep-alive) and http2.Http2Transport (HTTP/2 multiplexing, needs httpx).
+They are selected per wrapper by instance or by name, see create_transport.
+"""
+import collections
+import http.client
+import logging
+import socket
+import threading
+import time
+import urllib.parse
+logger = logging.getLogger(__name__)
+
+Response = collections.namedtuple('Response', 'status reason headers body')
+
+
+def split_timeout(timeout):
+    """
+    :param timeout: resilience.Timeout(connect, read), seconds for both or None
+    :return: (connect, read)
+    """
+    if isinstance(timeout, tuple):
+        return timeout
+    return timeout, timeout
+
+
+def split_url(url):
+    """
+    :return: ((scheme, host, port), path with query)
+    """
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+    path = parts.path or '/'
+    if parts.query:
+        path = '{0}?{1}'.format(path, parts.query)
+    return key, path
+
+
+# transport name -> (module, class) for create_transport
+TRANSPORTS = dict(
+    urllib=('transport', 'UrllibTransport'),
+    pooled=('transport', 'PooledTransport'),
+    http2=('http2', 'Http2Transport'),
+)
+
+
+def create_transport(name: str, transports: dict=TRANSPORTS, **options):
+    """
+    :param name: urllib, pooled or http2
+    :param transports: name -> (module of pysberbps, class)
+    :param options: arguments of transport class
+    :raise ValueError: if transport is unknown
+    :raise ImportError: if optional dependency of transport is not installed
+    """
+    if name not in transports:
+        raise ValueError('Unknown transport {0!r}, expected one of {1}'.format(name, ', '.join(sorted(transports))))
+    import importlib
+    module, cls = transports[name]
+    return getattr(importlib.import_module('.' + module, __package__), cls)(**options)
+
+
+class Transport(object):
+    """
+    Base class of transports, implementations override request()
+    """
+    def request(self, method: str, url: str, body: bytes=None, headers: dict=None, timeout=None, trace=None):
+        """
+        Send request and read the whole reply
+        :param timeout: resilience.Timeout(connect, read) or seconds, transport timeout if None
+        :param trace: callable(stage, seconds) receiving connect, tls and ttfb timings
+        :raise OSError, http.client.HTTPException: on network errors
+        :return: Response(status, reason, headers, body)
+        """
+        raise NotImplementedError
+
+    def prewarm(self, url: str, connections: int=1, timeout=None):
+        """
+        Open connections to the host of url ahead of the first request, nothing to do by default
+        """
+
+    def close(self):
+        """Release connections"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class UrllibTransport(Transport):
+    """
+    urllib.request.urlopen with new connection for every request. Honors proxy environment variables
+    and handlers installed with urllib.request.install_opener
+    """
+    def __init__(self, timeout=None, ssl_context=None):
+        """
+        :param timeout: resilience.Timeout(connect, read) or seconds for both (None means global default)
+        :param ssl_context: ssl.SSLContext for https connections
+        """
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+
+    def request(self, method: str, url: str, body: bytes=None, headers: dict=None, timeout=None, trace=None):
+        import urllib.error
+        import urllib.request
+        kwargs = {}
+        timeout = self.timeout if timeout is None else timeout
+        if timeout is not None:
+            # urlopen has one timeout for connecting and reading, the longest one is used
+            kwargs['timeout'] = max(split_timeout(timeout))
+        if self.ssl_context is not None:
+            kwargs['context'] = self.ssl_context
+        started = time.perf_counter()
+        try:
+            response = urllib.request.urlopen(urllib.request.Request(url, body, headers or {}, method=method),
+                                              **kwargs)
+        except urllib.error.HTTPError as e:
+            body = b''
+            try:
+                body = e.read()
+            except (OSError, AttributeError):
+                # HTTPError without reply body
+                pass
+            finally:
+                e.close()
+            return Response(e.code, e.msg, e.headers.items() if e.headers else None, body)
+        with response:
+            if trace is not None:
+                # urlopen connects and waits for headers at once
+                trace('ttfb', time.perf_counter() - started)
+            return Response(response.status, response.reason, response.getheaders(), response.read())
+
+
+class DNSCache(object):
+    """
+    Caches resolved addresses of acquiring hosts for ttl seconds. May be shared between transports
+    """
+    def __init__(self, ttl: float=300.0):
+        """
+        :param ttl: lifetime of resolved addresses, seconds
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # (host, port) -> (expires_at, [sockaddr, ...])
+        self._addresses = {}
+
+    def resolve(self, host: str, port: int):
+        """
+        :return: list of (family, sockaddr) for host
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._addresses.get((host, port))
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        addresses = [(family, sockaddr) for family, _, _, _, sockaddr
+                     in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+        with self._lock:
+            self._addresses[(host, port)] = (now + self.ttl, addresses)
+        return addresses
+
+    def create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        """socket.create_connection replacement using cached addresses"""
+        host, port = address
+        error = None
+        for family, sockaddr in self.resolve(host, port):
+            try:
+                return socket.create_connection(sockaddr[:2], timeout, source_address)
+            except OSError as e:
+                error = e
+        raise error or OSError('Can not resolve {0}'.format(host))
+
+    def clear(self):
+        with self._lock:
+            self._addresses.clear()
+
+
+class PooledTransport(Transport):
+    """
+    HTTP/1.1 keep-alive transport. Keeps idle connections per (scheme, host, port) and reuses them
+    between requests, so TLS handshake is paid once per connection instead of once per call.
+    The number of open connections isn't limited: every concurrent request without an idle connection
+    opens a new one, connections above maxsize are closed when their reply is read.
+    Instance is thread-safe and may be shared by all worker threads.
+    """
+    def __init__(self, maxsize: int=10, idle_timeout: float=60.0, timeout: float=None, ssl_context=None,
+                 resolver: DNSCache=None):
+        """
+        :param maxsize: maximum idle connections kept per host, not a limit of open connections
+        :param idle_timeout: idle connections older than this (seconds) are closed instead of reused
+        :param timeout: resilience.Timeout(connect, read) or seconds for both (None means global default)
+        :param ssl_context: ssl.SSLContext for https connections
+        :param resolver: DNSCache for host names, system resolver on every connect if None
+        """
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self.resolver = resolver
+        self._lock = threading.Lock()
+        # (scheme, host, port) -> deque of (connection, released_at)
+        self._idle = collections.defaultdict(collections.deque)
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, context=self.ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port)
+        if self.resolver is not None:
+            conn._create_connection = self.resolver.create_connection
+        return conn
+
+    def _checkout(self, key):
+        now = time.monotonic()
+        stale = []
+        conn = None
+        with self._lock:
+            idle = self._idle[key]
+            while idle:
+                candidate, released_at = idle.pop()
+                if now - released_at <= self.idle_timeout:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+        for candidate in stale:
+            candidate.close()
+        if conn is not None:
+            return conn, True
+        return self._connect(key), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle[key]
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    @staticmethod
+    def _traced_connect(conn, trace):
+        """Connect reporting TCP connect (with DNS lookup) and TLS handshake time separately"""
+        create_connection = conn._create_connection
+        tcp = []
+
+        def timed_create_connection(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return create_connection(*args, **kwargs)
+            finally:
+                tcp.append(time.perf_counter() - started)
+
+        conn._create_connection = timed_create_connection
+        started = time.perf_counter()
+        try:
+            conn.connect()
+        finally:
+            conn._create_connection = create_connection
+        total = time.perf_counter() - started
+        if tcp:
+            trace('connect', tcp[0])
+            if isinstance(conn, http.client.HTTPSConnection):
+                trace('tls', total - tcp[0])
+
+    def request(self, method: str, url: str, body: bytes=None, headers: dict=None, timeout=None, trace=None):
+        """
+        Send request through a pooled connection
+        :param timeout: resilience.Timeout(connect, read) or seconds, transport timeout if None
+        :param trace: callable(stage, seconds) receiving connect, tls and ttfb timings
+        :return: Response(status, reason, headers, body)
+        """
+        connect_timeout, read_timeout = split_timeout(self.timeout if timeout is None else timeout)
+        key, path = split_url(url)
+
+        while True:
+            conn, reused = self._checkout(key)
+            sent = False
+            try:
+                if conn.sock is None:
+                    if connect_timeout is not None:
+                        conn.timeout = connect_timeout
+                    if trace is None:
+                        conn.connect()
+                    else:
+                        self._traced_connect(conn, trace)
+                if read_timeout is not None:
+                    conn.sock.settimeout(read_timeout)
+                started = time.perf_counter()
+                conn.request(method, path, body, headers or {})
+                sent = True
+                response = conn.getresponse()
+                if trace is not None:
+                    trace('ttfb', time.perf_counter() - started)
+                data = response.read()
+            except (ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                # server dropped keep-alive connection between requests: the request wasn't written or
+                # no byte of reply came. Other resets may follow processing of the request, it isn't resent
+                if reused and (not sent or isinstance(e, http.client.RemoteDisconnected)):
+                    logger.debug('Pooled connection to %s:%s was closed by peer, retrying', key[1], key[2])
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(key, conn)
+            return Response(response.status, response.reason, response.getheaders(), data)
+
+    def prewarm(self, url: str, connections: int=1, timeout=None):
+        """
+        Open connections (TCP connect and TLS handshake) to the host of url ahead of the first request
+        :param connections: number of connections put to the pool, no more than maxsize
+        :param timeout: resilience.Timeout(connect, read) or seconds, transport timeout if None
+        """
+        connect_timeout, _ = split_timeout(self.timeout if timeout is None else timeout)
+        key, _ = split_url(url)
+        for _ in range(min(connections, self.maxsize)):
+            conn = self._connect(key)
+            if connect_timeout is not None:
+                conn.timeout = connect_timeout
+            try:
+                conn.connect()
+            except BaseException:
+                conn.close()
+                raise
+            self._release(key, conn)
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, collections.defaultdict(collections.deque)
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
@@ -43,6 +43,9 @@ setup(
     packages=find_packages(),
     install_requires=[],
     extras_require={
-        'soap': ['suds-py3k']
-    }
+        'http2': ['httpx[http2]'],
+    },
+    entry_points={
+        'console_scripts': ['pysberbps-profile=pysberbps.profiler:main'],
+    },
 )